@@ -0,0 +1,433 @@
+'''
+Benchmarks of the LUT inversion hot path (`inv_img`, `inv_df` and
+`retrieve_traits` of `rtm_inv.core.inversion`) on synthetic LUTs and
+images.
+
+Every benchmark case runs in a fresh process so that the peak resident
+set size (RSS) reported refers to that case only. BLAS is limited to a
+single thread while timing, so the thread scaling only reflects the
+`n_workers` threads. The solutions aggregated
+by `retrieve_traits` are searched beforehand in a separate process, so its
+peak RSS does not include the search. Synthetic data is drawn
+with fixed seeds, so runs on different commits see the same inputs.
+Results are written to a JSON file, e.g.
+
+    python benchmarks/bench_inversion.py --preset quick -o bench.json
+    python benchmarks/bench_inversion.py --preset quick -o new.json \
+        --baseline bench.json
+
+compares a new run against an earlier one case by case.
+
+@author Lukas Valentin Graf
+'''
+
+import json
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from argparse import ArgumentParser
+from datetime import datetime
+from pathlib import Path
+from threadpoolctl import threadpool_info, threadpool_limits
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+from rtm_inv.core.cost_functions import available_cost_functions
+from rtm_inv.core.inversion import inv_df, inv_img, retrieve_traits
+
+# grids of LUT sizes, numbers of bands and image sizes (pixels per side)
+presets = {
+    'quick': {
+        'lut_sizes': [10_000],
+        'n_bands': [9],
+        'img_sizes': [100]
+    },
+    'default': {
+        'lut_sizes': [10_000, 50_000],
+        'n_bands': [9, 13],
+        'img_sizes': [100, 500]
+    },
+    'full': {
+        'lut_sizes': [10_000, 50_000, 200_000],
+        'n_bands': [9, 13],
+        'img_sizes': [100, 500, 2000]
+    }
+}
+measures = ['median', 'mean', 'weighted_mean']
+traits = ['lai', 'ccc']
+# fraction of masked pixels in the synthetic images
+mask_fraction = 0.1
+# keys identifying a benchmark case across runs
+case_keys = [
+    'function', 'lut_size', 'n_bands', 'img_size', 'cost_function',
+    'measure', 'n_workers', 'n_solutions'
+]
+
+
+def _synthetic_data(
+        lut_size: int,
+        n_bands: int,
+        img_size: int
+) -> Dict[str, Any]:
+    """
+    Draws a synthetic LUT (spectra and traits) and an image whose pixels
+    are noisy copies of LUT spectra, using fixed seeds
+    """
+    rng = np.random.default_rng(42)
+    band_names = [f'B{x:02d}' for x in range(n_bands)]
+    lut = pd.DataFrame(
+        rng.uniform(0.01, 0.6, (lut_size, n_bands)), columns=band_names)
+    for trait in traits:
+        lut[trait] = rng.uniform(0., 7., lut_size)
+    n_pixels = img_size**2
+    pixels = lut[band_names].values[rng.integers(0, lut_size, n_pixels)]
+    pixels = np.clip(
+        pixels + rng.normal(0., 0.01, pixels.shape), 0.001, None)
+    img = pixels.T.reshape(n_bands, img_size, img_size)
+    mask = rng.random((img_size, img_size)) < mask_fraction
+    return {
+        'lut': lut,
+        'band_names': band_names,
+        'img': img,
+        'mask': mask,
+        'df': pd.DataFrame(pixels[~mask.ravel()], columns=band_names)
+    }
+
+
+def _search_solutions(case: Dict[str, Any], fpath_solutions: Path) -> None:
+    """
+    Searches the solutions aggregated by a `retrieve_traits` case (in a
+    worker process) and saves them to a `.npz` file
+    """
+    data = _synthetic_data(
+        lut_size=case['lut_size'],
+        n_bands=case['n_bands'],
+        img_size=case['img_size']
+    )
+    lut_idxs, cost_function_values = inv_img(
+        lut=data['lut'][data['band_names']].values,
+        img=data['img'],
+        mask=data['mask'],
+        cost_function=case['cost_function'],
+        n_solutions=case['n_solutions'],
+        backend='kdtree',
+        n_workers=None
+    )
+    np.savez(
+        fpath_solutions,
+        lut_idxs=lut_idxs,
+        cost_function_values=cost_function_values
+    )
+
+
+def _run_case(
+        case: Dict[str, Any],
+        fpath_solutions: Optional[Path] = None
+) -> Dict[str, Any]:
+    """
+    Runs a benchmark case (in a worker process) and returns the case with
+    its wall times, throughput and peak RSS. `retrieve_traits` cases
+    aggregate the solutions saved by `_search_solutions` to
+    `fpath_solutions`.
+    """
+    data = _synthetic_data(
+        lut_size=case['lut_size'],
+        n_bands=case['n_bands'],
+        img_size=case['img_size']
+    )
+    lut_spectra = data['lut'][data['band_names']].values
+    n_pixels = int((~data['mask']).sum())
+
+    if case['function'] == 'inv_img':
+        def func():
+            inv_img(
+                lut=lut_spectra,
+                img=data['img'],
+                mask=data['mask'],
+                cost_function=case['cost_function'],
+                n_solutions=case['n_solutions'],
+                n_workers=case['n_workers']
+            )
+    elif case['function'] == 'inv_df':
+        def func():
+            inv_df(
+                lut=data['lut'][data['band_names']],
+                df=data['df'],
+                cost_function=case['cost_function'],
+                n_solutions=case['n_solutions'],
+                n_workers=case['n_workers']
+            )
+    elif case['function'] == 'retrieve_traits':
+        with np.load(fpath_solutions) as solutions:
+            lut_idxs = solutions['lut_idxs']
+            cost_function_values = solutions['cost_function_values']
+
+        def func():
+            retrieve_traits(
+                lut=data['lut'],
+                lut_idxs=lut_idxs,
+                cost_function_values=cost_function_values,
+                traits=traits,
+                measure=case['measure'],
+                n_workers=case['n_workers']
+            )
+    else:
+        raise ValueError(f'Function {case["function"]} is not benchmarked')
+
+    wall_times = []
+    # keep BLAS from adding its own threads to the `n_workers` threads
+    with threadpool_limits(limits=1):
+        blas_threads = max(
+            (x['num_threads'] for x in threadpool_info()
+             if x['user_api'] == 'blas'),
+            default=None
+        )
+        for _ in range(case['repeats']):
+            t0 = time.perf_counter()
+            func()
+            wall_times.append(time.perf_counter() - t0)
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak_rss /= 1024
+    return dict(
+        case,
+        n_pixels=n_pixels,
+        wall_times_s=wall_times,
+        wall_time_s=min(wall_times),
+        pixels_per_s=n_pixels / min(wall_times),
+        peak_rss_mb=peak_rss / 1024,
+        blas_threads=blas_threads
+    )
+
+
+def benchmark_cases(
+        lut_sizes: List[int],
+        n_bands: List[int],
+        img_sizes: List[int],
+        n_solutions: Optional[int] = 100,
+        thread_counts: Optional[List[int]] = [1],
+        repeats: Optional[int] = 3
+) -> List[Dict[str, Any]]:
+    """
+    Sets up the benchmark cases. All cost functions and aggregation
+    measures run single-threaded, the thread scaling is measured for
+    'rmse' and the median.
+
+    :param lut_sizes:
+        numbers of LUT spectra
+    :param n_bands:
+        numbers of spectral bands
+    :param img_sizes:
+        image sizes in pixels per side
+    :param n_solutions:
+        number of best solutions per pixel
+    :param thread_counts:
+        numbers of threads (`n_workers`) for the thread scaling
+    :param repeats:
+        number of timed repetitions per case (the minimum is reported)
+    :returns:
+        list of benchmark cases
+    """
+    cases = []
+    for lut_size in lut_sizes:
+        for bands in n_bands:
+            for img_size in img_sizes:
+                base = {
+                    'lut_size': lut_size,
+                    'n_bands': bands,
+                    'img_size': img_size,
+                    'n_solutions': n_solutions,
+                    'repeats': repeats,
+                    'cost_function': None,
+                    'measure': None
+                }
+                for function in ['inv_img', 'inv_df']:
+                    for cost_function in available_cost_functions():
+                        cases.append(dict(
+                            base, function=function,
+                            cost_function=cost_function, n_workers=1))
+                for measure in measures:
+                    cases.append(dict(
+                        base, function='retrieve_traits',
+                        cost_function='rmse', measure=measure, n_workers=1))
+                for n_workers in thread_counts:
+                    if n_workers == 1:
+                        continue
+                    cases.append(dict(
+                        base, function='inv_img', cost_function='rmse',
+                        n_workers=n_workers))
+                    cases.append(dict(
+                        base, function='retrieve_traits',
+                        cost_function='rmse', measure='median',
+                        n_workers=n_workers))
+    return cases
+
+
+def run_benchmarks(cases: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Runs benchmark cases one after the other, each in a fresh process.
+    The solutions of the `retrieve_traits` cases are searched in another
+    process once per input and kept in a temporary directory.
+
+    :param cases:
+        benchmark cases (see `benchmark_cases`)
+    :returns:
+        list of results per case
+    """
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        solutions = {}
+        for idx, case in enumerate(cases):
+            fpath_solutions = None
+            if case['function'] == 'retrieve_traits':
+                inputs = tuple(case[x] for x in [
+                    'lut_size', 'n_bands', 'img_size', 'cost_function',
+                    'n_solutions'])
+                if inputs not in solutions:
+                    solutions[inputs] = Path(tmp_dir).joinpath(
+                        f'solutions_{len(solutions)}.npz')
+                    with ctx.Pool(processes=1) as pool:
+                        pool.apply(
+                            _search_solutions, (case, solutions[inputs]))
+                fpath_solutions = solutions[inputs]
+            with ctx.Pool(processes=1) as pool:
+                res = pool.apply(_run_case, (case, fpath_solutions))
+            results.append(res)
+            print(
+                f'[{idx + 1}/{len(cases)}] {_case_label(res)}: ' +
+                f'{res["wall_time_s"]:.3f}s ' +
+                f'({res["pixels_per_s"]:.0f} px/s, ' +
+                f'peak RSS {res["peak_rss_mb"]:.0f} MB)', flush=True)
+    return results
+
+
+def _case_label(case: Dict[str, Any]) -> str:
+    return ' '.join(
+        f'{key}={case[key]}' for key in case_keys
+        if case.get(key) is not None)
+
+
+def _metadata() -> Dict[str, Any]:
+    """
+    Environment of the benchmark run (commit, versions, hardware)
+    """
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd=Path(__file__).resolve().parent,
+            capture_output=True,
+            text=True,
+            check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def compare(
+        results: List[Dict[str, Any]],
+        baseline: List[Dict[str, Any]],
+        tolerance: Optional[float] = 0.1
+) -> List[Dict[str, Any]]:
+    """
+    Compares the wall times of two benchmark runs case by case
+
+    :param results:
+        results of the current run
+    :param baseline:
+        results of the run to compare against
+    :param tolerance:
+        relative slow-down tolerated before a case counts as regression
+    :returns:
+        list with the ratio of current and baseline wall time of the cases
+        found in both runs and whether it is a regression
+    """
+    baseline = {
+        tuple(x.get(key) for key in case_keys): x for x in baseline}
+    comparison = []
+    for res in results:
+        ref = baseline.get(tuple(res.get(key) for key in case_keys))
+        if ref is None:
+            continue
+        ratio = res['wall_time_s'] / ref['wall_time_s']
+        comparison.append({
+            'case': _case_label(res),
+            'ratio': ratio,
+            'regression': ratio > 1 + tolerance
+        })
+    return comparison
+
+
+if __name__ == '__main__':
+
+    parser = ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--preset', choices=list(presets), default='default',
+        help='grid of LUT sizes, bands and image sizes')
+    parser.add_argument(
+        '--lut-sizes', type=int, nargs='+',
+        help='numbers of LUT spectra (overrides the preset)')
+    parser.add_argument(
+        '--n-bands', type=int, nargs='+',
+        help='numbers of spectral bands (overrides the preset)')
+    parser.add_argument(
+        '--img-sizes', type=int, nargs='+',
+        help='image sizes in pixels per side (overrides the preset)')
+    parser.add_argument(
+        '--n-solutions', type=int, default=100,
+        help='number of best solutions per pixel')
+    parser.add_argument(
+        '--threads', type=int, nargs='+',
+        default=sorted({1, 2, os.cpu_count() or 1}),
+        help='numbers of threads for the thread scaling')
+    parser.add_argument(
+        '--repeats', type=int, default=3,
+        help='timed repetitions per case')
+    parser.add_argument(
+        '-o', '--output', type=Path, default=Path('bench_results.json'),
+        help='JSON file to write the results to')
+    parser.add_argument(
+        '--baseline', type=Path,
+        help='JSON file of an earlier run to compare against')
+    args = parser.parse_args()
+
+    grid = presets[args.preset]
+    cases = benchmark_cases(
+        lut_sizes=args.lut_sizes or grid['lut_sizes'],
+        n_bands=args.n_bands or grid['n_bands'],
+        img_sizes=args.img_sizes or grid['img_sizes'],
+        n_solutions=args.n_solutions,
+        thread_counts=args.threads,
+        repeats=args.repeats
+    )
+    results = run_benchmarks(cases)
+    with open(args.output, 'w+') as dst:
+        json.dump({'meta': _metadata(), 'results': results}, dst, indent=2)
+    print(f'Wrote {len(results)} results to {args.output}')
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as src:
+            baseline = json.load(src)['results']
+        comparison = compare(results, baseline)
+        for item in comparison:
+            flag = 'REGRESSION' if item['regression'] else 'ok'
+            print(f'{item["ratio"]:6.2f}x {flag:10s} {item["case"]}')
+        if any(x['regression'] for x in comparison):
+            sys.exit(1)
@@ -7,8 +7,8 @@ over the growing season and run PROSAIL simulations.
 
 import geopandas as gpd
 import matplotlib.pyplot as plt
+import numpy as np
 import pandas as pd
-import pickle
 import tempfile
 import urllib
 import uuid
@@ -29,7 +29,12 @@ from eodal.mapper.mapper import Mapper, MapperConfigs
 from eodal.metadata.sentinel2.parsing import parse_MTD_TL
 from eodal.utils.sentinel2 import get_S2_platform_from_safe, _url_to_safe_name
 from pathlib import Path
+from rtm_inv.core.angle_grid import (
+    AngleGridLUT, grid_axis, interpolation_error, is_angle_grid,
+    read_angle_grid, relative_azimuth, simulate_angle_grid, write_angle_grid)
 from rtm_inv.core.lookup_table import generate_lut
+from rtm_inv.core.lut_cache import LUTCache, lut_key
+from rtm_inv.core.lut_io import lut_suffix, write_lut
 from typing import Any, Dict, List, Optional
 
 from utils import get_farms
@@ -41,6 +46,12 @@ logger = settings.logger
 # Sentinel-2 bands to extract and use for PROSAIL runs
 band_selection = [
     'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12']
+# LUT configuration options for sampling the RTM parameters and for the
+# PROSAIL runs (used for angle-grid LUTs)
+sampling_options = [
+    'lut_size', 'sampling_method', 'seed_value', 'apply_glai_ccc_constraint',
+    'apply_chlorophyll_carotiniod_constraint']
+rtm_options = ['fpath_srf', 'remove_invalid_green_peaks', 'linearize_lai']
 
 
 def angles_from_mspc(url: str) -> Dict[str, float]:
@@ -195,13 +206,70 @@ def get_s2_mapper(
     return mapper
 
 
+def get_angle_grid(
+    fpath_grid: Path,
+    lut_params: Path,
+    lut_config: Dict[str, Any],
+    axes: Dict[str, np.ndarray]
+    ) -> AngleGridLUT:
+    """
+    Reads the angle-grid LUT of a parametrization or simulates it if it does
+    not exist yet or was simulated for other grid nodes or with another
+    configuration (content of the parameter CSV, sampling and PROSAIL
+    options, sensor and SRF)
+
+    :param fpath_grid:
+        directory of the angle-grid LUT
+    :param lut_params:
+        CSV file with the PROSAIL inputs
+    :param lut_config:
+        configuration telling how to build the LUT (including the sensor)
+    :param axes:
+        grid nodes of the angles 'tts', 'tto' and 'psi'
+    :returns:
+        angle-grid LUT with memory-mapped spectra
+    """
+    unknown_options = [
+        k for k, v in lut_config.items()
+        if k not in sampling_options + rtm_options + ['sensor'] and
+        not k.endswith('_angle') and v is not None
+    ]
+    if unknown_options:
+        raise ValueError(
+            f'Options {unknown_options} are not supported for angle grids')
+    grid_config = {
+        k: v for k, v in lut_config.items()
+        if k in sampling_options + rtm_options + ['sensor']
+    }
+    config_sha1 = lut_key(lut_params=lut_params, **grid_config)
+    if is_angle_grid(fpath_grid):
+        grid = read_angle_grid(fpath_grid)
+        if grid.metadata.get('config_sha1') == config_sha1 and \
+                all(np.array_equal(grid.axes[k], v) for k, v in axes.items()):
+            return grid
+    lut = generate_lut(
+        lut_params=lut_params,
+        **{k: v for k, v in lut_config.items() if k in sampling_options})
+    grid = simulate_angle_grid(
+        lut=lut,
+        sensor=lut_config['sensor'],
+        **axes,
+        **{k: v for k, v in lut_config.items() if k in rtm_options})
+    write_angle_grid(
+        grid, fpath_grid, metadata={'config_sha1': config_sha1},
+        overwrite=True)
+    return read_angle_grid(fpath_grid)
+
+
 def get_s2_spectra(
     output_dir: Path,
     lut_params_dir: Path,
     s2_mapper_config: Dict[str, Any],
     rtm_lut_config: Dict[str, Any],
     traits: List[str],
-    apply_contraints: Optional[bool] = True
+    apply_contraints: Optional[bool] = True,
+    lut_cache: Optional[LUTCache] = None,
+    angle_grid_steps: Optional[Dict[str, float]] = None
     ) -> None:
     """
     Extract S2 SRF for field parcel geometries and run PROSAIL in forward mode
@@ -221,12 +289,40 @@ def get_s2_spectra(
         are available from the inversion)
     :param apply_constraints:
         whether to apply the GLAI-CCC and Cab-Car constraint. Default is True.
+    :param lut_cache:
+        optional cache of LUTs shared across scenes and runs. Scenes with
+        the same (rounded) angles and sensor reference the cached LUT
+        instead of simulating it again.
+    :param angle_grid_steps:
+        optional steps (deg) of a grid of solar zenith ('tts'), viewing
+        zenith ('tto') and relative azimuth ('psi') angles covering all
+        scenes. If provided, PROSAIL is run once per parametrization and
+        sensor on the grid (see `rtm_inv.core.angle_grid`) and the LUTs of
+        the scenes are interpolated from the grid instead of being
+        simulated. The interpolation error versus direct simulation is
+        logged and stored with the LUT metadata. The LUT cache is not used
+        for interpolated LUTs.
     """
     trait_str = '-'.join(traits)
     mapper = get_s2_mapper(s2_mapper_config, output_dir=output_dir)
     s2_data = mapper.data
     s2_metadata = mapper.metadata
     s2_metadata['sensing_date'] = pd.to_datetime(s2_metadata.sensing_date)
+    # grid nodes of the angle-grid LUTs covering the angles of all scenes
+    angle_grid_axes = None
+    if angle_grid_steps is not None:
+        angle_grid_axes = {
+            'tts': grid_axis(
+                s2_metadata['sun_zenith_angle'], angle_grid_steps['tts']),
+            'tto': grid_axis(
+                s2_metadata['sensor_zenith_angle'], angle_grid_steps['tto']),
+            'psi': grid_axis(
+                relative_azimuth(
+                    s2_metadata['sun_azimuth_angle'],
+                    s2_metadata['sensor_azimuth_angle']),
+                angle_grid_steps['psi'])
+        }
+    angle_grids = {}
     # loop over mapper
     for _, scene in s2_data:
         # make sure we're looking at the right metadata
@@ -294,12 +390,14 @@ def get_s2_spectra(
             # generate lookup-table for the current angles
             if apply_contraints:
                 fpath_lut = res_dir_scene.joinpath(
-                    f'{pheno_phases}_{trait_str}_lut.pkl')
+                    f'{pheno_phases}_{trait_str}_lut{lut_suffix}')
             else:
                 fpath_lut = res_dir_scene.joinpath(
-                    f'{pheno_phases}_{trait_str}_lut_no-constraints.pkl')
-            # if LUT exists, continue, else generate it
-            if not fpath_lut.exists():
+                    f'{pheno_phases}_{trait_str}_lut_no-constraints' +
+                    lut_suffix)
+            # if LUT exists (also as legacy pickle), continue, else generate it
+            if not (fpath_lut.exists() or
+                    fpath_lut.with_suffix('.pkl').exists()):
                 lut_inp = rtm_lut_config.copy()
                 lut_inp.update(angle_dict)
                 if not apply_contraints:
@@ -307,8 +405,50 @@ def get_s2_spectra(
                         'apply_glai_ccc_constraint': False,
                         'apply_chlorophyll_carotiniod_constraint': False
                     })
-                lut_inp['lut_params'] = lut_params_pheno
-                lut = generate_lut(**lut_inp)
+                lut_metadata = {'params_file': lut_params_pheno.name}
+                lut_key = None
+                if angle_grid_axes is not None:
+                    # interpolate the LUT from the angle grid of the
+                    # parametrization and sensor
+                    grid_name = f'{pheno_phases}_{trait_str}_{platform}_grid'
+                    if not apply_contraints:
+                        grid_name += '_no-constraints'
+                    if grid_name not in angle_grids:
+                        angle_grids[grid_name] = get_angle_grid(
+                            fpath_grid=output_dir.joinpath(grid_name),
+                            lut_params=lut_params_pheno,
+                            lut_config=lut_inp,
+                            axes=angle_grid_axes)
+                    scene_angles = {
+                        'tts': float(angle_dict['solar_zenith_angle']),
+                        'tto': float(angle_dict['viewing_zenith_angle']),
+                        'psi': float(relative_azimuth(
+                            angle_dict['solar_azimuth_angle'],
+                            angle_dict['viewing_azimuth_angle']))
+                    }
+                    lut = angle_grids[grid_name].interpolate(**scene_angles)
+                    errors = interpolation_error(
+                        angle_grids[grid_name], **scene_angles)
+                    logger.info(
+                        f'{metadata.product_uri.iloc[0]} {pheno_phases}: ' +
+                        f'interpolation RMSE {errors["rmse"]:.5f} (max ' +
+                        f'{errors["max_abs_error"]:.5f}, relative ' +
+                        f'{errors["relative_rmse"]:.2%}) versus ' +
+                        f'{errors["n_samples"]} directly simulated spectra')
+                    lut_metadata['interpolation_error'] = errors
+                else:
+                    # look up the LUT in the cache (angles are rounded to the
+                    # tolerance of the cache)
+                    if lut_cache is not None:
+                        lut_inp = lut_cache.round_angles(lut_inp)
+                        lut_key = lut_cache.key(
+                            lut_params=lut_params_pheno, traits=traits,
+                            **lut_inp)
+                        if lut_cache.get(lut_key) is not None:
+                            lut_cache.link(lut_key, fpath_lut)
+                            continue
+                    lut_inp['lut_params'] = lut_params_pheno
+                    lut = generate_lut(**lut_inp)
                 # special case CCC (Canopy Chlorophyll Content) ->
                 # this is not a direct RTM output
                 if 'ccc' in traits:
@@ -321,15 +461,21 @@ def get_s2_spectra(
                 # lut = lut[band_selection + traits].copy()
                 lut.dropna(inplace=True)
 
-                # save LUT to file
-                # if not fpath_lut.exists():
-                with open(fpath_lut, 'wb+') as f:
-                    pickle.dump(lut, f)
+                # save LUT to file (columnar format with metadata)
+                if lut_key is not None:
+                    lut_cache.put(lut_key, lut, metadata=lut_metadata)
+                    lut_cache.link(lut_key, fpath_lut)
+                else:
+                    write_lut(lut, fpath_lut, metadata=lut_metadata)
             else:
                 continue
 
         logger.info(f'{metadata.product_uri.iloc[0]} finished PROSAIL runs')
 
+    if lut_cache is not None:
+        logger.info(
+            f'LUT cache: {lut_cache.hits} hits, {lut_cache.misses} misses')
+
 
 if __name__ == '__main__':
 
@@ -354,6 +500,14 @@ if __name__ == '__main__':
     }
     # directory with LUT parameters for different phenological macro-stages
     lut_params_dir = Path('lut_params')
+    # LUTs shared across scenes and runs (bounded to 20 GB)
+    lut_cache = LUTCache(
+        cache_dir=out_dir.joinpath('lut_cache'), max_size=20 * 1024**3)
+    # optional steps (deg) of an angle grid the LUTs of the scenes are
+    # interpolated from, e.g., {'tts': 5, 'tto': 5, 'psi': 30}. One grid is
+    # simulated per parametrization and platform, which pays off only for
+    # many scenes. None simulates a LUT per scene (using the LUT cache).
+    angle_grid_steps = None
 
     # target trait(s)
     traits = ['lai', 'cab', 'ccc', 'car']
@@ -396,7 +550,9 @@ if __name__ == '__main__':
                 lut_params_dir=lut_params_dir,
                 s2_mapper_config=s2_mapper_config,
                 rtm_lut_config=rtm_lut_config,
-                traits=traits
+                traits=traits,
+                lut_cache=lut_cache,
+                angle_grid_steps=angle_grid_steps
             )
         except Exception as e:
             logger.error(f'Farm {farm}: {e}')
@@ -439,7 +595,9 @@ if __name__ == '__main__':
                     s2_mapper_config=s2_mapper_config,
                     rtm_lut_config=rtm_lut_config,
                     traits=traits,
-                    apply_contraints=apply_constraints
+                    apply_contraints=apply_constraints,
+                    lut_cache=lut_cache,
+                    angle_grid_steps=angle_grid_steps
                 )
             except Exception as e:
                 logger.error(f'Farm {farm}: {e}')
@@ -6,11 +6,14 @@ PROSAIL lookup tables
 '''
 
 import numpy as np
-import pandas as pd
+import rasterio
+import tempfile
+import time
 import warnings
 
 import sys
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 base_dir = Path(os.path.dirname(os.path.realpath("__file__"))).parent
 sys.path.insert(0, os.path.join(base_dir, "eodal"))
@@ -18,8 +21,17 @@ from eodal.config import get_settings
 from eodal.core.band import Band
 from eodal.core.raster import RasterCollection
 from pathlib import Path
-from typing import Dict, List, Optional
-from rtm_inv.core.inversion import inv_img, retrieve_traits
+from typing import Any, Dict, List, Optional, Tuple
+from rtm_inv.core.inversion import backend_indices
+from rtm_inv.core.lut_index import LUTNeighbourGraph
+from rtm_inv.core.lut_io import find_luts, read_lut
+from rtm_inv.core.precision import (
+    PrecisionPolicy, get_precision_policy, no_solution,
+    set_precision_policy)
+from rtm_inv.core.result_cache import SolutionCache
+from rtm_inv.core.streaming import (
+    cost_summaries, inv_img_multi_streaming, inv_img_streaming,
+    retrieve_traits_streaming)
 
 logger = get_settings().logger
 warnings.filterwarnings('ignore')
@@ -27,6 +39,381 @@ warnings.filterwarnings('ignore')
 band_selection = [
     'B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12']
 
+# largest share of the LUT the warm start candidates of a pixel may cover.
+# Beyond, searching the candidates is hardly faster than a full search
+max_warm_start_fraction = 0.25
+
+
+def _prepare_lut(
+    fpath_lut: Path,
+    lut_size: int,
+    lut_dir: Path
+) -> Dict[str, Any]:
+    """
+    Reads a LUT, draws a sub-sample if required and writes the LUT
+    as `.npy` file that workers can memory-map read-only instead of
+    receiving a pickled copy of the LUT per task.
+
+    :param fpath_lut:
+        file-path to the LUT (columnar or legacy pickle, see
+        `rtm_inv.core.lut_io.read_lut`)
+    :param lut_size:
+        number of LUT entries to use
+    :param lut_dir:
+        directory where to write the `.npy` file to
+    :returns:
+        file-path of the `.npy` file and the column names of the LUT
+    """
+    lut = read_lut(fpath_lut)
+    # draw sub-sample from LUT if required (using a fixed seed
+    # so that a persisted LUT index remains valid)
+    if lut_size < lut.shape[0]:
+        lut = lut.sample(lut_size, random_state=0)
+    lut = lut.select_dtypes(include='number')
+    fpath_npy = lut_dir.joinpath(
+        f'{fpath_lut.parent.parent.name}_{fpath_lut.parent.name}_' +
+        f'{fpath_lut.stem}.npy')
+    np.save(fpath_npy, np.ascontiguousarray(lut.values, dtype='float64'))
+    return {'fpath_npy': fpath_npy, 'columns': lut.columns.tolist()}
+
+
+def _n_workers(
+    per_job_bytes: int,
+    n_workers: Optional[int] = None
+) -> int:
+    """
+    Number of worker processes to use given the number of cores and the
+    memory currently available
+
+    :param per_job_bytes:
+        estimated peak memory of a single job in bytes
+    :param n_workers:
+        optional upper limit of workers. Defaults to the number of cores.
+    :returns:
+        number of workers (at least 1)
+    """
+    n_cores = os.cpu_count() or 1
+    if n_workers is None:
+        n_workers = n_cores
+    try:
+        available = os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+        n_workers = min(n_workers, available // per_job_bytes)
+    except (AttributeError, ValueError, OSError):
+        # memory information not available on this platform
+        pass
+    return int(max(1, min(n_workers, n_cores)))
+
+
+def _scene_shape(scene_dir: Path) -> Tuple[int, int]:
+    """
+    Number of rows and columns of a S2 scene read from the header of its
+    raster
+    """
+    with rasterio.open(scene_dir.joinpath('SRF_S2.tiff')) as src:
+        return src.height, src.width
+
+
+def _save_traits(
+    s2_ds: RasterCollection,
+    bands: List[str],
+    traits: List[str],
+    outputs: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    fname: Path
+) -> None:
+    """
+    Saves retrieved traits, their 5 and 95% percentiles and the cost
+    function summaries to GeoTiff
+
+    :param s2_ds:
+        inverted S2 scene (provides the geo-information)
+    :param bands:
+        S2 bands used for the inversion
+    :param traits:
+        retrieved traits
+    :param outputs:
+        outputs of `inv_img_streaming`
+    :param fname:
+        file-path of the GeoTiff
+    """
+    trait_img, q05_img, q95_img, cost_img = outputs
+    trait_collection = RasterCollection()
+    for tdx, trait in enumerate(traits):
+        trait_collection.add_band(
+            Band,
+            geo_info=s2_ds[bands[0]].geo_info,
+            band_name=trait,
+            values=trait_img[tdx, :, :]
+        )
+        trait_collection.add_band(
+            Band,
+            geo_info=s2_ds[bands[0]].geo_info,
+            band_name=f'{trait}_q05',
+            values=q05_img[tdx, :, :]
+        )
+        trait_collection.add_band(
+            Band,
+            geo_info=s2_ds[bands[0]].geo_info,
+            band_name=f'{trait}_q95',
+            values=q95_img[tdx, :, :]
+        )
+    # save lowest, median and highest cost function value
+    for cdx, cost_summary in enumerate(cost_summaries):
+        trait_collection.add_band(
+            Band,
+            geo_info=s2_ds[bands[0]].geo_info,
+            band_name=cost_summary,
+            values=cost_img[cdx, :, :]
+        )
+    trait_collection.to_rasterio(fpath_raster=fname)
+
+
+def _acquisition_time(scene_dir: Path) -> str:
+    """
+    Sensing time of a S2 scene from its .SAFE name (e.g.,
+    `S2A_MSIL2A_20190420T103021_...` -> `20190420T103021`) to sort scenes
+    """
+    parts = scene_dir.name.split('_')
+    return parts[2] if len(parts) > 2 else scene_dir.name
+
+
+def _invert_job(
+        job: Dict[str, Any],
+        previous: Optional[Dict[str, Tuple[List[str], np.ndarray, np.ndarray]]]
+        = None
+) -> Dict[str, Any]:
+    """
+    Inverts a single S2 scene against one or more LUTs (phenological
+    phases) and saves the traits to GeoTiff. Runs in a worker process.
+
+    :param job:
+        job description (see `invert_scenes`)
+    :param previous:
+        RTM parameter names, RTM parameters of the LUT and best solutions
+        per phase of the previous scene of the time series to warm start
+        the inversion from (see `_invert_series`)
+    :returns:
+        job identifiers, run time in seconds and inversion statistics (and
+        the solutions per phase for warm starting the next scene)
+    """
+    t0 = time.perf_counter()
+    scene_dir = job['scene_dir']
+    traits = job['traits']
+    # worker processes do not inherit the policy of the parent process
+    set_precision_policy(job['precision'])
+
+    # load the Sentinel-2 data
+    fpath_s2_raster = scene_dir.joinpath('SRF_S2.tiff')
+    s2_ds = RasterCollection.from_multi_band_raster(
+        fpath_raster=fpath_s2_raster)
+    bands = s2_ds.band_names[:-1]
+    s2_spectra = s2_ds.get_values(band_selection=bands)
+
+    if isinstance(s2_spectra, np.ma.MaskedArray):
+        mask = s2_spectra.mask[0, :, :]
+        s2_spectra = s2_spectra.data
+    else:
+        mask = np.zeros(
+            shape=(
+                s2_spectra.shape[1], s2_spectra.shape[2]
+            ),
+            dtype='uint8')
+        mask = mask.astype('bool')
+        mask[s2_spectra[0, :, :] == 0] = True
+
+    # the LUTs are shared read-only between workers
+    s2_lut_spectra, trait_values = {}, {}
+    for pheno_phase, lut_job in job['luts'].items():
+        lut = np.load(lut_job['fpath_npy'], mmap_mode='r')
+        columns = lut_job['columns']
+        s2_lut_spectra[pheno_phase] = \
+            lut[:, [columns.index(x) for x in bands]]
+        trait_values[pheno_phase] = lut[:, [columns.index(x) for x in traits]]
+
+    # jobs run in a process pool with one worker per core, so the traits
+    # are retrieved on a single thread
+    stats = {}
+    if job['multi_phase']:
+        # invert all phases in a single pass over the scene
+        res = inv_img_multi_streaming(
+            luts=s2_lut_spectra,
+            trait_values=trait_values,
+            img=s2_spectra,
+            mask=mask,
+            cost_functions={
+                k: v['cost_function'] for k, v in job['luts'].items()},
+            n_solutions={
+                k: v['n_solutions'] for k, v in job['luts'].items()},
+            measures={k: v['measure'] for k, v in job['luts'].items()},
+            memory_budget=job['memory_budget'],
+            dedup=job['dedup'],
+            stats=stats,
+            n_workers=1
+        )
+    else:
+        res, solutions = {}, {}
+        cache = None
+        if job['cache_dir'] is not None:
+            cache = SolutionCache(job['cache_dir'])
+        policy = get_precision_policy()
+        for pheno_phase, lut_job in job['luts'].items():
+            lut_index = None
+            if job['backend'] in backend_indices:
+                lut_index = backend_indices[job['backend']].from_lut_file(
+                    fpath_lut=lut_job['fpath_lut'],
+                    lut=s2_lut_spectra[pheno_phase])
+            warm_start, graph = None, None
+            solutions_out, costs_out = None, None
+            if job['warm_start']:
+                # link the LUT of the previous scene to the LUT of this scene
+                # in the space of the RTM parameters
+                params = [x for x in lut_job['columns'] if x not in bands]
+                lut = np.load(lut_job['fpath_npy'], mmap_mode='r')
+                lut_params = lut[
+                    :, [lut_job['columns'].index(x) for x in params]]
+                if previous is not None and pheno_phase in previous:
+                    prev_params, prev_lut_params, prev_solutions = \
+                        previous[pheno_phase]
+                    if prev_params == params and \
+                            prev_solutions.shape[1:] == mask.shape:
+                        # candidates are derived from the solutions of the
+                        # previous scene tile by tile while inverting
+                        graph = LUTNeighbourGraph(
+                            source=prev_lut_params,
+                            target=lut_params,
+                            n_neighbours=job['n_neighbours'],
+                            n_jobs=1
+                        )
+                        warm_start = prev_solutions
+            warm_start_threshold = job['warm_start_thresholds'].get(
+                pheno_phase)
+            index_dtype = policy.index_dtype(
+                s2_lut_spectra[pheno_phase].shape[0])
+            solutions_shape = (lut_job['n_solutions'],) + mask.shape
+
+            # solutions of an earlier run with the same inputs only need to
+            # be aggregated again
+            cached = None
+            if cache is not None:
+                key = cache.key(
+                    lut=s2_lut_spectra[pheno_phase],
+                    img=s2_spectra,
+                    mask=mask,
+                    cost_function=lut_job['cost_function'],
+                    n_solutions=lut_job['n_solutions'],
+                    warm_start=warm_start,
+                    warm_start_threshold=warm_start_threshold,
+                    warm_start_graph=graph
+                )
+                cached = cache.get(key)
+            if cached is not None:
+                solutions_out = cached[0]
+                res[pheno_phase] = retrieve_traits_streaming(
+                    trait_values=trait_values[pheno_phase],
+                    lut_idxs=cached[0],
+                    cost_function_values=cached[1],
+                    measure=lut_job['measure'],
+                    memory_budget=job['memory_budget'],
+                    n_workers=1
+                )
+            else:
+                if cache is not None:
+                    solutions_out, costs_out = cache.allocate(
+                        key=key,
+                        shape=solutions_shape,
+                        index_dtype=index_dtype,
+                        cost_dtype=policy.cost_dtype
+                    )
+                elif job['warm_start']:
+                    # only the seeds of the next scene are kept
+                    solutions_out = np.full(
+                        (lut_job['n_seeds'],) + mask.shape,
+                        no_solution(index_dtype),
+                        dtype=index_dtype
+                    )
+                res[pheno_phase] = inv_img_streaming(
+                    lut=s2_lut_spectra[pheno_phase],
+                    trait_values=trait_values[pheno_phase],
+                    img=s2_spectra,
+                    mask=mask,
+                    cost_function=lut_job['cost_function'],
+                    n_solutions=lut_job['n_solutions'],
+                    measure=lut_job['measure'],
+                    memory_budget=job['memory_budget'],
+                    backend=job['backend'],
+                    lut_index=lut_index,
+                    dedup=job['dedup'],
+                    stats=stats,
+                    warm_start=warm_start,
+                    warm_start_threshold=warm_start_threshold,
+                    warm_start_graph=graph,
+                    solutions_out=solutions_out,
+                    costs_out=costs_out,
+                    n_workers=1
+                )
+                if cache is not None:
+                    solutions_out.flush()
+                    costs_out.flush()
+                    cache.commit(key)
+            if job['warm_start']:
+                solutions[pheno_phase] = (
+                    params, lut_params,
+                    np.array(solutions_out[:lut_job['n_seeds']]))
+        if cache is not None:
+            stats['cache_hits'] = cache.hits
+            stats['cache_misses'] = cache.misses
+
+    # save to GeoTiff
+    for pheno_phase, outputs in res.items():
+        _save_traits(
+            s2_ds=s2_ds,
+            bands=bands,
+            traits=traits,
+            outputs=outputs,
+            fname=scene_dir.joinpath(f'{pheno_phase}_lutinv_traits.tiff')
+        )
+
+    res_job = {
+        'farm': job['farm'],
+        'scene': scene_dir.name,
+        'pheno_phases': list(res.keys()),
+        'seconds': time.perf_counter() - t0,
+        'stats': stats
+    }
+    if job['warm_start']:
+        res_job['solutions'] = solutions
+    return res_job
+
+
+def _invert_series(jobs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Inverts the scenes of a time series one after the other, warm starting
+    each scene from the solutions of the previous one. Runs in a worker
+    process.
+
+    :param jobs:
+        job descriptions (see `invert_scenes`) in temporal order
+    :returns:
+        list of job results (see `_invert_job`). If a scene fails, its
+        result holds the 'error' and the next scene is inverted without
+        warm start.
+    """
+    results, previous = [], None
+    for job in jobs:
+        try:
+            res = _invert_job(job, previous)
+        except Exception as e:
+            results.append({
+                'farm': job['farm'],
+                'scene': job['scene_dir'].name,
+                'pheno_phases': list(job['luts']),
+                'error': e
+            })
+            previous = None
+            continue
+        previous = res.pop('solutions')
+        results.append(res)
+    return results
+
 
 def invert_scenes(
     data_dir: Path,
@@ -35,12 +422,28 @@ def invert_scenes(
     cost_functions: Dict[str, str],
     aggregation_methods: Dict[str, str],
     lut_sizes: Dict[str, str],
-    traits: Optional[List[str]] = ['lai', 'ccc']
+    traits: Optional[List[str]] = ['lai', 'ccc'],
+    backend: Optional[str] = 'brute',
+    memory_budget: Optional[float] = 1024,
+    n_workers: Optional[int] = None,
+    dedup: Optional[bool] = True,
+    multi_phase: Optional[bool] = False,
+    warm_start: Optional[bool] = False,
+    warm_start_thresholds: Optional[Dict[str, float]] = None,
+    warm_start_seeds: Optional[Dict[str, int]] = None,
+    n_neighbours: Optional[int] = 4,
+    precision: Optional[PrecisionPolicy] = None,
+    cache_dir: Optional[Path] = None
 ):
     """
     Lookup table based inversion of S2 imagery. The inversion setup can
     be adopted for each phenological macro-stage.
 
+    The (scene, LUT) combinations are independent and are inverted in a
+    pool of worker processes. LUTs are handed to the workers as read-only
+    memory-mapped files. With `multi_phase` a job comprises a scene and all
+    its LUTs, which are inverted in a single pass over the scene.
+
     :param data_dir:
         directory where PROSAIL LUTs and extracted S2 data are located
     :param farms:
@@ -58,126 +461,229 @@ def invert_scenes(
     :param traits:
         list of traits to extract (this is used to find the correct LUT file).
         Defaults to 'lai', 'cab', and 'ccc'.
+    :param backend:
+        LUT search backend passed to `inv_img`. When using 'kdtree' or
+        'pca' the KD-tree or principal component projection is persisted
+        next to the LUT file so that repeated inversions skip building it.
+    :param memory_budget:
+        memory budget in MB for the cost function values of a block of
+        pixels and the solutions of an image tile. Scenes are inverted tile
+        by tile and only the trait statistics and cost function summaries
+        are kept.
+    :param n_workers:
+        maximum number of worker processes. By default, as many workers
+        as cores are used as long as the available memory allows it.
+    :param dedup:
+        if True (default) the LUT is searched only once per unique pixel
+        spectrum. The resulting dedup ratio is logged per job.
+    :param multi_phase:
+        if True, inverts all phenological phases of a scene in a single pass
+        computing the cost function values once per cost function (brute
+        force backend only).
+    :param warm_start:
+        if True, the scenes of a farm are inverted in temporal order (one
+        worker per farm and phase) and each scene first searches the LUT
+        rows closest (in the space of the RTM parameters) to the solutions
+        of the previous scene before falling back to a full search. The
+        fallback rate is logged per scene. Intended for small numbers of
+        solutions as the candidates of a pixel may cover at most
+        `max_warm_start_fraction` of the LUT.
+    :param warm_start_thresholds:
+        cost function value per phenological macro-stage the best candidate
+        of a pixel must reach for the warm start to be accepted. Pixels
+        whose best candidate is worse are searched in the whole LUT.
+        Required for every phase inverted when warm starting.
+    :param warm_start_seeds:
+        number of best solutions of the previous scene per phenological
+        macro-stage the candidates are derived from (each linked to
+        `n_neighbours` LUT rows). Defaults to the number of solutions.
+    :param n_neighbours:
+        number of LUT rows of the current scene linked to every LUT row of
+        the previous scene when warm starting
+    :param precision:
+        ``PrecisionPolicy`` setting the data types of the solutions and
+        of the traits written to GeoTiff. Defaults to the policy set by
+        `rtm_inv.core.precision.set_precision_policy` (float32 traits).
+    :param cache_dir:
+        optional directory where the solutions of the LUT searches are
+        cached (see `rtm_inv.core.result_cache.SolutionCache`). Re-running
+        with the same LUTs, scenes, cost functions and numbers of solutions
+        but another aggregation method or traits then skips the search.
+        Cache hits and misses are logged per job.
     """
-    # loop over locations
-    for farm in farms:
-        farm_dir = data_dir.joinpath(farm)
-        if not farm_dir.exists():
-            continue
-        # loop over scenes in farm, find lookup tables and apply the LUT based
-        # inversion
-        for scene_dir in farm_dir.glob('*.SAFE'):
-            # load the Sentinel-2 data
-            fpath_s2_raster = scene_dir.joinpath('SRF_S2.tiff')
-            s2_ds = RasterCollection.from_multi_band_raster(
-                fpath_raster=fpath_s2_raster)
-            bands = s2_ds.band_names[:-1]
-            s2_spectra = s2_ds.get_values(band_selection=bands)
-
-            logger.info(f'{farm}: Started inversion of {scene_dir.name}')
-            # find the LUTs generated and use them for inversion
-            for fpath_lut in scene_dir.glob('*lut.pkl'):
-                # check if the LUT contains the correct traits,
-                # otherwise continue
-                fname_lut = fpath_lut.name
-                if not all([x in fname_lut for x in traits]):
+    if multi_phase and backend != 'brute':
+        raise ValueError('Multi-phase inversion requires the brute backend')
+    if multi_phase and warm_start:
+        raise ValueError(
+            'Warm starts are not supported for multi-phase inversions')
+    if multi_phase and cache_dir is not None:
+        raise ValueError(
+            'Caching solutions is not supported for multi-phase inversions')
+    if warm_start_thresholds is None:
+        warm_start_thresholds = {}
+    if warm_start_seeds is None:
+        warm_start_seeds = {}
+    if precision is None:
+        precision = get_precision_policy()
+    with tempfile.TemporaryDirectory() as lut_dir:
+        lut_dir = Path(lut_dir)
+        # collect the (scene, LUT) jobs
+        jobs = []
+        # loop over locations
+        for farm in farms:
+            farm_dir = data_dir.joinpath(farm)
+            if not farm_dir.exists():
+                continue
+            # loop over scenes in farm, find lookup tables
+            # in temporal order so that warm starts follow the time series
+            for scene_dir in sorted(
+                    farm_dir.glob('*.SAFE'), key=_acquisition_time):
+                scene_luts = {}
+                for fpath_lut in find_luts(scene_dir, '*lut'):
+                    # check if the LUT contains the correct traits,
+                    # otherwise continue
+                    fname_lut = fpath_lut.name
+                    if not all([x in fname_lut for x in traits]):
+                        continue
+                    pheno_phase = fpath_lut.name.split('_')[0]
+                    if pheno_phase == 'all':
+                        pheno_phase = 'all_phases'
+                    lut_job = {
+                        'fpath_lut': fpath_lut,
+                        'cost_function': cost_functions[pheno_phase],
+                        'n_solutions': n_solutions[pheno_phase],
+                        'n_seeds': warm_start_seeds.get(
+                            pheno_phase, n_solutions[pheno_phase]),
+                        'measure': aggregation_methods[pheno_phase]
+                    }
+                    lut_job.update(_prepare_lut(
+                        fpath_lut=fpath_lut,
+                        lut_size=lut_sizes[pheno_phase],
+                        lut_dir=lut_dir
+                    ))
+                    scene_luts[pheno_phase] = lut_job
+                if len(scene_luts) == 0:
                     continue
-                lut = pd.read_pickle(fpath_lut)
-                pheno_phase = fpath_lut.name.split('_')[0]
-                if pheno_phase == 'all':
-                    pheno_phase = 'all_phases'
-
-                # draw sub-sample from LUT if required
-                if lut_sizes[pheno_phase] < lut.shape[0]:
-                    lut = lut.sample(lut_sizes[pheno_phase])
-
-                # invert the S2 scene by comparing ProSAIL simulated
-                # to S2 observed spectra
-                s2_lut_spectra = lut[bands].values
-
-                if isinstance(s2_spectra, np.ma.MaskedArray):
-                    mask = s2_spectra.mask[0, :, :]
-                    s2_spectra = s2_spectra.data
+                job = {
+                    'farm': farm,
+                    'scene_dir': scene_dir,
+                    'traits': traits,
+                    'memory_budget': memory_budget,
+                    'backend': backend,
+                    'dedup': dedup,
+                    'multi_phase': multi_phase,
+                    'warm_start': warm_start,
+                    'warm_start_thresholds': warm_start_thresholds,
+                    'n_neighbours': n_neighbours,
+                    'precision': precision,
+                    'cache_dir': cache_dir
+                }
+                if multi_phase:
+                    jobs.append(dict(job, luts=scene_luts))
                 else:
-                    mask = np.zeros(
-                        shape=(
-                            s2_spectra.shape[1], s2_spectra.shape[2]
-                        ),
-                        dtype='uint8')
-                    mask = mask.astype('bool')
-                    mask[s2_spectra[0, :, :] == 0] = True
-
-                lut_idxs, cost_function_values = inv_img(
-                    lut=s2_lut_spectra,
-                    img=s2_spectra,
-                    mask=mask,
-                    cost_function=cost_functions[pheno_phase],
-                    n_solutions=n_solutions[pheno_phase],
-                )
-                trait_img, q05_img, q95_img = retrieve_traits(
-                    lut=lut,
-                    lut_idxs=lut_idxs,
-                    traits=traits,
-                    cost_function_values=cost_function_values,
-                    measure=aggregation_methods[pheno_phase]
-                )
+                    for pheno_phase, lut_job in scene_luts.items():
+                        jobs.append(dict(job, luts={pheno_phase: lut_job}))
+        if len(jobs) == 0:
+            return
 
-                # save traits to file
-                trait_collection = RasterCollection()
-                for tdx, trait in enumerate(traits):
-                    trait_collection.add_band(
-                        Band,
-                        geo_info=s2_ds[bands[0]].geo_info,
-                        band_name=trait,
-                        values=trait_img[tdx, :, :]
-                    )
-                    trait_collection.add_band(
-                        Band,
-                        geo_info=s2_ds[bands[0]].geo_info,
-                        band_name=f'{trait}_q05',
-                        values=q05_img[tdx, :, :]
-                    )
-                    trait_collection.add_band(
-                        Band,
-                        geo_info=s2_ds[bands[0]].geo_info,
-                        band_name=f'{trait}_q95',
-                        values=q95_img[tdx, :, :]
-                    )
-                # save lowest, median and highest cost function value
-                highest_cost_function_vals = cost_function_values[-1, :, :]
-                highest_cost_function_vals[np.isnan(trait_img[0, :, :])] = \
-                    np.nan
-                lowest_cost_function_vals = cost_function_values[0, :, :]
-                lowest_cost_function_vals[np.isnan(trait_img[0, :, :])] = \
-                    np.nan
-                median_cost_function_vals = np.median(
-                    cost_function_values[:, :, :], axis=0)
-                median_cost_function_vals[np.isnan(trait_img[0, :, :])] = \
-                    np.nan
-                trait_collection.add_band(
-                    Band,
-                    geo_info=s2_ds[bands[0]].geo_info,
-                    band_name='lowest_error',
-                    values=lowest_cost_function_vals
-                )
-                trait_collection.add_band(
-                    Band,
-                    geo_info=s2_ds[bands[0]].geo_info,
-                    band_name='highest_error',
-                    values=highest_cost_function_vals
-                )
-                trait_collection.add_band(
-                    Band,
-                    geo_info=s2_ds[bands[0]].geo_info,
-                    band_name='median_error',
-                    values=median_cost_function_vals
-                )
+        # size the pool by cores and memory. A job needs its memory budget,
+        # which covers the cost function matrix of a block of pixels (256
+        # pixels x LUT size x 8 bytes) unless that matrix alone exceeds it
+        per_job_bytes = 0
+        for job in jobs:
+            lut_sizes_job = {
+                k: np.load(v['fpath_npy'], mmap_mode='r').shape[0]
+                for k, v in job['luts'].items()
+            }
+            job_bytes = max(
+                int(memory_budget * 2**20),
+                256 * sum(lut_sizes_job.values()) * 8)
+            if warm_start:
+                rows, cols = _scene_shape(job['scene_dir'])
+                for pheno_phase, lut_job in job['luts'].items():
+                    if pheno_phase not in warm_start_thresholds:
+                        raise ValueError(
+                            'Warm start requires a threshold for ' +
+                            f'{pheno_phase} (see warm_start_thresholds)')
+                    n_candidates = lut_job['n_seeds'] * n_neighbours
+                    if not lut_job['n_seeds'] <= lut_job['n_solutions'] \
+                            <= n_candidates:
+                        raise ValueError(
+                            f'{pheno_phase}: The number of warm start ' +
+                            'seeds must not exceed the number of solutions ' +
+                            'and, times the number of neighbours, reach it')
+                    lut_size = lut_sizes_job[pheno_phase]
+                    if n_candidates > max_warm_start_fraction * lut_size:
+                        raise ValueError(
+                            f'{pheno_phase}: {n_candidates} warm start ' +
+                            'candidates per pixel exceed ' +
+                            f'{max_warm_start_fraction:.0%} of the LUT. ' +
+                            'Reduce the number of solutions, seeds or ' +
+                            'neighbours or invert without warm start')
+                    # seeds of the previous and the current scene, the
+                    # neighbour graph and a tile of a single row of
+                    # candidates (see `rtm_inv.core.streaming.tile_rows`)
+                    job_bytes += 2 * lut_job['n_seeds'] * rows * cols * 4 + \
+                        lut_size * n_neighbours * 12 + \
+                        n_candidates * 3 * 4 * cols
+            per_job_bytes = max(per_job_bytes, job_bytes)
 
-                # save to GeoTiff
-                fname = scene_dir.joinpath(f'{pheno_phase}_lutinv_traits.tiff')
-                trait_collection.to_rasterio(fpath_raster=fname)
+        # when warm starting, the scenes of a farm and phase form a time
+        # series that is inverted in order by a single worker
+        if warm_start:
+            series = {}
+            for job in jobs:
+                series.setdefault((job['farm'], *job['luts']), []).append(job)
+            tasks = [(_invert_series, x, x) for x in series.values()]
+        else:
+            tasks = [(_invert_job, x, [x]) for x in jobs]
+        n_workers = min(_n_workers(per_job_bytes, n_workers), len(tasks))
+        logger.info(
+            f'Inverting {len(jobs)} jobs ({len(tasks)} tasks) on ' +
+            f'{n_workers} workers')
 
-            logger.info(f'{farm}: Finished inversion of {scene_dir.name}')
+        t0 = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {
+                executor.submit(func, arg): task_jobs
+                for func, arg, task_jobs in tasks}
+            for future in as_completed(futures):
+                try:
+                    res = future.result()
+                except Exception as e:
+                    # the worker did not return, so all its scenes failed
+                    for job in futures[future]:
+                        logger.error(
+                            f'{job["farm"]}: Inversion of ' +
+                            f'{job["scene_dir"].name} ' +
+                            f'({", ".join(job["luts"])}) failed: {e}')
+                    continue
+                for res_job in res if isinstance(res, list) else [res]:
+                    if 'error' in res_job:
+                        logger.error(
+                            f'{res_job["farm"]}: Inversion of ' +
+                            f'{res_job["scene"]} ' +
+                            f'({", ".join(res_job["pheno_phases"])}) ' +
+                            f'failed: {res_job["error"]}')
+                        continue
+                    stats = res_job['stats']
+                    msg = f'{res_job["farm"]}: Finished inversion of ' + \
+                        f'{res_job["scene"]} ' + \
+                        f'({", ".join(res_job["pheno_phases"])}) in ' + \
+                        f'{res_job["seconds"]:.1f}s'
+                    if 'dedup_ratio' in stats:
+                        msg += f' (dedup ratio {stats["dedup_ratio"]:.2f})'
+                    if 'cache_hits' in stats:
+                        msg += \
+                            f' (solution cache: {stats["cache_hits"]} ' + \
+                            f'hits, {stats["cache_misses"]} misses)'
+                    if 'fallback_rate' in stats:
+                        msg += \
+                            ' (warm start fallback rate ' + \
+                            f'{stats["fallback_rate"]:.2f})'
+                    logger.info(msg)
+        logger.info(
+            f'Finished {len(jobs)} jobs in {time.perf_counter() - t0:.1f}s')
 
 
 if __name__ == '__main__':
@@ -6,7 +6,6 @@ PROSAIL lookup tables
 '''
 
 import numpy as np
-import pandas as pd
 import warnings
 
 import sys
@@ -20,6 +19,7 @@ from eodal.core.raster import RasterCollection
 from pathlib import Path
 from typing import Dict, List, Optional
 from rtm_inv.core.inversion import inv_img, retrieve_traits
+from rtm_inv.core.lut_io import find_luts, read_lut
 
 logger = get_settings().logger
 warnings.filterwarnings('ignore')
@@ -76,13 +76,13 @@ def invert_scenes(
 
             logger.info(f'{farm}: Started inversion of {scene_dir.name}')
             # find the LUTs generated and use them for inversion
-            for fpath_lut in scene_dir.glob('*lut.pkl'):
+            for fpath_lut in find_luts(scene_dir, '*lut'):
                 # check if the LUT contains the correct traits,
                 # otherwise continue
                 fname_lut = fpath_lut.name
                 if not all([x in fname_lut for x in traits]):
                     continue
-                lut = pd.read_pickle(fpath_lut)
+                lut = read_lut(fpath_lut)
                 pheno_phase = fpath_lut.name.split('_')[0]
                 if pheno_phase == 'all':
                     pheno_phase = 'all_phases'
@@ -15,6 +15,7 @@ import os
 from pathlib import Path
 from typing import Dict, List, Optional
 from rtm_inv.core.inversion import inv_df, retrieve_traits
+from rtm_inv.core.lut_io import read_lut
 from sklearn.metrics import mean_squared_error, mean_absolute_error, r2_score
 import matplotlib.pyplot as plt
 import time
@@ -42,7 +43,8 @@ def invert_scenes(
     :param data_path:
         path to where data to invert is plocated. Should be a .pkl file with a gpd 
     :param lut_paths:
-        list of LUTs to use for inversion
+        list of LUTs to use for inversion (columnar `.lut` directories or
+        legacy pickles)
     :param n_solutions:
         number of solutions of the inversion to use per phenological
         macro-stage
@@ -55,8 +57,8 @@ def invert_scenes(
         Defaults to 'lai', 'cab', and 'ccc'.
     """
 
-    # Load the LUTs
-    lut = pd.concat([pd.read_pickle(path) for path in lut_paths], axis=0, ignore_index=True)
+    # Load the LUTs (columnar or legacy pickled format)
+    lut = pd.concat([read_lut(path) for path in lut_paths], axis=0, ignore_index=True)
     s2_lut = lut[['B02', 'B03', 'B04', 'B05', 'B06', 'B07', 'B8A', 'B11', 'B12']]
 
     # Load the data to invert
@@ -85,9 +87,9 @@ def invert_scenes(
         df_data[f'{trait}_q95'] = q95_img[:, i]
 
     # Save lowest, median and highest cost function value
-    highest_cost_function_vals = [np.max(c) for c in cost_function_values]
-    lowest_cost_function_vals = [np.min(c) for c in cost_function_values]
-    median_cost_function_vals = [np.median(c) for c in cost_function_values]
+    highest_cost_function_vals = np.max(cost_function_values, axis=1)
+    lowest_cost_function_vals = np.min(cost_function_values, axis=1)
+    median_cost_function_vals = np.median(cost_function_values, axis=1)
     df_data['cost_func_max'] = highest_cost_function_vals
     df_data['cost_func_min'] = lowest_cost_function_vals
     df_data['cost_func_median'] = median_cost_function_vals
@@ -141,7 +143,7 @@ if __name__ == '__main__':
 
     data_path = os.path.expanduser('~/mnt/eo-nas1/eoa-share/projects/010_CropCovEO/results/validation_data_extended_angles_shift.pkl')
     lut_dir = os.path.expanduser('~/mnt/eo-nas1/eoa-share/projects/010_CropCovEO/results/lut_based_inversion/soil/')
-    lut_paths = [os.path.join(lut_dir, 'prosail_danner-etal_switzerland_soil_lai-cab-ccc-car_lut_no-constraints_multiplicative1.pkl')] #, os.path.join(lut_dir, 'prosail_danner-etal_switzerland_nosoil_S2B_lai-cab-ccc-car_lut_no-constraints.pkl')]
+    lut_paths = [os.path.join(lut_dir, 'prosail_danner-etal_switzerland_soil_lai-cab-ccc-car_lut_no-constraints_multiplicative1.lut')] #, os.path.join(lut_dir, 'prosail_danner-etal_switzerland_nosoil_S2B_lai-cab-ccc-car_lut_no-constraints.lut')]
 
     cost_functions = 'mae'
     aggregation_methods ='median'
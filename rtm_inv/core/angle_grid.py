@@ -0,0 +1,568 @@
+'''
+Angle-grid lookup-tables (LUTs).
+
+Instead of simulating a LUT for every scene (as the sun-view geometry
+differs between scenes), the ProSAIL spectra of the LUT samples are
+simulated once on a coarse grid of solar zenith (tts), observer zenith
+(tto) and relative azimuth (psi) angles. The LUT of a scene is obtained by
+multilinear interpolation of the spectra between the eight grid nodes
+surrounding the angles of the scene. The leaf optical properties
+(PROSPECT) do not depend on the angles and are simulated once per sample.
+
+    grid = simulate_angle_grid(
+        lut, sensor='Sentinel2A', tts=np.arange(20, 75, 5),
+        tto=np.arange(0, 15, 3), psi=np.arange(0, 210, 30))
+    lut_scene = grid.interpolate(tts=35.2, tto=4.1, psi=112.7)
+    errors = interpolation_error(grid, tts=35.2, tto=4.1, psi=112.7)
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import itertools
+import json
+import numpy as np
+import pandas as pd
+import time
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from rtm_inv.core.lookup_table import LookupTable
+from rtm_inv.core.lut_io import read_lut, write_lut
+from rtm_inv.core.prosail_batch import run_prosail_batch_angles, wavelengths
+from rtm_inv.core.rtm_adapter import ProSAILParameters, _resampling_matrix
+from rtm_inv.core.utils import green_is_valid, transform_lai
+
+# names of the angles spanning the grid (ProSAIL notation)
+angle_names: List[str] = ['tts', 'tto', 'psi']
+# soil spectra passed to ProSAIL
+soil_names: List[str] = ['rsoil0', 'soil_spectrum1', 'soil_spectrum2']
+# file names of the parts of an angle-grid LUT on disk
+meta_fname: str = 'meta.json'
+spectra_fname: str = 'spectra.npy'
+samples_fname: str = 'samples.lut'
+soil_fname: str = 'soil.npz'
+
+
+def relative_azimuth(
+        solar_azimuth_angle: float,
+        viewing_azimuth_angle: float
+) -> float:
+    """
+    Relative azimuth angle between sun and observer as used for LUTs with
+    fixed angles (see `rtm_inv.core.lookup_table.generate_lut`)
+
+    :param solar_azimuth_angle:
+        solar azimuth angle in deg
+    :param viewing_azimuth_angle:
+        viewing azimuth angle in deg
+    :returns:
+        relative azimuth angle in deg
+    """
+    return abs(solar_azimuth_angle - viewing_azimuth_angle)
+
+
+def grid_axis(values: np.ndarray, step: float) -> np.ndarray:
+    """
+    Grid nodes in steps of `step` covering a range of angles (e.g., the
+    angles of the scenes a grid is simulated for)
+
+    :param values:
+        angles to cover in deg
+    :param step:
+        distance between the grid nodes in deg
+    :returns:
+        grid nodes (at least two)
+    """
+    if step <= 0:
+        raise ValueError('Step must be > 0')
+    lower = np.floor(np.min(values) / step) * step
+    upper = max(np.ceil(np.max(values) / step) * step, lower + step)
+    return np.arange(lower, upper + 0.5 * step, step)
+
+
+def _simulate_bands(
+        samples: pd.DataFrame,
+        angles: np.ndarray,
+        out: np.ndarray,
+        matrix: np.ndarray,
+        prospect_version: str,
+        remove_invalid_green_peaks: bool,
+        soil: Dict[str, np.ndarray],
+        batch_size: int
+) -> None:
+    """
+    Simulates the spectral bands of the samples at several sun-view
+    geometries into `out` of shape (n_angles, n_samples, n_bands). Spectra
+    with invalid green peaks are set to NaN (if required).
+    """
+    n_samples = samples.shape[0]
+    for start in range(0, n_samples, batch_size):
+        stop = min(start + batch_size, n_samples)
+        batches = run_prosail_batch_angles(
+            params=samples.iloc[start:stop],
+            angles=angles,
+            prospect_version=prospect_version,
+            **soil
+        )
+        for idx, spectra in enumerate(batches):
+            bands = spectra @ matrix.T
+            if remove_invalid_green_peaks:
+                valid = green_is_valid(wvls=wavelengths, spectrum=spectra)
+                bands[~valid] = np.nan
+            out[idx, start:stop] = bands
+
+
+def _prospect_version(samples: pd.DataFrame) -> str:
+    # same check as `rtm_inv.core.rtm_adapter.RTM`
+    if set(ProSAILParameters.prospect5).issubset(set(samples.columns)):
+        return '5'
+    if set(samples.columns).issubset(ProSAILParameters.prospectD):
+        return 'D'
+    raise ValueError('Cannot determine Prospect Version')
+
+
+class AngleGridLUT(object):
+    """
+    LUT with the spectra of its samples simulated on a grid of angles.
+
+    :attrib samples:
+        LUT samples (RTM parameters) without spectra
+    :attrib axes:
+        grid nodes (increasing) of the angles 'tts', 'tto' and 'psi' in deg
+    :attrib band_names:
+        names of the spectral bands
+    :attrib spectra:
+        simulated spectral bands of shape (n_tts, n_tto, n_psi, n_samples,
+        n_bands). Spectra with invalid green peaks are NaN.
+    :attrib rtm_kwargs:
+        ProSAIL options the spectra were simulated with (sensor, fpath_srf,
+        remove_invalid_green_peaks, soil spectra) and whether to linearize
+        the LAI of the interpolated LUTs (linearize_lai)
+    :attrib metadata:
+        metadata of the LUT samples and the simulation
+    """
+    def __init__(
+            self,
+            samples: pd.DataFrame,
+            axes: Dict[str, np.ndarray],
+            band_names: List[str],
+            spectra: np.ndarray,
+            rtm_kwargs: Dict[str, Any],
+            metadata: Optional[Dict[str, Any]] = None
+    ):
+        """
+        Class constructor
+
+        :param samples:
+            LUT samples (RTM parameters) without spectra
+        :param axes:
+            grid nodes of the angles 'tts', 'tto' and 'psi' in deg
+        :param band_names:
+            names of the spectral bands
+        :param spectra:
+            simulated spectral bands of shape (n_tts, n_tto, n_psi,
+            n_samples, n_bands)
+        :param rtm_kwargs:
+            ProSAIL options the spectra were simulated with
+        :param metadata:
+            optional metadata of the LUT samples and the simulation
+        """
+        axes = {
+            name: np.asarray(axes[name], dtype='float64')
+            for name in angle_names
+        }
+        for name, axis in axes.items():
+            if axis.ndim != 1 or axis.size < 2:
+                raise ValueError(f'{name} grid must have >= 2 nodes')
+            if not (np.diff(axis) > 0).all():
+                raise ValueError(f'{name} grid must be increasing')
+        shape = tuple(axes[name].size for name in angle_names) + \
+            (samples.shape[0], len(band_names))
+        if spectra.shape != shape:
+            raise ValueError(
+                f'Expected spectra of shape {shape}, got {spectra.shape}')
+        self.samples = samples
+        self.axes = axes
+        self.band_names = list(band_names)
+        self.spectra = spectra
+        self.rtm_kwargs = rtm_kwargs
+        self.metadata = dict(metadata or {})
+
+    def _cell(self, name: str, value: float) -> Tuple[int, float]:
+        """
+        Grid cell (index of the lower node) and interpolation weight of the
+        upper node of an angle
+        """
+        axis = self.axes[name]
+        if not axis[0] <= value <= axis[-1]:
+            raise ValueError(
+                f'{name} of {value} deg is outside the angle grid ' +
+                f'({axis[0]} to {axis[-1]} deg)')
+        idx = min(np.searchsorted(axis, value, side='right') - 1,
+                  axis.size - 2)
+        return idx, (value - axis[idx]) / (axis[idx + 1] - axis[idx])
+
+    def interpolate_bands(
+            self,
+            tts: float,
+            tto: float,
+            psi: float
+    ) -> np.ndarray:
+        """
+        Spectral bands of the LUT samples at a sun-view geometry by
+        multilinear interpolation between the surrounding grid nodes
+
+        :param tts:
+            solar zenith angle in deg
+        :param tto:
+            observer zenith angle in deg
+        :param psi:
+            relative azimuth angle in deg
+        :returns:
+            band matrix of shape (n_samples, n_bands). Samples with invalid
+            green peaks at any of the nodes used are NaN.
+        """
+        cells = [
+            self._cell(name, value)
+            for name, value in zip(angle_names, [tts, tto, psi])
+        ]
+        out = np.zeros(self.spectra.shape[3:], dtype=self.spectra.dtype)
+        for corner in itertools.product([0, 1], repeat=len(cells)):
+            weight = 1.
+            for upper, (_, w) in zip(corner, cells):
+                weight *= w if upper else 1. - w
+            # nodes without weight are skipped (NaN * 0 would be NaN)
+            if weight == 0:
+                continue
+            node = tuple(idx + upper for upper, (idx, _) in zip(corner, cells))
+            out += weight * self.spectra[node]
+        return out
+
+    def interpolate(
+            self,
+            tts: float,
+            tto: float,
+            psi: float
+    ) -> pd.DataFrame:
+        """
+        LUT of a sun-view geometry (see `interpolate_bands`) in the same
+        format as returned by `rtm_inv.core.lookup_table.simulate_from_lut`
+
+        :param tts:
+            solar zenith angle in deg
+        :param tto:
+            observer zenith angle in deg
+        :param psi:
+            relative azimuth angle in deg
+        :returns:
+            LUT samples with interpolated spectra as `DataFrame`
+        """
+        lut = self.samples.copy()
+        for name, value in zip(angle_names, [tts, tto, psi]):
+            lut[name] = value
+        bands = pd.DataFrame(
+            self.interpolate_bands(tts=tts, tto=tto, psi=psi),
+            columns=self.band_names, index=lut.index)
+        lut = pd.concat([lut, bands], axis=1)
+        lut.attrs['lut_metadata'] = dict(
+            self.metadata, angle_grid=True, tts=tts, tto=tto, psi=psi)
+        # linearize LAI as in `simulate_from_lut`
+        if self.rtm_kwargs.get('linearize_lai', False):
+            lut['lai'] = transform_lai(lut['lai'], inverse=False)
+        return lut
+
+
+def simulate_angle_grid(
+        lut: LookupTable,
+        sensor: str,
+        tts: np.ndarray,
+        tto: np.ndarray,
+        psi: np.ndarray,
+        fpath_srf: Optional[Path] = None,
+        remove_invalid_green_peaks: Optional[bool] = False,
+        rsoil0: Optional[np.ndarray] = None,
+        soil_spectrum1: Optional[np.ndarray] = None,
+        soil_spectrum2: Optional[np.ndarray] = None,
+        linearize_lai: Optional[bool] = False,
+        batch_size: Optional[int] = 500
+) -> AngleGridLUT:
+    """
+    Simulates the ProSAIL spectra of LUT samples at every node of an angle
+    grid. The angles of the samples are ignored.
+
+    The grid needs n_samples * n_bands * 4 bytes per node (e.g., 1.8 MB
+    for 50000 samples and 9 bands).
+
+    :param lut:
+        LUT with samples (see `rtm_inv.core.lookup_table.generate_lut`)
+    :param sensor:
+        name of the sensor for which to simulate the spectra
+    :param tts:
+        grid nodes of the solar zenith angle in deg
+    :param tto:
+        grid nodes of the observer zenith angle in deg
+    :param psi:
+        grid nodes of the relative azimuth angle in deg
+    :param fpath_srf:
+        optional path to file with spectral response functions of the
+        spectral bands of the sensor (see `simulate_from_lut`)
+    :param remove_invalid_green_peaks:
+        set simulated spectra with unrealistic green peaks to NaN (see
+        `simulate_from_lut`)
+    :param rsoil0:
+        soil spectrum (see `simulate_from_lut`)
+    :param soil_spectrum1:
+        dry soil spectrum (see `simulate_from_lut`)
+    :param soil_spectrum2:
+        wet soil spectrum (see `simulate_from_lut`)
+    :param linearize_lai:
+        if True, the LAI values of the interpolated LUTs are linearized
+        (see `simulate_from_lut`). The spectra are simulated with the
+        original LAI values.
+    :param batch_size:
+        number of samples simulated at once
+    :returns:
+        ``AngleGridLUT`` with the simulated spectra
+    """
+    if batch_size <= 0:
+        raise ValueError('Batch size must be > 0')
+    if lut.samples is None or lut.samples.empty:
+        raise ValueError('LUT must not be empty')
+    samples = lut.samples.reset_index(drop=True)
+    samples = samples[[x for x in samples.columns if not x.startswith('B')]]
+    axes = {'tts': tts, 'tto': tto, 'psi': psi}
+    soil = {
+        'rsoil0': rsoil0,
+        'soil_spectrum1': soil_spectrum1,
+        'soil_spectrum2': soil_spectrum2
+    }
+    band_names, matrix = _resampling_matrix(
+        sensor=sensor, fpath_srf=fpath_srf)
+    nodes = np.array(list(itertools.product(
+        *[np.asarray(axes[name], dtype='float64') for name in angle_names])))
+    shape = tuple(np.size(axes[name]) for name in angle_names)
+    spectra = np.empty(
+        (nodes.shape[0], samples.shape[0], len(band_names)), dtype='float32')
+
+    t0 = time.perf_counter()
+    _simulate_bands(
+        samples=samples,
+        angles=nodes,
+        out=spectra,
+        matrix=matrix,
+        prospect_version=_prospect_version(samples),
+        remove_invalid_green_peaks=remove_invalid_green_peaks,
+        soil=soil,
+        batch_size=batch_size
+    )
+    seconds = time.perf_counter() - t0
+    print(
+        f'Simulated {samples.shape[0]} samples at {nodes.shape[0]} angle ' +
+        f'grid nodes in {seconds:.1f}s ' +
+        f'({spectra.shape[0] * spectra.shape[1] / seconds:.1f} spectra/s)')
+
+    metadata = dict(lut.samples.attrs.get('lut_metadata', {}))
+    metadata.update({
+        'rtm_name': 'prosail',
+        'sensor': sensor,
+        'fpath_srf': None if fpath_srf is None else str(fpath_srf),
+        'remove_invalid_green_peaks': remove_invalid_green_peaks,
+        'linearize_lai': linearize_lai
+    })
+    return AngleGridLUT(
+        samples=samples,
+        axes=axes,
+        band_names=band_names,
+        spectra=spectra.reshape(shape + spectra.shape[1:]),
+        rtm_kwargs=dict(
+            soil,
+            sensor=sensor,
+            fpath_srf=fpath_srf,
+            remove_invalid_green_peaks=remove_invalid_green_peaks,
+            linearize_lai=linearize_lai
+        ),
+        metadata=metadata
+    )
+
+
+def interpolation_error(
+        grid: AngleGridLUT,
+        tts: float,
+        tto: float,
+        psi: float,
+        n_samples: Optional[int] = 500,
+        seed: Optional[int] = 0,
+        batch_size: Optional[int] = 500
+) -> Dict[str, Any]:
+    """
+    Error of the interpolated spectra of a sun-view geometry versus
+    spectra simulated directly at this geometry for a random subset of
+    the LUT samples
+
+    :param grid:
+        ``AngleGridLUT`` to evaluate
+    :param tts:
+        solar zenith angle in deg
+    :param tto:
+        observer zenith angle in deg
+    :param psi:
+        relative azimuth angle in deg
+    :param n_samples:
+        number of LUT samples simulated directly
+    :param seed:
+        seed for drawing the LUT samples
+    :param batch_size:
+        number of samples simulated at once
+    :returns:
+        number of samples compared, root mean squared error (overall and
+        per band), mean and maximum absolute error in reflectance units
+        and the RMSE relative to the mean reflectance. Samples that are NaN
+        in either spectrum are not compared.
+    """
+    n_lut = grid.samples.shape[0]
+    rng = np.random.default_rng(seed)
+    idx = np.sort(rng.choice(n_lut, size=min(n_samples, n_lut),
+                             replace=False))
+    rtm_kwargs = dict(grid.rtm_kwargs)
+    _, matrix = _resampling_matrix(
+        sensor=rtm_kwargs['sensor'], fpath_srf=rtm_kwargs['fpath_srf'])
+    direct = np.empty((1, idx.size, len(grid.band_names)), dtype='float64')
+    samples = grid.samples.iloc[idx]
+    _simulate_bands(
+        samples=samples,
+        angles=np.array([[tts, tto, psi]]),
+        out=direct,
+        matrix=matrix,
+        prospect_version=_prospect_version(samples),
+        remove_invalid_green_peaks=rtm_kwargs[
+            'remove_invalid_green_peaks'],
+        soil={name: rtm_kwargs[name] for name in soil_names},
+        batch_size=batch_size
+    )
+    direct = direct[0]
+    interpolated = grid.interpolate_bands(tts=tts, tto=tto, psi=psi)[idx]
+    valid = ~(np.isnan(direct).any(axis=1) |
+              np.isnan(interpolated).any(axis=1))
+    diff = interpolated[valid] - direct[valid]
+    rmse_bands = np.sqrt(np.mean(diff**2, axis=0))
+    rmse = float(np.sqrt(np.mean(diff**2)))
+    return {
+        'n_samples': int(valid.sum()),
+        'rmse': rmse,
+        'rmse_bands': dict(zip(grid.band_names, rmse_bands.tolist())),
+        'mean_abs_error': float(np.mean(np.abs(diff))),
+        'max_abs_error': float(np.max(np.abs(diff))),
+        'relative_rmse': rmse / float(np.mean(direct[valid]))
+    }
+
+
+def write_angle_grid(
+        grid: AngleGridLUT,
+        fpath_grid: Path,
+        metadata: Optional[Dict[str, Any]] = None,
+        overwrite: Optional[bool] = False
+) -> Path:
+    """
+    Writes an angle-grid LUT to a directory holding the samples (columnar
+    LUT format), the spectra (`.npy`), the soil spectra and a `meta.json`
+    file with the grid, band names, ProSAIL options and metadata
+
+    :param grid:
+        ``AngleGridLUT`` to write
+    :param fpath_grid:
+        directory where to write the angle-grid LUT to
+    :param metadata:
+        metadata to store with the grid in addition to `grid.metadata`
+        (e.g., a hash of the configuration the grid was simulated with)
+    :param overwrite:
+        if False (default), writing to an existing directory raises an
+        error
+    :returns:
+        path of the directory
+    """
+    fpath_grid = Path(fpath_grid)
+    if fpath_grid.exists() and not overwrite:
+        raise ValueError(f'{fpath_grid} already exists')
+    fpath_grid.mkdir(parents=True, exist_ok=True)
+    # an overwritten grid is incomplete until the metadata is written again
+    fpath_grid.joinpath(meta_fname).unlink(missing_ok=True)
+    grid_metadata = dict(grid.metadata, **(metadata or {}))
+    write_lut(
+        grid.samples, fpath_grid.joinpath(samples_fname),
+        metadata=grid_metadata, overwrite=True)
+    np.save(fpath_grid.joinpath(spectra_fname), grid.spectra)
+    soil = {
+        name: np.asarray(grid.rtm_kwargs[name]) for name in soil_names
+        if grid.rtm_kwargs[name] is not None
+    }
+    np.savez(fpath_grid.joinpath(soil_fname), **soil)
+    rtm_kwargs = {
+        k: v for k, v in grid.rtm_kwargs.items() if k not in soil_names}
+    if rtm_kwargs['fpath_srf'] is not None:
+        rtm_kwargs['fpath_srf'] = str(rtm_kwargs['fpath_srf'])
+    meta = {
+        'axes': {k: v.tolist() for k, v in grid.axes.items()},
+        'band_names': grid.band_names,
+        'rtm_kwargs': rtm_kwargs,
+        'metadata': grid_metadata
+    }
+    # the metadata is written last and marks a complete angle-grid LUT
+    with open(fpath_grid.joinpath(meta_fname), 'w+') as dst:
+        json.dump(meta, dst, indent=2, default=str)
+    return fpath_grid
+
+
+def is_angle_grid(fpath_grid: Path) -> bool:
+    """
+    Checks if a path is a complete angle-grid LUT
+    """
+    return Path(fpath_grid).joinpath(meta_fname).exists()
+
+
+def read_angle_grid(fpath_grid: Path) -> AngleGridLUT:
+    """
+    Reads an angle-grid LUT written by `write_angle_grid`. The spectra are
+    memory-mapped read-only.
+
+    :param fpath_grid:
+        directory with the angle-grid LUT
+    :returns:
+        ``AngleGridLUT``
+    """
+    fpath_grid = Path(fpath_grid)
+    if not is_angle_grid(fpath_grid):
+        raise FileNotFoundError(f'No angle-grid LUT found in {fpath_grid}')
+    with open(fpath_grid.joinpath(meta_fname), 'r') as src:
+        meta = json.load(src)
+    rtm_kwargs = meta['rtm_kwargs']
+    if rtm_kwargs['fpath_srf'] is not None:
+        rtm_kwargs['fpath_srf'] = Path(rtm_kwargs['fpath_srf'])
+    with np.load(fpath_grid.joinpath(soil_fname)) as soil:
+        for name in soil_names:
+            rtm_kwargs[name] = soil[name] if name in soil.files else None
+    samples = read_lut(fpath_grid.joinpath(samples_fname))
+    samples.attrs = {}
+    return AngleGridLUT(
+        samples=samples,
+        axes=meta['axes'],
+        band_names=meta['band_names'],
+        spectra=np.load(fpath_grid.joinpath(spectra_fname), mmap_mode='r'),
+        rtm_kwargs=rtm_kwargs,
+        metadata=meta['metadata']
+    )
@@ -0,0 +1,381 @@
+'''
+Registry of the cost functions used to compare observed and simulated
+spectra in the lookup-table (LUT) inversion.
+
+Every cost function declares the terms that depend on the LUT only (e.g.,
+squared norms or logarithms of the LUT spectra). These are computed once
+per LUT instead of once per block of pixels. The blocked kernel evaluates
+the cost function between a block of observed spectra and all LUT spectra
+at once; the candidate kernel evaluates it on a different subset of LUT
+spectra per observed spectrum (used when re-ranking candidates).
+
+New cost functions are made available to all inversion functions with
+`register_cost_function`, e.g.
+
+    register_cost_function(band_weighted_rmse(weights=[1, 1, 2, 2, 1]))
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import numpy as np
+
+from typing import Any, Callable, Dict, List, Optional
+
+
+class CostFunction(object):
+    """
+    Cost function with its kernels.
+
+    :attrib name:
+        name under which the cost function is registered
+    :attrib precompute:
+        callable taking the LUT spectra (num_spectra, num_bands) and
+        returning a dictionary with the terms of the cost function that
+        depend on the LUT only
+    :attrib block:
+        callable taking the LUT spectra, the precomputed LUT terms and a
+        block of observed spectra (num_pixels, num_bands) and returning the
+        cost function values of shape (num_pixels, num_spectra)
+    :attrib candidates:
+        callable taking the LUT spectra, the LUT indices to evaluate per
+        observed spectrum (num_pixels, num_candidates) and the observed
+        spectra and returning the cost function values of shape
+        (num_pixels, num_candidates)
+    :attrib minimize:
+        if True (default), the best solutions have the smallest cost
+        function values, otherwise the largest
+    :attrib minkowski_p:
+        if the cost function is a strictly increasing function of the
+        Minkowski distance with this p-norm, spatial indices over the LUT
+        can be used for the search. None otherwise.
+    :attrib from_distance:
+        callable converting Minkowski distances and the number of bands
+        into cost function values (required if `minkowski_p` is set)
+    :attrib to_distance:
+        inverse of `from_distance`
+    :attrib params:
+        parameters the kernels depend on (e.g., band weights). Cost
+        functions sharing a name but differing in their parameters give
+        different solutions (see `rtm_inv.core.result_cache.SolutionCache`).
+    """
+    def __init__(
+            self,
+            name: str,
+            precompute: Callable[[np.ndarray], Dict[str, np.ndarray]],
+            block: Callable[..., np.ndarray],
+            candidates: Callable[..., np.ndarray],
+            minimize: Optional[bool] = True,
+            minkowski_p: Optional[int] = None,
+            from_distance: Optional[Callable[..., np.ndarray]] = None,
+            to_distance: Optional[Callable[..., np.ndarray]] = None,
+            params: Optional[Dict[str, Any]] = None
+    ):
+        if minkowski_p is not None and \
+                (from_distance is None or to_distance is None):
+            raise ValueError(
+                'Cost functions based on Minkowski distances require ' +
+                'conversions from and to distances')
+        self.name = name
+        self.precompute = precompute
+        self.block = block
+        self.candidates = candidates
+        self.minimize = minimize
+        self.minkowski_p = minkowski_p
+        self.from_distance = from_distance
+        self.to_distance = to_distance
+        self.params = params
+
+    def __repr__(self) -> str:
+        return f'CostFunction({self.name})'
+
+
+# registered cost functions by name
+registry: Dict[str, CostFunction] = {}
+
+
+def register_cost_function(
+        cost_function: CostFunction,
+        overwrite: Optional[bool] = False
+) -> None:
+    """
+    Makes a cost function available to the inversion functions
+
+    :param cost_function:
+        ``CostFunction`` to register under its name
+    :param overwrite:
+        if False (default), registering a name twice raises an error
+    """
+    if cost_function.name in registry and not overwrite:
+        raise ValueError(
+            f'Cost function {cost_function.name} is already registered')
+    registry[cost_function.name] = cost_function
+
+
+def get_cost_function(name: str | CostFunction) -> CostFunction:
+    """
+    Looks up a registered cost function
+
+    :param name:
+        name of the cost function. ``CostFunction`` instances are returned
+        as they are.
+    :returns:
+        ``CostFunction`` instance
+    """
+    if isinstance(name, CostFunction):
+        return name
+    if name not in registry:
+        raise ValueError(f'Cost function {name} is not available')
+    return registry[name]
+
+
+def available_cost_functions() -> List[str]:
+    """
+    Names of the registered cost functions
+    """
+    return list(registry.keys())
+
+
+def _sq_norms(lut: np.ndarray) -> Dict[str, Any]:
+    return {'sq_norms': np.einsum('ij,ij->i', lut, lut)}
+
+
+def _no_terms(lut: np.ndarray) -> Dict[str, Any]:
+    return {}
+
+
+def _ssd_block(
+        lut: np.ndarray,
+        terms: Dict[str, Any],
+        pixels: np.ndarray
+) -> np.ndarray:
+    # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab, where the cross-term is a
+    # single matrix product (BLAS)
+    delta = pixels @ lut.T
+    delta *= -2.
+    delta += terms['sq_norms'][np.newaxis, :]
+    delta += np.einsum('ij,ij->i', pixels, pixels)[:, np.newaxis]
+    # the expansion may result in tiny negative values due to
+    # floating point cancellation
+    np.maximum(delta, 0., out=delta)
+    return delta
+
+
+def _ssd_candidates(
+        lut: np.ndarray,
+        candidates: np.ndarray,
+        pixels: np.ndarray
+) -> np.ndarray:
+    diff = lut[candidates, :] - pixels[:, np.newaxis, :]
+    return np.einsum('ijk,ijk->ij', diff, diff)
+
+
+def _rmse_block(
+        lut: np.ndarray,
+        terms: Dict[str, Any],
+        pixels: np.ndarray
+) -> np.ndarray:
+    delta = _ssd_block(lut, terms, pixels)
+    delta /= lut.shape[1]
+    return np.sqrt(delta, out=delta)
+
+
+def _rmse_candidates(
+        lut: np.ndarray,
+        candidates: np.ndarray,
+        pixels: np.ndarray
+) -> np.ndarray:
+    delta = _ssd_candidates(lut, candidates, pixels)
+    delta /= lut.shape[1]
+    return np.sqrt(delta, out=delta)
+
+
+def _mae_block(
+        lut: np.ndarray,
+        terms: Dict[str, Any],
+        pixels: np.ndarray
+) -> np.ndarray:
+    # broadcast band by band to keep the memory footprint at
+    # (num_pixels, num_spectra)
+    delta = np.zeros((pixels.shape[0], lut.shape[0]), dtype='float64')
+    for band in range(lut.shape[1]):
+        delta += np.abs(pixels[:, band, np.newaxis] - lut[np.newaxis, :, band])
+    return delta
+
+
+def _mae_candidates(
+        lut: np.ndarray,
+        candidates: np.ndarray,
+        pixels: np.ndarray
+) -> np.ndarray:
+    return np.abs(lut[candidates, :] - pixels[:, np.newaxis, :]).sum(axis=2)
+
+
+def _contrast_terms(lut: np.ndarray) -> Dict[str, Any]:
+    return {'log_sums': np.log10(lut).sum(axis=1)}
+
+
+def _contrast_block(
+        lut: np.ndarray,
+        terms: Dict[str, Any],
+        pixels: np.ndarray
+) -> np.ndarray:
+    # sum_b r_b - log10(r_b) with r_b = lut_b / pixel_b splits into
+    # lut @ (1 / pixel) minus the sum of log10(lut) (precomputed) plus the
+    # sum of log10(pixel)
+    delta = (1. / pixels) @ lut.T
+    delta -= terms['log_sums'][np.newaxis, :]
+    delta += np.log10(pixels).sum(axis=1)[:, np.newaxis]
+    return delta
+
+
+def _contrast_candidates(
+        lut: np.ndarray,
+        candidates: np.ndarray,
+        pixels: np.ndarray
+) -> np.ndarray:
+    ratio = lut[candidates, :] / pixels[:, np.newaxis, :]
+    return (ratio - np.log10(ratio)).sum(axis=2)
+
+
+def _spectral_angle_terms(lut: np.ndarray) -> Dict[str, Any]:
+    return {'norms': np.sqrt(np.einsum('ij,ij->i', lut, lut))}
+
+
+def _spectral_angle_block(
+        lut: np.ndarray,
+        terms: Dict[str, Any],
+        pixels: np.ndarray
+) -> np.ndarray:
+    delta = pixels @ lut.T
+    delta /= terms['norms'][np.newaxis, :]
+    delta /= np.sqrt(np.einsum('ij,ij->i', pixels, pixels))[:, np.newaxis]
+    np.clip(delta, -1., 1., out=delta)
+    return np.arccos(delta, out=delta)
+
+
+def _spectral_angle_candidates(
+        lut: np.ndarray,
+        candidates: np.ndarray,
+        pixels: np.ndarray
+) -> np.ndarray:
+    spectra = lut[candidates, :]
+    cos = np.einsum('ijk,ik->ij', spectra, pixels)
+    cos /= np.sqrt(np.einsum('ijk,ijk->ij', spectra, spectra))
+    cos /= np.sqrt(np.einsum('ij,ij->i', pixels, pixels))[:, np.newaxis]
+    np.clip(cos, -1., 1., out=cos)
+    return np.arccos(cos, out=cos)
+
+
+def band_weighted_rmse(
+        weights: np.ndarray,
+        name: Optional[str] = 'band_weighted_rmse'
+) -> CostFunction:
+    """
+    Root mean squared error with a weight per spectral band, i.e.
+    sqrt(sum_b w_b * (lut_b - pixel_b)^2 / sum_b w_b)
+
+    :param weights:
+        non-negative weight per spectral band
+    :param name:
+        name under which to register the cost function
+    :returns:
+        ``CostFunction`` instance (to be passed to `register_cost_function`)
+    """
+    weights = np.asarray(weights, dtype='float64')
+    if weights.ndim != 1 or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError('Band weights must be a non-negative 1-d array')
+    sqrt_weights = np.sqrt(weights / weights.sum())
+
+    def _terms(lut: np.ndarray) -> Dict[str, Any]:
+        if lut.shape[1] != weights.size:
+            raise ValueError(
+                f'Got {weights.size} band weights for {lut.shape[1]} bands')
+        lut_weighted = lut * sqrt_weights[np.newaxis, :]
+        return {
+            'lut': lut_weighted,
+            'sq_norms': np.einsum('ij,ij->i', lut_weighted, lut_weighted)
+        }
+
+    def _block(
+            lut: np.ndarray,
+            terms: Dict[str, Any],
+            pixels: np.ndarray
+    ) -> np.ndarray:
+        delta = _ssd_block(
+            terms['lut'], terms, pixels * sqrt_weights[np.newaxis, :])
+        return np.sqrt(delta, out=delta)
+
+    def _candidates(
+            lut: np.ndarray,
+            candidates: np.ndarray,
+            pixels: np.ndarray
+    ) -> np.ndarray:
+        diff = lut[candidates, :] - pixels[:, np.newaxis, :]
+        diff *= sqrt_weights
+        delta = np.einsum('ijk,ijk->ij', diff, diff)
+        return np.sqrt(delta, out=delta)
+
+    return CostFunction(
+        name=name,
+        precompute=_terms,
+        block=_block,
+        candidates=_candidates,
+        params={'weights': weights}
+    )
+
+
+# built-in cost functions
+register_cost_function(CostFunction(
+    name='rmse',
+    precompute=_sq_norms,
+    block=_rmse_block,
+    candidates=_rmse_candidates,
+    minkowski_p=2,
+    from_distance=lambda dist, n_bands: dist / np.sqrt(n_bands),
+    to_distance=lambda vals, n_bands: vals * np.sqrt(n_bands)
+))
+register_cost_function(CostFunction(
+    name='mae',
+    precompute=_no_terms,
+    block=_mae_block,
+    candidates=_mae_candidates,
+    minkowski_p=1,
+    from_distance=lambda dist, n_bands: dist,
+    to_distance=lambda vals, n_bands: vals
+))
+register_cost_function(CostFunction(
+    name='contrast_function',
+    precompute=_contrast_terms,
+    block=_contrast_block,
+    candidates=_contrast_candidates
+))
+register_cost_function(CostFunction(
+    name='squared_sum_of_differences',
+    precompute=_sq_norms,
+    block=_ssd_block,
+    candidates=_ssd_candidates,
+    minkowski_p=2,
+    from_distance=lambda dist, n_bands: dist**2,
+    to_distance=lambda vals, n_bands: np.sqrt(vals)
+))
+register_cost_function(CostFunction(
+    name='spectral_angle',
+    precompute=_spectral_angle_terms,
+    block=_spectral_angle_block,
+    candidates=_spectral_angle_candidates
+))
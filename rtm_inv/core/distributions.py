@@ -100,3 +100,34 @@ class Distributions(object):
                 (self.max_value - self.mean_value) / self.std_value
             X = truncnorm(a, b, loc=self.mean_value, scale=self.std_value)
             return X.rvs(n_samples)
+
+    def ppf(
+            self,
+            distribution: str,
+            quantiles: np.ndarray
+    ) -> np.ndarray:
+        """
+        Returns the RTM parameter values at given quantiles of a specific
+        distribution (inverse cumulative distribution function). Maps
+        samples of the unit interval (e.g., Latin Hypercube samples) to
+        parameter values.
+
+        :param distribution:
+            name of the distribution. See
+            `~core.distributions.Distributions.distributions` for a list
+            of distributions currently implemented
+        :param quantiles:
+            quantiles between 0 and 1
+        :returns:
+            ``numpy.ndarray`` with RTM parameter values.
+        """
+        if distribution == 'Uniform':
+            return self.min_value + quantiles * \
+                (self.max_value - self.min_value)
+        elif distribution == 'Gaussian':
+            a, b = (self.min_value - self.mean_value) / self.std_value, \
+                (self.max_value - self.mean_value) / self.std_value
+            X = truncnorm(a, b, loc=self.mean_value, scale=self.std_value)
+            return X.ppf(quantiles)
+        else:
+            raise NotImplementedError(f'{distribution} not found')
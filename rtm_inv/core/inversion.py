@@ -1,7 +1,8 @@
 '''
 Actual inversion strategy using a pre-computed Lookup-Table (LUT)
 and an image matrix of remotely sensed spectra.
-Makes use of `numba` to speed up Python code.
+Cost functions are evaluated for blocks of pixels against the whole
+LUT at once using vectorized `numpy` (BLAS) operations.
 
 Copyright (C) 2022 Lukas Valentin Graf
 
@@ -19,21 +20,520 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 '''
 
+from __future__ import annotations
+
 import numpy as np
+import os
 import pandas as pd
 
-from numba import njit, prange
-from typing import List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
+from rtm_inv.core.cost_functions import CostFunction, get_cost_function
+from rtm_inv.core.lut_index import LUTIndex, LUTProjection
+from rtm_inv.core.lut_store import ShardedLUT
+from rtm_inv.core.precision import (
+    get_precision_policy, is_no_solution, no_solution, signed_indices)
 
-@njit(parallel=True, cache=True)
-def inv_img(
+# search backends currently implemented
+backends: List[str] = ['brute', 'kdtree', 'pca']
+# LUT data structures used by the search backends (built on the fly if not
+# passed)
+backend_indices: Dict[str, type] = {
+    'kdtree': LUTIndex,
+    'pca': LUTProjection
+}
+
+
+def _top_k(
+        delta: np.ndarray,
+        n_solutions: int,
+        minimize: Optional[bool] = True
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Finds the `n_solutions` best cost function values per row of
+    `delta` using a partial sort (only the *k* winners get sorted)
+
+    :param delta:
+        cost function values of shape (num_pixels, num_spectra)
+    :param n_solutions:
+        number of best solutions to return
+    :param minimize:
+        if True (default) the smallest values are the best, otherwise the
+        largest
+    :returns:
+        tuple with LUT indices and cost function values of the best
+        solutions (best first), each of shape (num_pixels, n_solutions)
+    """
+    if not minimize:
+        idxs, vals = _top_k(-delta, n_solutions)
+        return idxs, -vals
+    if n_solutions < delta.shape[1]:
+        candidates = np.argpartition(
+            delta, n_solutions - 1, axis=1)[:, :n_solutions]
+    else:
+        candidates = np.broadcast_to(
+            np.arange(delta.shape[1]), delta.shape)
+    candidate_vals = np.take_along_axis(delta, candidates, axis=1)
+    order = np.argsort(candidate_vals, axis=1)
+    idxs = np.take_along_axis(candidates, order, axis=1)
+    vals = np.take_along_axis(candidate_vals, order, axis=1)
+    return idxs, vals
+
+
+def _inv_pixels_pca(
+        lut: np.ndarray,
+        pixels: np.ndarray,
+        cost_function: CostFunction,
+        n_solutions: int,
+        block_size: int,
+        projection: LUTProjection,
+        stats: Optional[Dict[str, Any]] = None,
+        n_jobs: Optional[int] = -1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Two-stage inversion: an over-sized candidate set is searched in the
+    reduced space of the LUT's principal components and re-ranked using the
+    exact cost function on full spectra.
+
+    The squared Euclidean distance in the reduced space is a lower bound of
+    the squared Euclidean distance between full spectra. If the worst of
+    the best solutions found among the candidates is better than the bound
+    of the closest LUT spectrum not selected as candidate, no other LUT
+    spectrum can enter the best solutions. For pixels where this does not
+    hold the candidate set is enlarged until it does, so the solutions are
+    exact.
+
+    :param lut:
+        LUT spectra of shape (num_spectra, num_bands) as float64
+    :param pixels:
+        observed spectra of shape (num_pixels, num_bands) as float64
+    :param cost_function:
+        cost function based on the Euclidean distance (i.e., with a
+        `minkowski_p` of 2 such as 'rmse' and 'squared_sum_of_differences')
+    :param n_solutions:
+        number of best solutions to return
+    :param block_size:
+        number of pixels to evaluate at once
+    :param projection:
+        ``LUTProjection`` fitted on `lut`
+    :param stats:
+        optional dictionary to which the number of pixels that required
+        an enlarged candidate set is written ('n_fallback')
+    :param n_jobs:
+        number of workers querying the candidates. -1 (default) uses all
+        cores.
+    :returns:
+        tuple with LUT indices (int32) and cost function values (float32)
+        of the `n_solutions` best solutions, each of shape
+        (num_pixels, n_solutions)
+    """
+    n_pixels = pixels.shape[0]
+    lut_idxs = np.empty((n_pixels, n_solutions), dtype='int32')
+    cost_function_values = np.empty((n_pixels, n_solutions), dtype='float32')
+    n_fallback = 0
+    for start in range(0, n_pixels, block_size):
+        # block-relative indices of the pixels not solved yet
+        pending = np.arange(min(block_size, n_pixels - start))
+        n_candidates = int(np.ceil(projection.oversampling * n_solutions))
+        first_pass = True
+        while pending.size > 0:
+            block = pixels[start + pending, :]
+            candidates, bound = projection.query_candidates(
+                pixels=block,
+                n_candidates=n_candidates,
+                n_jobs=n_jobs
+            )
+            delta = cost_function.candidates(lut, candidates, block)
+            order, vals = _top_k(delta, n_solutions)
+            # express the worst solution as squared Euclidean distance and
+            # keep a margin for rounding errors
+            worst = cost_function.to_distance(vals[:, -1], lut.shape[1])**2
+            solved = worst < bound * (1. - 1e-9) - 1e-12
+            lut_idxs[start + pending[solved], :] = np.take_along_axis(
+                candidates[solved], order[solved], axis=1)
+            cost_function_values[start + pending[solved], :] = vals[solved]
+            pending = pending[~solved]
+            if first_pass:
+                n_fallback += pending.size
+                first_pass = False
+            n_candidates *= 4
+    if stats is not None:
+        stats['n_fallback'] = n_fallback
+    return lut_idxs, cost_function_values
+
+
+def _inv_pixels_sharded(
+        store: ShardedLUT,
+        pixels: np.ndarray,
+        cost_function: CostFunction,
+        n_solutions: int,
+        block_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Out-of-core inversion against a sharded LUT. Shards are read one after
+    the other and the best solutions of every shard are merged into a
+    running top-k per pixel. LUT indices are global (i.e., across shards).
+    Peak memory is bounded by the size of a shard and the
+    `(num_pixels, n_solutions)` buffers.
+
+    :param store:
+        ``ShardedLUT`` to search
+    :param pixels:
+        observed spectra of shape (num_pixels, num_bands)
+    :param cost_function:
+        ``CostFunction`` to evaluate
+    :param n_solutions:
+        number of best solutions to return
+    :param block_size:
+        number of pixels to evaluate at once
+    :returns:
+        tuple with global LUT indices (int32) and cost function values
+        (float32) of the `n_solutions` best solutions, each of shape
+        (num_pixels, n_solutions)
+    """
+    pixels = np.ascontiguousarray(pixels, dtype='float64')
+    n_pixels = pixels.shape[0]
+    # running top-k (kept in float64 so that merging does not change the
+    # ranking compared to searching the whole LUT at once)
+    lut_idxs = np.zeros((n_pixels, 0), dtype='int64')
+    costs = np.zeros((n_pixels, 0), dtype='float64')
+    for offset, shard in store.shards():
+        shard = np.ascontiguousarray(shard, dtype='float64')
+        lut_terms = cost_function.precompute(shard)
+        n_shard = min(n_solutions, shard.shape[0])
+        n_merged = min(n_solutions, lut_idxs.shape[1] + n_shard)
+        merged_idxs = np.empty((n_pixels, n_merged), dtype='int64')
+        merged_costs = np.empty((n_pixels, n_merged), dtype='float64')
+        for start in range(0, n_pixels, block_size):
+            stop = min(start + block_size, n_pixels)
+            delta = cost_function.block(
+                shard, lut_terms, pixels[start:stop, :])
+            idxs, vals = _top_k(delta, n_shard, cost_function.minimize)
+            # merge with the solutions of the previous shards
+            idxs = np.concatenate(
+                [lut_idxs[start:stop], idxs + offset], axis=1)
+            vals = np.concatenate([costs[start:stop], vals], axis=1)
+            order, merged_costs[start:stop] = _top_k(
+                vals, n_merged, cost_function.minimize)
+            merged_idxs[start:stop] = np.take_along_axis(idxs, order, axis=1)
+        lut_idxs, costs = merged_idxs, merged_costs
+        del shard
+    return lut_idxs.astype('int32'), costs.astype('float32')
+
+
+def _inv_pixels_warm(
         lut: np.ndarray,
+        pixels: np.ndarray,
+        cost_function: CostFunction,
+        n_solutions: int,
+        block_size: int,
+        warm_start: np.ndarray,
+        warm_start_threshold: float | None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Searches the best solutions among a set of candidate LUT spectra per
+    pixel (e.g., derived from the solutions of the previous scene of a time
+    series).
+
+    :param lut:
+        LUT spectra of shape (num_spectra, num_bands) as float64
+    :param pixels:
+        observed spectra of shape (num_pixels, num_bands) as float64
+    :param cost_function:
+        ``CostFunction`` to evaluate
+    :param n_solutions:
+        number of best solutions to return
+    :param block_size:
+        maximum number of pixels to evaluate at once
+    :param warm_start:
+        candidate LUT indices of shape (num_pixels, num_candidates).
+        Negative indices and duplicates are ignored.
+    :param warm_start_threshold:
+        pixels whose best cost function value is worse than this threshold
+        are marked for a full search. If None, only pixels with less than
+        `n_solutions` candidates are.
+    :returns:
+        tuple with LUT indices (int32) and cost function values (float32)
+        of the `n_solutions` best candidates, each of shape
+        (num_pixels, n_solutions), and a boolean array marking the pixels
+        that require a full search
+    """
+    n_pixels, n_candidates = warm_start.shape
+    lut_idxs = np.zeros((n_pixels, n_solutions), dtype='int32')
+    cost_function_values = np.zeros((n_pixels, n_solutions), dtype='float32')
+    fallback = np.ones(n_pixels, dtype='bool')
+    if n_candidates < n_solutions:
+        return lut_idxs, cost_function_values, fallback
+    # the candidate spectra of a block are gathered at once, so keep the
+    # gathered block at about 64 MB
+    block_size = max(
+        1, min(block_size, 2**26 // (8 * n_candidates * lut.shape[1])))
+    invalid_value = np.inf if cost_function.minimize else -np.inf
+    for start in range(0, n_pixels, block_size):
+        stop = min(start + block_size, n_pixels)
+        candidates = np.sort(warm_start[start:stop], axis=1)
+        ignore = candidates < 0
+        ignore[:, 1:] |= candidates[:, 1:] == candidates[:, :-1]
+        candidates[ignore] = 0
+        delta = cost_function.candidates(lut, candidates, pixels[start:stop])
+        delta[ignore] = invalid_value
+        order, vals = _top_k(delta, n_solutions, cost_function.minimize)
+        lut_idxs[start:stop] = np.take_along_axis(candidates, order, axis=1)
+        cost_function_values[start:stop] = vals
+        unsolved = (n_candidates - ignore.sum(axis=1)) < n_solutions
+        if warm_start_threshold is not None:
+            if cost_function.minimize:
+                unsolved |= vals[:, 0] > warm_start_threshold
+            else:
+                unsolved |= vals[:, 0] < warm_start_threshold
+        fallback[start:stop] = unsolved
+    return lut_idxs, cost_function_values, fallback
+
+
+def _inv_pixels(
+        lut: np.ndarray | ShardedLUT,
+        pixels: np.ndarray,
+        cost_function: str | CostFunction,
+        n_solutions: int,
+        block_size: int,
+        backend: Optional[str] = 'brute',
+        lut_index: Optional[LUTIndex | LUTProjection] = None,
+        dedup: Optional[bool] = False,
+        stats: Optional[Dict[str, Any]] = None,
+        warm_start: Optional[np.ndarray] = None,
+        warm_start_threshold: Optional[float] = None,
+        n_workers: Optional[int] = 1
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Batched inversion of observed spectra against the complete LUT.
+    Pixels are processed in blocks of `block_size` so that the memory
+    required for the cost function values is bounded by
+    `block_size * num_spectra`.
+
+    :param lut:
+        LUT spectra of shape (num_spectra, num_bands) or ``ShardedLUT``
+        (searched shard by shard, 'brute' backend only)
+    :param pixels:
+        observed spectra of shape (num_pixels, num_bands)
+    :param cost_function:
+        name of a registered cost function (see
+        `rtm_inv.core.cost_functions`) or ``CostFunction`` instance
+    :param n_solutions:
+        number of best solutions to return
+    :param block_size:
+        number of pixels to evaluate at once
+    :param backend:
+        'brute' (default) evaluates the cost function against every LUT
+        spectrum. 'kdtree' answers the search as k-nearest neighbour query
+        on a KD-tree (rmse, squared_sum_of_differences and mae only), 'pca'
+        searches candidates on the principal components of the LUT and
+        re-ranks them on full spectra (rmse and squared_sum_of_differences
+        only).
+    :param lut_index:
+        pre-built (e.g., persisted) ``LUTIndex`` or ``LUTProjection`` of
+        the LUT spectra to use with the 'kdtree' or 'pca' backend,
+        respectively. Built on the fly if not provided.
+    :param dedup:
+        if True, searches the LUT only once per unique spectrum and
+        scatters the results back to all pixels sharing that spectrum.
+    :param stats:
+        optional dictionary to which inversion statistics are written
+        ('n_pixels', 'n_unique' and 'dedup_ratio' if `dedup` is True,
+        'n_fallback' for the 'pca' backend and 'n_fallback' and
+        'fallback_rate' when using a `warm_start`).
+    :param warm_start:
+        optional candidate LUT indices of shape (num_pixels,
+        num_candidates) searched first (see `inv_img`)
+    :param warm_start_threshold:
+        pixels whose best candidate is worse than this cost function value
+        are searched using the `backend` (see `inv_img`)
+    :param n_workers:
+        number of threads evaluating blocks of pixels in parallel with the
+        'brute' backend. As only (valid) pixels are passed, all blocks but
+        the last have the same size and the threads are evenly loaded.
+        Also limits the workers querying the 'kdtree' and 'pca' indices.
+    :returns:
+        tuple with LUT indices (int32) and cost function values (float32)
+        of the `n_solutions` best solutions, each of shape
+        (num_pixels, n_solutions)
+    """
+    # resolve the cost function once for all blocks
+    cost_function = get_cost_function(cost_function)
+    if not 0 < n_solutions <= lut.shape[0]:
+        raise ValueError(
+            'The number of solutions must be between 1 and the ' +
+            'lookup-table size'
+        )
+    if block_size <= 0:
+        raise ValueError('Block size must be > 0')
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if backend not in backends:
+        raise ValueError(f'Backend {backend} is not available')
+
+    if stats is not None:
+        stats['n_pixels'] = pixels.shape[0]
+    if dedup:
+        # identical spectra (e.g., after resampling 20 m bands to 10 m)
+        # have identical solutions
+        pixels, first, inverse = np.unique(
+            np.asarray(pixels, dtype='float64'),
+            axis=0,
+            return_index=True,
+            return_inverse=True
+        )
+        if stats is not None:
+            stats['n_unique'] = pixels.shape[0]
+            stats['dedup_ratio'] = \
+                stats['n_pixels'] / max(pixels.shape[0], 1)
+        if warm_start is not None:
+            # use the candidates of the first pixel with that spectrum
+            warm_start = np.asarray(warm_start)[first]
+        lut_idxs, cost_function_values = _inv_pixels(
+            lut=lut,
+            pixels=pixels,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            backend=backend,
+            lut_index=lut_index,
+            stats=stats,
+            warm_start=warm_start,
+            warm_start_threshold=warm_start_threshold,
+            n_workers=n_workers
+        )
+        if stats is not None:
+            # refers to the whole set of pixels again
+            stats['n_pixels'] = inverse.size
+        inverse = inverse.ravel()
+        return lut_idxs[inverse], cost_function_values[inverse]
+
+    if warm_start is not None:
+        warm_start = signed_indices(warm_start)
+        if warm_start.ndim != 2 or warm_start.shape[0] != pixels.shape[0]:
+            raise ValueError(
+                'Warm start candidates must be of shape (num_pixels, ' +
+                'num_candidates)')
+        if isinstance(lut, ShardedLUT):
+            raise ValueError('Warm starts require a LUT held in memory')
+        if warm_start.size > 0 and warm_start.max() >= lut.shape[0]:
+            raise ValueError('Warm start candidates exceed the LUT size')
+        lut = np.ascontiguousarray(lut, dtype='float64')
+        pixels = np.ascontiguousarray(pixels, dtype='float64')
+        lut_idxs, cost_function_values, fallback = _inv_pixels_warm(
+            lut=lut,
+            pixels=pixels,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            warm_start=warm_start,
+            warm_start_threshold=warm_start_threshold
+        )
+        # full search for the pixels the candidates did not solve
+        n_fallback = int(fallback.sum())
+        if stats is not None:
+            stats['n_fallback'] = n_fallback
+            stats['fallback_rate'] = n_fallback / max(pixels.shape[0], 1)
+        if n_fallback > 0:
+            idxs, vals = _inv_pixels(
+                lut=lut,
+                pixels=pixels[fallback],
+                cost_function=cost_function,
+                n_solutions=n_solutions,
+                block_size=block_size,
+                backend=backend,
+                lut_index=lut_index,
+                n_workers=n_workers
+            )
+            lut_idxs[fallback] = idxs
+            cost_function_values[fallback] = vals
+        return lut_idxs, cost_function_values
+
+    if isinstance(lut, ShardedLUT):
+        if backend != 'brute':
+            raise ValueError('Sharded LUTs require the brute backend')
+        return _inv_pixels_sharded(
+            store=lut,
+            pixels=pixels,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            block_size=block_size
+        )
+    if backend != 'brute':
+        if lut_index is None:
+            lut_index = backend_indices[backend](lut=lut)
+        elif not isinstance(lut_index, backend_indices[backend]) or \
+                lut_index.size != lut.shape[0]:
+            raise ValueError('LUT index does not match the LUT or backend')
+    if backend == 'kdtree':
+        return lut_index.query(
+            pixels=pixels,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            n_jobs=n_workers
+        )
+
+    lut = np.ascontiguousarray(lut, dtype='float64')
+    pixels = np.ascontiguousarray(pixels, dtype='float64')
+    if backend == 'pca':
+        if cost_function.minkowski_p != 2 or not cost_function.minimize:
+            raise ValueError(
+                f'Cost function {cost_function.name} is not supported by ' +
+                'the pca backend. Use a cost function based on the ' +
+                'Euclidean distance (e.g., rmse)'
+            )
+        return _inv_pixels_pca(
+            lut=lut,
+            pixels=pixels,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            projection=lut_index,
+            stats=stats,
+            n_jobs=n_workers
+        )
+    lut_terms = cost_function.precompute(lut)
+
+    n_pixels = pixels.shape[0]
+    lut_idxs = np.empty((n_pixels, n_solutions), dtype='int32')
+    cost_function_values = np.empty((n_pixels, n_solutions), dtype='float32')
+
+    def _search_block(start: int) -> None:
+        stop = min(start + block_size, n_pixels)
+        delta = cost_function.block(lut, lut_terms, pixels[start:stop, :])
+        idxs, vals = _top_k(delta, n_solutions, cost_function.minimize)
+        lut_idxs[start:stop, :] = idxs
+        cost_function_values[start:stop, :] = vals
+
+    starts = range(0, n_pixels, block_size)
+    if n_workers == 1:
+        for start in starts:
+            _search_block(start)
+    else:
+        # numpy releases the GIL in the matrix products and partial sorts
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            # consume the iterator to propagate exceptions
+            list(executor.map(_search_block, starts))
+    return lut_idxs, cost_function_values
+
+
+def inv_img(
+        lut: np.ndarray | ShardedLUT,
         img: np.ndarray,
         mask: np.ndarray,
-        cost_function: str,
-        n_solutions: int
-) -> Tuple[np.ndarray, np.ndarray]:
+        cost_function: str | CostFunction,
+        n_solutions: int,
+        block_size: Optional[int] = 256,
+        backend: Optional[str] = 'brute',
+        lut_index: Optional[LUTIndex | LUTProjection] = None,
+        dedup: Optional[bool] = False,
+        stats: Optional[Dict[str, Any]] = None,
+        warm_start: Optional[np.ndarray] = None,
+        warm_start_threshold: Optional[float] = None,
+        sparse: Optional[bool] = False,
+        n_workers: Optional[int] = 1
+) -> Tuple[np.ndarray, ...]:
     """
     Lookup-table based inversion on images by minimizing a
     cost function using *n* best solutions to improve numerical
@@ -42,7 +542,9 @@ def inv_img(
     :param lut:
         LUT with synthetic (i.e., RTM-simulated) spectra in the
         spectral resolution of the sensor used. The shape of the LUT
-        must equal (num_spectra, num_bands).
+        must equal (num_spectra, num_bands). LUTs too large for memory
+        can be passed as ``ShardedLUT`` which is searched shard by shard
+        (the returned indices are global across shards).
     :param img:
         image with sensor spectra. The number of spectral bands must
         match the number  of spectral bands in the LUT. The shape of
@@ -52,69 +554,376 @@ def inv_img(
         pixels should be processed set all cells in `mask` to False.
     :param cost_function:
         cost function implementing similarity metric between sensor
-        synthetic spectra. Currently implemented: 'rmse', 'mae',
-        'contrast_function', 'squared_sum_of_differences'
+        synthetic spectra. Built-in: 'rmse', 'mae', 'contrast_function',
+        'squared_sum_of_differences' and 'spectral_angle'. Further cost
+        functions can be added using
+        `rtm_inv.core.cost_functions.register_cost_function`.
     :param n_solutions:
         number of best solutions to return (where cost function is
         minimal)
+    :param block_size:
+        number of pixels evaluated against the whole LUT at once. Larger
+        blocks make better use of BLAS but require
+        `block_size * num_spectra * 8` bytes of memory.
+    :param backend:
+        search backend. 'brute' (default) evaluates the cost function
+        against every LUT spectrum, 'kdtree' uses a KD-tree over the LUT
+        spectra for exact k-nearest neighbour search (rmse,
+        squared_sum_of_differences and mae only) and 'pca' searches an
+        over-sized candidate set on the principal components of the LUT
+        spectra that is re-ranked on full spectra (rmse and
+        squared_sum_of_differences only). All backends return the same
+        solutions.
+    :param lut_index:
+        optional pre-built ``LUTIndex`` or ``LUTProjection`` to use with the
+        'kdtree' or 'pca' backend, respectively (see `from_lut_file` for
+        persisting them next to the LUT).
+    :param dedup:
+        if True, the LUT is searched only once per unique spectrum among the
+        valid pixels and results are scattered back to all pixels sharing
+        that spectrum (e.g., after resampling 20 m bands to 10 m).
+    :param stats:
+        optional dictionary to which inversion statistics are written
+        (number of pixels inverted, number of unique spectra and the ratio
+        of both as 'n_pixels', 'n_unique' and 'dedup_ratio' and the number
+        of pixels for which the 'pca' backend had to enlarge the candidate
+        set or the `warm_start` candidates were not sufficient as
+        'n_fallback' and, for warm starts, 'fallback_rate').
+    :param warm_start:
+        optional candidate LUT indices of shape `(num_candidates, img_rows,
+        img_columns)` that are searched before the whole LUT, e.g., derived
+        from the solutions of the previous scene of a time series using
+        `LUTNeighbourGraph.candidates`. Only pixels with less than
+        `n_solutions` valid candidates or whose best candidate is worse
+        than `warm_start_threshold` are searched using the `backend`.
+    :param warm_start_threshold:
+        cost function value the best candidate of a pixel must reach for
+        the warm start to be accepted. If None, the best candidates are
+        always accepted.
+    :param sparse:
+        if True, only the solutions of the pixels not masked are returned
+        instead of image-shaped arrays (see returns). Saves memory for
+        scenes with many masked pixels (e.g., parcels covering a small part
+        of their bounding box).
+    :param n_workers:
+        number of threads evaluating blocks of (not masked) pixels in
+        parallel (1 by default, None uses all cores) with the 'brute'
+        backend, or querying the index with the 'kdtree' and 'pca'
+        backends.
     :returns:
         tuple with two ``np.ndarray`` of shape
         `(n_solutions, img_rows, img_columns)` where for each pixel
         the `n_solutions` best solutions are returned as row indices
         in the `lut` in the first tuple element and the corresponding
-        cost function values in the second.
+        cost function values in the second. The data types are set by the
+        precision policy (see `rtm_inv.core.precision`); masked pixels are
+        marked by `rtm_inv.core.precision.no_solution`. If `sparse` is
+        True, a tuple
+        with the row indices and cost function values of shape
+        `(n_valid, n_solutions)` (as returned by `inv_df`) and the flat
+        index of the valid pixels in the image of shape `(n_valid,)`
+        (see `scatter_pixels` to get back images).
     """
-    # TODO: think of memory files and downgrade to int16?
-    output_shape = (n_solutions, img.shape[1], img.shape[2])
-    # array for storing best matching LUT indices
-    lut_idxs = np.zeros(shape=output_shape, dtype='int32')
+    n_bands, rows, cols = img.shape
+    if lut.shape[1] != n_bands:
+        raise ValueError(
+            f'Number of bands in the LUT ({lut.shape[1]}) does not match ' +
+            f'the number of bands in the image ({n_bands})'
+        )
+    # only invert pixels that are not masked. They are compacted into a
+    # dense (n_valid, n_bands) array
+    valid = np.flatnonzero(~np.asarray(mask, dtype='bool').ravel())
+    if warm_start is not None:
+        warm_start = np.asarray(warm_start)
+        if warm_start.ndim != 3 or warm_start.shape[1:] != (rows, cols):
+            raise ValueError(
+                'Warm start candidates must be of shape (num_candidates, ' +
+                'img_rows, img_columns)')
+        warm_start = warm_start.reshape(warm_start.shape[0], -1)[:, valid].T
+    if valid.size > 0:
+        pixels = img.reshape(n_bands, -1)[:, valid].T
+        idxs, vals = _inv_pixels(
+            lut=lut,
+            pixels=pixels,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            backend=backend,
+            lut_index=lut_index,
+            dedup=dedup,
+            stats=stats,
+            warm_start=warm_start,
+            warm_start_threshold=warm_start_threshold,
+            n_workers=n_workers
+        )
+    else:
+        idxs = np.empty((0, n_solutions), dtype='int32')
+        vals = np.empty((0, n_solutions), dtype='float32')
+    # data types of the outputs are set by the precision policy
+    policy = get_precision_policy()
+    index_dtype = policy.index_dtype(lut.shape[0])
+    if sparse:
+        return (
+            idxs.astype(index_dtype, copy=False),
+            vals.astype(policy.cost_dtype, copy=False),
+            valid
+        )
+
+    output_shape = (n_solutions, rows * cols)
+    # array for storing best matching LUT indices (`no_solution` for masked
+    # pixels)
+    lut_idxs = np.full(
+        output_shape, no_solution(index_dtype), dtype=index_dtype)
     # array for storing cost function values (required by some strategies)
-    # TODO: might also float16 do the job?
-    cost_function_values = np.zeros(shape=output_shape, dtype='float32')
-
-    for row in prange(img.shape[1]):
-        for col in range(img.shape[2]):
-            # skip masked pixels
-            if mask[row, col]:
-                lut_idxs[:, row, col] = -1
-                continue
-            # get sensor spectrum (single pixel)
-            image_ref = img[:, row, col]
-
-            # cost functions (from EnMap box) implemented in a
-            # way Numba can handle them
-            # (cannot use keywords in numpy functions)
-            # TODO: float64 is propably an overkill given the lower precision of the other arrays...,
-            # move delta init out of for-loop
-            delta = np.zeros(shape=(lut.shape[0],), dtype='float64')
-            for idx in range(lut.shape[0]):
-                if cost_function == 'rmse':
-                    delta[idx] = np.sqrt(np.mean((image_ref - lut[idx, :])**2))
-                elif cost_function == 'mae':
-                    delta[idx] = np.sum(np.abs(image_ref - lut[idx, :]))
-                elif cost_function == 'contrast_function':
-                    # TODO: use np.diff
-                    delta[idx] = np.sum(
-                        -np.log10(lut[idx, :] / image_ref) + lut[idx, :] /
-                        image_ref
-                    )
-                elif cost_function == 'squared_sum_of_differences':
-                    delta[idx] = np.sum((lut[idx, :] - image_ref)**2)
-            # find the smallest errors between simulated and observed spectra
-            # we need the row index of the corresponding entries in the LUT
-            delta_sorted = np.argsort(delta)
-            lut_idxs[:, row, col] = delta_sorted[0:n_solutions]
-            cost_function_values[:, row, col] = delta[
-                delta_sorted[0:n_solutions]]
+    cost_function_values = np.zeros(output_shape, dtype=policy.cost_dtype)
+    lut_idxs[:, valid] = idxs.T
+    cost_function_values[:, valid] = vals.T
+
+    return (
+        lut_idxs.reshape(n_solutions, rows, cols),
+        cost_function_values.reshape(n_solutions, rows, cols)
+    )
+
+
+def scatter_pixels(
+        values: np.ndarray,
+        pixel_idxs: np.ndarray,
+        rows: int,
+        cols: int,
+        fill_value: Optional[Any] = np.nan
+) -> np.ndarray:
+    """
+    Scatters per-pixel values of the valid pixels of an image (e.g., the
+    sparse output of `inv_img` or traits retrieved from it) back into an
+    image
+
+    :param values:
+        values of the valid pixels of shape (n_valid, ...)
+    :param pixel_idxs:
+        flat index of the valid pixels in the image of shape (n_valid,)
+    :param rows:
+        number of rows of the image
+    :param cols:
+        number of columns of the image
+    :param fill_value:
+        value of the pixels without values (NaN by default)
+    :returns:
+        image of shape (..., rows, cols)
+    """
+    values = np.asarray(values)
+    if values.shape[0] != pixel_idxs.size:
+        raise ValueError(
+            'Number of values does not match the number of pixels')
+    img = np.full(
+        values.shape[1:] + (rows * cols,),
+        fill_value,
+        dtype=np.result_type(values, np.min_scalar_type(fill_value))
+    )
+    img[..., pixel_idxs] = np.moveaxis(values, 0, -1)
+    return img.reshape(values.shape[1:] + (rows, cols))
 
-    return lut_idxs, cost_function_values
+
+def _inv_pixels_multi(
+        luts: Dict[str, np.ndarray],
+        pixels: np.ndarray,
+        cost_functions: Dict[str, str],
+        n_solutions: Dict[str, int],
+        block_size: int,
+        n_workers: Optional[int] = 1
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Batched inversion of observed spectra against several LUTs (e.g., one
+    per phenological stage) in a single pass. The LUTs sharing a cost
+    function are concatenated (keeping track of the rows belonging to each
+    stage) so that the cost function values of a block of pixels are
+    computed once. The best solutions of every stage are then extracted
+    from its slice of the shared buffer.
+
+    :param luts:
+        LUT spectra of shape (num_spectra, num_bands) per stage
+    :param pixels:
+        observed spectra of shape (num_pixels, num_bands)
+    :param cost_functions:
+        name of the (registered) cost function per stage
+    :param n_solutions:
+        number of best solutions to return per stage
+    :param block_size:
+        number of pixels to evaluate at once
+    :param n_workers:
+        number of threads evaluating blocks of pixels in parallel (see
+        `_inv_pixels`)
+    :returns:
+        dictionary with LUT indices (int32, relative to the LUT of the
+        stage) and cost function values (float32) of shape
+        (num_pixels, n_solutions) per stage
+    """
+    if block_size <= 0:
+        raise ValueError('Block size must be > 0')
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    for stage, lut in luts.items():
+        if not 0 < n_solutions[stage] <= lut.shape[0]:
+            raise ValueError(
+                f'{stage}: The number of solutions must be between 1 and ' +
+                'the lookup-table size'
+            )
+
+    pixels = np.ascontiguousarray(pixels, dtype='float64')
+    n_pixels = pixels.shape[0]
+    res = {}
+    # group stages by cost function and label the rows of each stage in
+    # the concatenated LUT by their offsets
+    for name in set(cost_functions[x] for x in luts):
+        cost_function = get_cost_function(name)
+        stages = [x for x in luts if cost_functions[x] == name]
+        lut = np.ascontiguousarray(
+            np.concatenate([luts[x] for x in stages], axis=0),
+            dtype='float64'
+        )
+        offsets = np.cumsum([0] + [luts[x].shape[0] for x in stages])
+        lut_terms = cost_function.precompute(lut)
+        for stage in stages:
+            res[stage] = (
+                np.empty((n_pixels, n_solutions[stage]), dtype='int32'),
+                np.empty((n_pixels, n_solutions[stage]), dtype='float32')
+            )
+
+        def _search_block(start: int) -> None:
+            stop = min(start + block_size, n_pixels)
+            delta = cost_function.block(lut, lut_terms, pixels[start:stop, :])
+            for sdx, stage in enumerate(stages):
+                idxs, vals = _top_k(
+                    delta[:, offsets[sdx]:offsets[sdx + 1]],
+                    n_solutions[stage],
+                    cost_function.minimize
+                )
+                res[stage][0][start:stop, :] = idxs
+                res[stage][1][start:stop, :] = vals
+
+        starts = range(0, n_pixels, block_size)
+        if n_workers == 1:
+            for start in starts:
+                _search_block(start)
+        else:
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                # consume the iterator to propagate exceptions
+                list(executor.map(_search_block, starts))
+    return res
+
+
+def inv_img_multi(
+        luts: Dict[str, np.ndarray],
+        img: np.ndarray,
+        mask: np.ndarray,
+        cost_functions: Dict[str, str],
+        n_solutions: Dict[str, int],
+        block_size: Optional[int] = 256,
+        dedup: Optional[bool] = False,
+        stats: Optional[Dict[str, Any]] = None,
+        n_workers: Optional[int] = 1
+) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Lookup-table based inversion on images against several LUTs (e.g.,
+    one per phenological stage) in a single pass over the image. The cost
+    function values are computed once per cost function for all stages
+    using it.
+
+    :param luts:
+        LUTs with synthetic spectra per stage. The shape of each LUT must
+        equal (num_spectra, num_bands); the number of spectra may differ
+        between stages.
+    :param img:
+        image with sensor spectra of shape (num_bands, num_rows,
+        num_columns).
+    :param mask:
+        mask of `img.shape[1], img.shape[2]` to skip pixels
+    :param cost_functions:
+        cost function per stage (see `inv_img`)
+    :param n_solutions:
+        number of best solutions to return per stage
+    :param block_size:
+        number of pixels evaluated against the concatenated LUTs at once
+    :param dedup:
+        if True, the LUTs are searched only once per unique spectrum
+        (see `inv_img`)
+    :param stats:
+        optional dictionary to which inversion statistics are written
+        (see `inv_img`)
+    :param n_workers:
+        number of threads evaluating blocks of (not masked) pixels in
+        parallel (1 by default, None uses all cores)
+    :returns:
+        dictionary with a tuple of LUT indices and cost function values of
+        shape `(n_solutions, img_rows, img_columns)` per stage (see
+        `inv_img`). LUT indices refer to the rows of the stage's LUT.
+    """
+    n_bands, rows, cols = img.shape
+    for stage, lut in luts.items():
+        if lut.shape[1] != n_bands:
+            raise ValueError(
+                f'{stage}: Number of bands in the LUT ({lut.shape[1]}) ' +
+                f'does not match the number of bands in the image ({n_bands})'
+            )
+    res = {}
+    policy = get_precision_policy()
+    for stage, lut in luts.items():
+        output_shape = (n_solutions[stage], rows * cols)
+        index_dtype = policy.index_dtype(lut.shape[0])
+        res[stage] = (
+            np.full(output_shape, no_solution(index_dtype), dtype=index_dtype),
+            np.zeros(output_shape, dtype=policy.cost_dtype)
+        )
+
+    # only invert pixels that are not masked
+    valid = np.flatnonzero(~np.asarray(mask, dtype='bool').ravel())
+    pixels = img.reshape(n_bands, -1)[:, valid].T
+    if stats is not None:
+        stats['n_pixels'] = pixels.shape[0]
+    inverse = None
+    if dedup:
+        pixels, inverse = np.unique(
+            np.asarray(pixels, dtype='float64'), axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+        if stats is not None:
+            stats['n_unique'] = pixels.shape[0]
+            stats['dedup_ratio'] = \
+                stats['n_pixels'] / max(pixels.shape[0], 1)
+    if valid.size > 0:
+        res_pixels = _inv_pixels_multi(
+            luts=luts,
+            pixels=pixels,
+            cost_functions=cost_functions,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            n_workers=n_workers
+        )
+        for stage, (idxs, vals) in res_pixels.items():
+            if inverse is not None:
+                idxs, vals = idxs[inverse], vals[inverse]
+            res[stage][0][:, valid] = idxs.T
+            res[stage][1][:, valid] = vals.T
+
+    return {
+        stage: (
+            lut_idxs.reshape(n_solutions[stage], rows, cols),
+            cost_function_values.reshape(n_solutions[stage], rows, cols)
+        ) for stage, (lut_idxs, cost_function_values) in res.items()
+    }
 
 
 def inv_df(
-        lut: np.ndarray,
+        lut: pd.DataFrame | ShardedLUT,
         df: pd.DataFrame,
-        cost_function: str,
-        n_solutions: int
+        cost_function: str | CostFunction,
+        n_solutions: int,
+        block_size: Optional[int] = 256,
+        backend: Optional[str] = 'brute',
+        lut_index: Optional[LUTIndex | LUTProjection] = None,
+        dedup: Optional[bool] = False,
+        stats: Optional[Dict[str, Any]] = None,
+        warm_start: Optional[np.ndarray] = None,
+        warm_start_threshold: Optional[float] = None,
+        n_workers: Optional[int] = 1
 ) -> Tuple[np.ndarray, np.ndarray]:
     """
     Lookup-table based inversion on dataframe by minimizing a
@@ -124,62 +933,251 @@ def inv_df(
     :param lut:
         LUT with synthetic (i.e., RTM-simulated) spectra in the
         spectral resolution of the sensor used. The shape of the LUT
-        must equal (num_spectra, num_bands).
+        must equal (num_spectra, num_bands). Can also be a ``ShardedLUT``
+        (see `inv_img`).
     :param df:
         pd.DataFrame with sensor spectra. The number of spectral bands must
         match the number  of spectral bands in the LUT.
     :param cost_function:
         cost function implementing similarity metric between sensor
-        synthetic spectra. Currently implemented: 'rmse', 'mae',
-        'contrast_function', 'squared_sum_of_differences'
+        synthetic spectra. Built-in: 'rmse', 'mae', 'contrast_function',
+        'squared_sum_of_differences' and 'spectral_angle'. Further cost
+        functions can be added using
+        `rtm_inv.core.cost_functions.register_cost_function`.
     :param n_solutions:
         number of best solutions to return (where cost function is
         minimal)
+    :param block_size:
+        number of observations evaluated against the whole LUT at once
+    :param backend:
+        search backend ('brute', 'kdtree' or 'pca', see `inv_img`)
+    :param lut_index:
+        optional pre-built ``LUTIndex`` or ``LUTProjection`` to use with the
+        'kdtree' or 'pca' backend, respectively
+    :param dedup:
+        if True, the LUT is searched only once per unique spectrum and
+        results are scattered back to all observations sharing it.
+    :param stats:
+        optional dictionary to which inversion statistics are written
+        ('n_pixels', 'n_unique' and 'dedup_ratio' and 'n_fallback' and
+        'fallback_rate' when using a `warm_start`).
+    :param warm_start:
+        optional candidate LUT indices of shape `(n_obs, num_candidates)`
+        searched before the whole LUT (see `inv_img`)
+    :param warm_start_threshold:
+        cost function value the best candidate of an observation must reach
+        for the warm start to be accepted (see `inv_img`)
+    :param n_workers:
+        number of threads evaluating blocks of observations in parallel
+        (see `inv_img`)
     :returns:
-        Lists lut_idxs and cost_function_values, where each entry corresponds to a row of the input gdf.
-        For each pixel i the `n_solutions` best solutions are returned as row indices in lut_idxs[i]
-        The corresponding cost function values in cost_function_values[i]
-    """
-
-    lut_idxs = []
-    cost_function_values = []
-
-    lut_cols = lut.columns.tolist()
-
-    for i, row in df.iterrows():
-        pix_ref = row[lut_cols].values
-
-        delta = np.zeros(shape=(lut.shape[0],), dtype='float64')
-        for idx in range(lut.shape[0]):
-            if cost_function == 'rmse':
-                delta[idx] = np.sqrt(np.mean((pix_ref - lut.iloc[idx].values)**2))
-            elif cost_function == 'mae':
-                delta[idx] = np.sum(np.abs(pix_ref - lut.iloc[idx].values))
-            elif cost_function == 'contrast_function':
-                # TODO: use np.diff
-                delta[idx] = np.sum(
-                    -np.log10(lut.iloc[idx].values/ pix_ref) + lut.iloc[idx].values /
-                    pix_ref
-                )
-            elif cost_function == 'squared_sum_of_differences':
-                delta[idx] = np.sum((lut.iloc[idx].values - pix_ref)**2)
-        # find the smallest errors between simulated and observed spectra
-        # we need the row index of the corresponding entries in the LUT
-        delta_sorted = np.argsort(delta)
-        lut_idxs.append(delta_sorted[0:n_solutions])
-        cost_function_values.append(delta[delta_sorted[0:n_solutions]])
+        tuple with two ``np.ndarray`` of shape `(n_obs, n_solutions)`
+        where for each row i of the input df the `n_solutions` best
+        solutions are returned as row indices in the `lut` in lut_idxs[i]
+        and the corresponding cost function values in
+        cost_function_values[i].
+    """
+    if isinstance(lut, ShardedLUT):
+        lut_cols = lut.band_names
+        lut_spectra = lut
+    else:
+        lut_cols = lut.columns.tolist()
+        # convert LUT and observations to contiguous arrays once
+        lut_spectra = np.ascontiguousarray(lut.values, dtype='float64')
+    obs_spectra = np.ascontiguousarray(df[lut_cols].values, dtype='float64')
 
+    lut_idxs, cost_function_values = _inv_pixels(
+        lut=lut_spectra,
+        pixels=obs_spectra,
+        cost_function=cost_function,
+        n_solutions=n_solutions,
+        block_size=block_size,
+        backend=backend,
+        lut_index=lut_index,
+        dedup=dedup,
+        stats=stats,
+        warm_start=warm_start,
+        warm_start_threshold=warm_start_threshold,
+        n_workers=n_workers
+    )
     return lut_idxs, cost_function_values
 
 
-# TODO: would be nice to get this running in parallel again
-# @njit(cache=True, parallel=True)
+def _check_quantiles(quantiles: List[float]) -> None:
+    """
+    Checks that quantiles are between 0 and 1
+    """
+    if not all(0 <= q <= 1 for q in quantiles):
+        raise ValueError('Quantiles must be between 0 and 1')
+
+
+def _order_statistics(
+        values: np.ndarray,
+        quantiles: List[float],
+        median: Optional[bool] = False
+) -> Tuple[np.ndarray | None, List[np.ndarray]]:
+    """
+    Computes the median and quantiles of values along the first axis
+    using a single partial sort (selection) of all order statistics
+    required. Quantiles are interpolated linearly between the closest
+    ranks as `np.quantile` does by default.
+
+    :param values:
+        values of shape (n, ...)
+    :param quantiles:
+        quantiles to compute (between 0 and 1)
+    :param median:
+        if True, the median is computed as well
+    :returns:
+        tuple with the median (None if `median` is False) and a list with
+        the quantiles, each of shape `values.shape[1:]`
+    """
+    n = values.shape[0]
+    quantiles = np.asarray(quantiles, dtype='float64')
+    virtual = (n - 1) * quantiles
+    lower = np.floor(virtual)
+    upper = lower + 1
+    lower[virtual >= n - 1] = n - 1
+    upper[virtual >= n - 1] = n - 1
+    gamma = virtual - lower
+    lower, upper = lower.astype(int), upper.astype(int)
+    kth = set(lower.tolist()) | set(upper.tolist())
+    if median:
+        kth |= {(n - 1) // 2, n // 2}
+    partitioned = np.partition(values, sorted(kth), axis=0)
+
+    median_vals = None
+    if median:
+        median_vals = partitioned[(n - 1) // 2]
+        if n % 2 == 0:
+            median_vals = (median_vals + partitioned[n // 2]) / 2
+    quantile_vals = []
+    for qdx in range(quantiles.size):
+        a, b, t = partitioned[lower[qdx]], partitioned[upper[qdx]], gamma[qdx]
+        # same interpolation as np.quantile (numerically stable for t
+        # close to 1)
+        diff_b_a = b - a
+        quantile_vals.append(
+            b - diff_b_a * (1 - t) if t >= 0.5 else a + diff_b_a * t)
+    return median_vals, quantile_vals
+
+
+def _aggregate_solutions(
+        trait_vals_n_solutions: np.ndarray,
+        cost_function_values: np.ndarray,
+        measure: str,
+        quantiles: Optional[List[float]] = [0.05, 0.95]
+) -> Tuple[np.ndarray, ...]:
+    """
+    Aggregates the trait values of the *n* best solutions of a set of
+    pixels into a single value per pixel and trait plus the quantiles of
+    the solutions. The median and quantiles are selected in a single
+    partial sort along the solution axis.
+
+    :param trait_vals_n_solutions:
+        trait values of the *n* best solutions of shape
+        (n_solutions, n_pixels, n_traits)
+    :param cost_function_values:
+        corresponding cost function values of shape
+        (n_solutions, n_pixels)
+    :param measure:
+        upper-case name of the statistical measure ('MEDIAN', 'MEAN' or
+        'WEIGHTED_MEAN')
+    :param quantiles:
+        quantiles of the trait values to compute (5 and 95% by default)
+    :returns:
+        tuple with the aggregated trait values and the quantiles, each of
+        shape (n_pixels, n_traits)
+    """
+    trait_vals, quantile_vals = _order_statistics(
+        values=trait_vals_n_solutions,
+        quantiles=quantiles,
+        median=measure == 'MEDIAN'
+    )
+    if measure == 'MEAN':
+        trait_vals = np.mean(trait_vals_n_solutions, axis=0)
+    elif measure == 'WEIGHTED_MEAN':
+        weights = 0.1 * np.asarray(cost_function_values, dtype='float64')
+        weights /= weights.sum(axis=0, keepdims=True)
+        trait_vals = np.einsum('ij,ijk->jk', weights, trait_vals_n_solutions)
+    return (trait_vals, *quantile_vals)
+
+
+def _retrieve_traits_pixels(
+        trait_values: np.ndarray,
+        lut_idxs: np.ndarray,
+        cost_function_values: np.ndarray,
+        measure: str,
+        n_workers: Optional[int] = None,
+        chunk_bytes: Optional[int] = 2**26,
+        quantiles: Optional[List[float]] = [0.05, 0.95]
+) -> Tuple[np.ndarray, ...]:
+    """
+    Gathers the trait values of the *n* best solutions of all pixels as
+    one (n_solutions, n_pixels, n_traits) tensor and aggregates them.
+    Pixels are split into chunks of at most `chunk_bytes` which are
+    processed in parallel (numpy releases the GIL in the sorting and
+    reduction kernels used).
+
+    :param trait_values:
+        array with traits entries in the LUT of shape (n_lut, n_traits)
+    :param lut_idxs:
+        indices of the best matching entries in the LUT of shape
+        (n_solutions, n_pixels)
+    :param cost_function_values:
+        corresponding values of the cost function of shape
+        (n_solutions, n_pixels)
+    :param measure:
+        upper-case name of the statistical measure
+    :param n_workers:
+        number of threads to use. Uses all cores by default.
+    :param chunk_bytes:
+        maximum size of the gathered trait tensor per chunk in bytes
+    :param quantiles:
+        quantiles of the trait values to compute (5 and 95% by default)
+    :returns:
+        tuple with the aggregated trait values and the quantiles, each of
+        shape (n_pixels, n_traits)
+    """
+    n_solutions, n_pixels = lut_idxs.shape
+    n_traits = trait_values.shape[1]
+    # aggregated trait values followed by the quantiles
+    outputs = [
+        np.empty((n_pixels, n_traits), dtype='float64')
+        for _ in range(1 + len(quantiles))
+    ]
+
+    chunk_size = max(1, chunk_bytes // (8 * n_solutions * n_traits))
+
+    def _process_chunk(start: int) -> None:
+        stop = min(start + chunk_size, n_pixels)
+        trait_vals_n_solutions = trait_values[lut_idxs[:, start:stop], :]
+        res = _aggregate_solutions(
+            trait_vals_n_solutions=trait_vals_n_solutions,
+            cost_function_values=cost_function_values[:, start:stop],
+            measure=measure,
+            quantiles=quantiles
+        )
+        for output, vals in zip(outputs, res):
+            output[start:stop] = vals
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    starts = range(0, n_pixels, chunk_size)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        # consume the iterator to propagate exceptions
+        list(executor.map(_process_chunk, starts))
+    return tuple(outputs)
+
+
 def _retrieve_traits(
         trait_values: np.ndarray,
         lut_idxs: np.ndarray,
         cost_function_values: np.ndarray,
-        measure: Optional[str] = 'Median'
-) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        measure: Optional[str] = 'Median',
+        n_workers: Optional[int] = None,
+        quantiles: Optional[List[float]] = [0.05, 0.95]
+) -> Tuple[np.ndarray, ...]:
     """
     Uses the indices of the best matching spectra to retrieve the
     corresponding trait values from the LUT
@@ -196,79 +1194,72 @@ def _retrieve_traits(
         are "median" (takes the median value of the best *n* solutions)
         and "weighted_mean" (mean weighted by the cost function values
         of the *n* best solutions)
+    :param n_workers:
+        number of threads to use. Uses all cores by default.
+    :param quantiles:
+        quantiles of the trait values across the *n* solutions to return
+        (between 0 and 1). Defaults to the 5 and 95% percentiles.
     :returns:
-        tuple with 3 arrays. The first item contains a3-d image with
-        trait values with shape (n_traits, nrows, ncols). The second and third
-        item contain the 5 and 95% percentile of the predicted traits across
-        the *n* solutions, respectively. This gives a measure of the
-        variability of the *n* solutions found.
+        tuple with 1 + len(quantiles) arrays. The first item contains a3-d
+        image with trait values with shape (n_traits, nrows, ncols). The
+        following items contain the quantiles of the predicted traits across
+        the *n* solutions (by default the 5 and 95% percentile). This gives
+        a measure of the variability of the *n* solutions found.
     """
     # check inputs
     measure = measure.upper()
     if measure not in ['MEDIAN', 'WEIGHTED_MEAN', 'MEAN']:
         raise ValueError(f'Measure {measure} is not available')
+    _check_quantiles(quantiles)
     n_traits = trait_values.shape[1]
     n_solutions, rows, cols = lut_idxs.shape
-    # allocate arrays for storing inversion results
-    trait_img_shape = (n_traits, rows, cols)
-    # TODO: downgrade to float32 or even float16?!
-    trait_img = np.zeros(trait_img_shape, dtype='float64')
-    q05_img = np.zeros(trait_img_shape, dtype='float64')
-    q95_img = np.zeros(trait_img_shape, dtype='float64')
-    # loop over pixels and write inversion result to trait_img
-    for row in prange(rows):
-        for col in range(cols):
-            # continue if the pixel was masked before and has therefore no
-            # solutions
-            if (lut_idxs[:, row, col] == -1).all():
-                trait_img[:, row, col] = np.nan,
-                q05_img[:, row, col] = np.nan
-                q95_img[:, row, col] = np.nan
-                continue
-            # TODO: cast to Fortran-styled array to speed up operations?
-            trait_vals_n_solutions = trait_values[lut_idxs[:, row, col], :]
-            for trait_idx in range(trait_values.shape[1]):
-                if measure == 'MEDIAN':
-                    trait_img[trait_idx, row, col] = \
-                        np.median(trait_vals_n_solutions[:, trait_idx])
-                elif measure == 'MEAN':
-                    trait_img[trait_idx, row, col] = \
-                        np.mean(trait_vals_n_solutions[:, trait_idx])
-                elif measure == 'WEIGHTED_MEAN':
-                    denominator = np.sum(
-                        0.1 * cost_function_values[:, row, col])
-                    vest_sum = 0.
-                    for solution in range(n_solutions):
-                        weight = \
-                            0.1 * cost_function_values[solution, row, col] / \
-                            denominator
-                        vest_sum += \
-                            weight * trait_vals_n_solutions[
-                                solution, trait_idx]
-                    trait_img[trait_idx, row, col] = vest_sum
-                # get quantiles of traits
-                q05_img[trait_idx, row, col] = np.quantile(
-                    trait_vals_n_solutions[:, trait_idx], 0.05)
-                q95_img[trait_idx, row, col] = np.quantile(
-                    trait_vals_n_solutions[:, trait_idx], 0.95)
-
-    return trait_img, q05_img, q95_img
+    # allocate arrays for storing inversion results (the trait values
+    # followed by the quantiles). Pixels masked before have no solutions and
+    # remain NaN
+    trait_img_shape = (n_traits, rows * cols)
+    # the data type of the trait images is set by the precision policy
+    imgs = [
+        np.full(
+            trait_img_shape, np.nan,
+            dtype=get_precision_policy().trait_dtype)
+        for _ in range(1 + len(quantiles))
+    ]
+
+    lut_idxs = lut_idxs.reshape(n_solutions, -1)
+    cost_function_values = cost_function_values.reshape(n_solutions, -1)
+    valid = np.flatnonzero(~is_no_solution(lut_idxs).all(axis=0))
+    if valid.size > 0:
+        res = _retrieve_traits_pixels(
+            trait_values=trait_values,
+            lut_idxs=lut_idxs[:, valid],
+            cost_function_values=cost_function_values[:, valid],
+            measure=measure,
+            n_workers=n_workers,
+            quantiles=quantiles
+        )
+        for img, vals in zip(imgs, res):
+            img[:, valid] = vals.T
+
+    return tuple(img.reshape(n_traits, rows, cols) for img in imgs)
 
 
 def _retrieve_traits_df(
-        trait_values: tuple,
-        lut_idxs: list,
-        cost_function_values: list,
-        measure: Optional[str] = 'Median'
-) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        trait_values: np.ndarray,
+        lut_idxs: np.ndarray,
+        cost_function_values: np.ndarray,
+        measure: Optional[str] = 'Median',
+        n_workers: Optional[int] = None,
+        quantiles: Optional[List[float]] = [0.05, 0.95]
+) -> Tuple[np.ndarray, ...]:
     """
     Uses the indices of the best matching spectra to retrieve the
     corresponding trait values from the LUT
 
     :param trait_values:
-        array or tuple with traits entries in the LUT
+        array with traits entries in the LUT
     :param lut_idxs:
-        indices of the best matching entries in the LUT
+        indices of the best matching entries in the LUT of shape
+        (n_obs, n_solutions)
     :param cost_function_values:
         corresponding values of the cost function chosen
     :param measure:
@@ -277,68 +1268,49 @@ def _retrieve_traits_df(
         are "median" (takes the median value of the best *n* solutions)
         and "weighted_mean" (mean weighted by the cost function values
         of the *n* best solutions)
+    :param n_workers:
+        number of threads to use. Uses all cores by default.
+    :param quantiles:
+        quantiles of the trait values across the *n* solutions to return
+        (between 0 and 1). Defaults to the 5 and 95% percentiles.
     :returns:
-        tuple with 3 arrays. Each has a shape (nrows, n_traits).
-        The first contains the retrieved trait values.
-        The second and third item contain the 5 and 95% percentile of the predicted traits across
-        the *n* solutions, respectively. This gives a measure of the
-        variability of the *n* solutions found.
+        tuple with 1 + len(quantiles) arrays. Each has a shape
+        (nrows, n_traits). The first contains the retrieved trait values.
+        The following items contain the quantiles of the predicted traits
+        across the *n* solutions (by default the 5 and 95% percentile).
+        This gives a measure of the variability of the *n* solutions found.
     """
     # check inputs
     measure = measure.upper()
     if measure not in ['MEDIAN', 'WEIGHTED_MEAN', 'MEAN']:
         raise ValueError(f'Measure {measure} is not available')
-    n_traits = trait_values.shape[1]
-    n_rows = len(lut_idxs)
-    n_solutions = len(lut_idxs[0])
-    # For storing inversion results
-    trait_arr = np.zeros((n_rows,n_traits), dtype='float64')
-    q05_arr = np.zeros((n_rows,n_traits), dtype='float64')
-    q95_arr = np.zeros((n_rows,n_traits), dtype='float64')
-
-    # Loop over pixels and write inversion result
-    for i in range(len(lut_idxs)):
-        lut_idx = lut_idxs[i]
-        cost_function_value = cost_function_values[i]
-
-        trait_vals_n_solutions = trait_values[lut_idx, :]
-        for trait_idx in range(trait_values.shape[1]):
-            if measure == 'MEDIAN':
-                trait_arr[i, trait_idx] = np.median(trait_vals_n_solutions[:, trait_idx])
-            elif measure == 'MEAN':
-                trait_arr[i, trait_idx] = np.mean(trait_vals_n_solutions[:, trait_idx])
-            elif measure == 'WEIGHTED_MEAN':
-                denominator = np.sum(
-                    0.1 * cost_function_value)
-                vest_sum = 0.
-                for solution in range(n_solutions):
-                    weight = \
-                        0.1 * cost_function_value/ \
-                        denominator
-                    vest_sum += \
-                        weight * trait_vals_n_solutions[
-                            solution, trait_idx]
-                trait_arr[i, trait_idx] = vest_sum
-            # get quantiles of traits
-            q05_arr[i, trait_idx] = np.quantile(trait_vals_n_solutions[:, trait_idx], 0.05)
-            q95_arr[i, trait_idx] = np.quantile(trait_vals_n_solutions[:, trait_idx], 0.95)
-
-    return trait_arr, q05_arr, q95_arr
+    _check_quantiles(quantiles)
+    lut_idxs = np.asarray(lut_idxs)
+    cost_function_values = np.asarray(cost_function_values)
+
+    return _retrieve_traits_pixels(
+        trait_values=trait_values,
+        lut_idxs=lut_idxs.T,
+        cost_function_values=cost_function_values.T,
+        measure=measure,
+        n_workers=n_workers,
+        quantiles=quantiles
+    )
 
 
 def retrieve_traits(
-        lut: pd.DataFrame,
+        lut: pd.DataFrame | ShardedLUT,
         lut_idxs: np.ndarray,
         cost_function_values: np.ndarray,
         traits: List[str],
         **kwargs
-) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+) -> Tuple[np.ndarray, ...]:
     """
     Extracts traits from a lookup-table on results of `inv_img` or `inv_df`
 
     :param lut:
         complete lookup-table from the RTM forward runs (i.e.,
-        spectra + trait values) as ``pd.DataFrame``.
+        spectra + trait values) as ``pd.DataFrame`` or ``ShardedLUT``.
     :param lut_idxs:
         row indices in the `lut` denoting for each image pixel
         the *n* best solutions (smallest value of cost function
@@ -353,18 +1325,27 @@ def retrieve_traits(
         into a single final one. Calls [np.]median per default.
         Otherwise 'mean' can be passed.
     :param kwargs:
-        further key-word arguments to pass to `_retrieve_traits`
+        further key-word arguments to pass to `_retrieve_traits` (e.g.,
+        `quantiles` to compute other quantiles than the 5 and 95%
+        percentiles such as [0.25, 0.75])
     :returns:
-        tuple with 3 arrays. The first item contains a3-d image with
-        trait values with shape (n_traits, nrows, ncols). The second and third
-        item contain the 5 and 95% percentile of the predicted traits across
-        the *n* solutions, respectively. This gives a measure of the
+        tuple with 3 arrays (1 + len(quantiles) if `quantiles` are passed).
+        The first item contains a3-d image with trait values with shape
+        (n_traits, nrows, ncols). The following items contain the 5 and 95%
+        percentile (or the `quantiles`) of the predicted traits across the
+        *n* solutions, respectively. This gives a measure of the
         variability of the *n* solutions found.
-        If inverting a df, will return ........................
+        If inverting a df, each of the arrays has shape
+        (n_obs, n_traits) instead.
     """
-    trait_values = lut[traits].values.reshape(-1, len(traits))
+    if isinstance(lut, ShardedLUT):
+        trait_values = lut.trait_values(traits)
+    else:
+        trait_values = lut[traits].values.reshape(-1, len(traits))
 
-    if not isinstance(lut_idxs, list):
+    # results of `inv_img` are 3-d (n_solutions, rows, cols), results
+    # of `inv_df` are 2-d (n_obs, n_solutions)
+    if np.ndim(lut_idxs) == 3:
         res_tuple = _retrieve_traits(
             trait_values=trait_values,
             lut_idxs=lut_idxs,
@@ -372,7 +1353,7 @@ def retrieve_traits(
             **kwargs
         )
         return res_tuple
-    if isinstance(lut_idxs, list):
+    else:
         res_tuple = _retrieve_traits_df(
             trait_values=trait_values,
             lut_idxs=lut_idxs,
@@ -19,15 +19,25 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import annotations
 
-import lhsmdu
+import hashlib
 import numpy as np
+import os
 import pandas as pd
+import time
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Dict, List, Optional
 
 from rtm_inv.core.distributions import Distributions
+from rtm_inv.core.lut_io import params_hash
 from rtm_inv.core.rtm_adapter import RTM
+from rtm_inv.core.samplers import (
+    available_samplers,
+    default_chunk_size,
+    get_sampler,
+    unit_samples
+)
 from rtm_inv.core.utils import (
     chlorophyll_carotiniod_constraint,
     glai_ccc_constraint,
@@ -35,7 +45,9 @@ from rtm_inv.core.utils import (
 )
 
 # sampling methods available
-sampling_methods: List[str] = ['LHS', 'FRS']
+sampling_methods: List[str] = available_samplers()
+# number of shards per worker when simulating spectra in parallel
+shards_per_worker: int = 4
 
 
 class LookupTable(object):
@@ -96,7 +108,8 @@ class LookupTable(object):
             method: str,
             seed_value: Optional[int] = 0,
             apply_glai_ccc_constraint: Optional[bool] = True,
-            apply_chlorophyll_carotiniod_constraint: Optional[bool] = True
+            apply_chlorophyll_carotiniod_constraint: Optional[bool] = True,
+            chunk_size: Optional[int] = default_chunk_size
     ) -> None:
         """
         Sample parameter values using a custom sampling scheme.
@@ -104,8 +117,13 @@ class LookupTable(object):
         Currently supported sampling schemes are:
 
         - Latin Hypercube Sampling (LHS)
-        - Fully Random Sampling (FRS) using distributions of traits
-        - ...
+        - Fully Random Sampling (FRS)
+        - scrambled Sobol sequences (SOBOL)
+        - scrambled Halton sequences (HALTON)
+
+        See `rtm_inv.core.samplers` for registering further samplers. The
+        samples are mapped to trait values using the distribution of each
+        trait (uniform or truncated Gaussian between min and max).
 
         All parameters (traits) are sampled, whose distribution is not set
         as "constant"
@@ -114,7 +132,7 @@ class LookupTable(object):
             number of samples to draw (equals the size of the resulting
             lookup-table)
         :param method:
-            sampling method to apply
+            sampling method to apply (case insensitive)
         :param seed_value:
             seed value to set to the pseudo-random-number generator. Default
             is zero.
@@ -122,6 +140,8 @@ class LookupTable(object):
             whether the apply the GLAI-CCC constraint. Default is True.
         :param apply_glai_ccc_constraint:
             whether the apply the Cab-Car constraint. Default is True.
+        :param chunk_size:
+            number of samples generated at once
         """
         # set seed to the random number generator
         np.random.seed(seed_value)
@@ -144,45 +164,35 @@ class LookupTable(object):
         constant_traits = constant_traits.transpose()
         constant_traits.columns = constant_trait_names
 
-        # select method and conduct sampling
-        if method.upper() == 'LHS':
-            # create LHS matrix
-            lhc = lhsmdu.createRandomStandardUniformMatrix(
-                n_traits, num_samples)
-            traits_lhc = pd.DataFrame(lhc).transpose()
-            traits_lhc.columns = trait_names
-            # replace original values in LHS matrix (scaled between 0 and 1)
-            # with trait values scaled between their specific min and max
-            for trait_name in trait_names:
-                traits_lhc[trait_name] = traits_lhc[trait_name] * \
-                    traits[trait_name]['Max'] + traits[trait_name]['Min']
-            sample_traits = traits_lhc
-        elif method.upper() == 'FRS':
-            # fully random sampling within the trait ranges specified
-            # drawing a random sample for each trait
-            frs_matrix = np.empty((num_samples, n_traits), dtype=np.float32)
-            traits_frs = pd.DataFrame(frs_matrix)
-            traits_frs.columns = trait_names
-            for trait_name in trait_names:
-                mode = None
-                if 'Mode' in traits[trait_name].index:
-                    mode = traits[trait_name]['Mode']
-                std = None
-                if 'Std' in traits[trait_name].index:
-                    std = traits[trait_name]['Std']
-                dist = Distributions(
-                    min_value=traits[trait_name]['Min'],
-                    max_value=traits[trait_name]['Max'],
-                    mean_value=mode,
-                    std_value=std
-                )
-                traits_frs[trait_name] = dist.sample(
+        # draw samples in the unit hypercube and map them to the trait values
+        # using the inverse distribution functions of the traits
+        sample_matrix = unit_samples(
+            sampler=method,
+            num_samples=num_samples,
+            num_traits=n_traits,
+            seed=seed_value,
+            chunk_size=chunk_size
+        )
+        for idx, trait_name in enumerate(trait_names):
+            mode = None
+            if 'Mode' in traits[trait_name].index:
+                mode = traits[trait_name]['Mode']
+            std = None
+            if 'Std' in traits[trait_name].index:
+                std = traits[trait_name]['Std']
+            dist = Distributions(
+                min_value=traits[trait_name]['Min'],
+                max_value=traits[trait_name]['Max'],
+                mean_value=mode,
+                std_value=std
+            )
+            for chunk_start in range(0, num_samples, chunk_size):
+                chunk = sample_matrix[chunk_start:chunk_start+chunk_size, idx]
+                chunk[:] = dist.ppf(
                     distribution=traits[trait_name]['Distribution'],
-                    n_samples=num_samples
+                    quantiles=chunk
                 )
-            sample_traits = traits_frs
-        else:
-            raise NotImplementedError(f'{method} not found')
+        sample_traits = pd.DataFrame(sample_matrix, columns=trait_names)
 
         # combine trait samples and constant values into a single DataFrame
         # so that in can be passed to the RTM
@@ -201,6 +211,17 @@ class LookupTable(object):
         if apply_chlorophyll_carotiniod_constraint:
             sample_traits = chlorophyll_carotiniod_constraint(
                 lut_df=sample_traits)
+        # record how the samples were generated (stored with the LUT, see
+        # `rtm_inv.core.lut_io.write_lut`)
+        sample_traits.attrs['lut_metadata'] = {
+            'params_sha1': params_hash(self._params_df),
+            'sampling_method': get_sampler(method).name,
+            'num_samples': num_samples,
+            'seed': seed_value,
+            'apply_glai_ccc_constraint': apply_glai_ccc_constraint,
+            'apply_chlorophyll_carotiniod_constraint':
+                apply_chlorophyll_carotiniod_constraint
+        }
         # set samples to instance variable
         self.samples = sample_traits
 
@@ -327,10 +348,48 @@ def generate_lut(
     lut = LookupTable(params=lut_params)
     lut.generate_samples(
         num_samples=lut_size, method=sampling_method, **kwargs)
+    lut.samples.attrs['lut_metadata'].update({
+        'fixed_angles': fixed_angles,
+        'solar_zenith_angle': solar_zenith_angle,
+        'viewing_zenith_angle': viewing_zenith_angle,
+        'solar_azimuth_angle': solar_azimuth_angle,
+        'viewing_azimuth_angle': viewing_azimuth_angle,
+        'relative_azimuth_angle': relative_azimuth_angle
+    })
 
     return lut
 
 
+def _simulate_shard(shard: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Simulates the spectra of a shard of LUT samples (in a worker process)
+
+    :param shard:
+        shard with its offset in the LUT, the samples and the arguments
+        of `RTM` and `RTM.simulate_spectra`
+    :returns:
+        shard with simulated samples and timing
+    """
+    t0 = time.perf_counter()
+    samples = shard['samples']
+    shard_lut = LookupTable(params=pd.DataFrame())
+    # the RTMs expect a LUT with a range index
+    shard_lut.samples = samples.reset_index(drop=True)
+    rtm = RTM(lut=shard_lut, rtm=shard['rtm_name'])
+    simulations = rtm.simulate_spectra(
+        sensor=shard['sensor'], **shard['rtm_kwargs'])
+    simulations.index = samples.index
+    seconds = time.perf_counter() - t0
+    return {
+        'offset': shard['offset'],
+        'n_spectra': samples.shape[0],
+        'worker': os.getpid(),
+        'seconds': seconds,
+        'spectra_per_s': samples.shape[0] / seconds,
+        'samples': simulations
+    }
+
+
 def simulate_from_lut(
     lut: LookupTable,
     sensor: str,
@@ -341,11 +400,21 @@ def simulate_from_lut(
     rsoil0: Optional[np.array] = None,
     soil_spectrum1: Optional[np.array] = None,
     soil_spectrum2: Optional[np.array] = None,
+    batch_size: Optional[int] = 500,
+    n_workers: Optional[int] = 1
     ):
 
     """
     Simulate spectra using RTM and LUT
 
+    The LUT samples are split into shards of consecutive rows that are
+    simulated in a pool of `n_workers` processes and merged back in the
+    original row order. Shards consist of whole ProSAIL batches, so every
+    spectrum is simulated in the same batch and the result is the same
+    for any number of workers. The shards (offset, number of spectra,
+    worker process and spectra per second) are recorded in the `attrs`
+    of the returned `DataFrame` under 'simulation_shards'.
+
     :param sensor:
         name of the sensor for which the simulated spectra should be resampled.
         See `rtm_inv.core.sensors.Sensors` for a list of sensors currently
@@ -370,23 +439,93 @@ def simulate_from_lut(
     :param soil_spectrum1: dry soil spectra. (will be scaled by rsoil and psoil in lut params). 2101-element array with reflectance values between 400 and 2500nm
         Should be provided with soil_spectrum2
     :param soil_spectrum2: wet soil spectra. 2101-element array with reflectance values between 400 and 2500nm
+    :param batch_size:
+        number of spectra simulated at once by ProSAIL
+    :param n_workers:
+        number of worker processes (1 by default, i.e., the spectra are
+        simulated in the calling process)
+    :returns:
+        LUT samples with simulated spectra as `DataFrame`
     """
+    if n_workers < 1:
+        raise ValueError('Number of workers must be >= 1')
+    if lut.samples is None or lut.samples.empty:
+        raise ValueError('LUT must not be empty')
+
+    # the soil and resampling options apply to ProSAIL only
+    rtm_kwargs = {}
+    batch = 1
+    if rtm_name == 'prosail':
+        rtm_kwargs = {
+            'fpath_srf': fpath_srf,
+            'remove_invalid_green_peaks': remove_invalid_green_peaks,
+            'rsoil0': rsoil0,
+            'soil_spectrum1': soil_spectrum1,
+            'soil_spectrum2': soil_spectrum2,
+            'batch_size': batch_size
+        }
+        batch = batch_size
+
+    # split the LUT into shards of whole batches
+    n_spectra = lut.samples.shape[0]
+    n_batches = int(np.ceil(n_spectra / batch))
+    shard_size = batch * int(
+        np.ceil(n_batches / (n_workers * shards_per_worker)))
+    shards = [
+        {
+            'offset': offset,
+            'samples': lut.samples.iloc[offset:offset + shard_size],
+            'sensor': sensor,
+            'rtm_name': rtm_name,
+            'rtm_kwargs': rtm_kwargs
+        } for offset in range(0, n_spectra, shard_size)
+    ]
 
     # Run the RTM in forward mode in the second step
     # outputs get resampled to the spectral resolution of the sensor
-    rtm = RTM(lut=lut, rtm=rtm_name)
-    lut_simulations = rtm.simulate_spectra(
-        sensor=sensor,
-        fpath_srf=fpath_srf,
-        remove_invalid_green_peaks=remove_invalid_green_peaks,
-        rsoil0=rsoil0,
-        soil_spectrum1=soil_spectrum1,
-        soil_spectrum2=soil_spectrum2
-    )
+    if n_workers == 1:
+        results = [_simulate_shard(shard) for shard in shards]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_simulate_shard, shards))
+    for idx, res in enumerate(results):
+        print(
+            f'Simulated shard {idx+1}/{len(results)} (offset ' +
+            f'{res["offset"]}, {res["n_spectra"]} spectra) on worker ' +
+            f'{res["worker"]}: {res["spectra_per_s"]:.1f} spectra/s')
+    workers = sorted({x['worker'] for x in results})
+    for worker in workers:
+        worker_results = [x for x in results if x['worker'] == worker]
+        rate = sum(x['n_spectra'] for x in worker_results) / \
+            sum(x['seconds'] for x in worker_results)
+        print(f'Worker {worker}: {rate:.1f} spectra/s')
+
+    # merge the shards in the original row order and record the RTM
+    # settings with the metadata of the samples
+    lut_metadata = dict(lut.samples.attrs.get('lut_metadata', {}))
+    soil_spectra = [
+        np.asarray(x, dtype='float64') for x in
+        [rsoil0, soil_spectrum1, soil_spectrum2] if x is not None
+    ]
+    lut_metadata.update({
+        'rtm_name': rtm_name,
+        'sensor': sensor,
+        'fpath_srf': None if fpath_srf is None else str(fpath_srf),
+        'remove_invalid_green_peaks': remove_invalid_green_peaks,
+        'linearize_lai': linearize_lai,
+        'soil_spectra_sha1': hashlib.sha1(
+            np.concatenate(soil_spectra).tobytes()).hexdigest()
+            if soil_spectra else None
+    })
+    lut.samples = pd.concat([x['samples'] for x in results])
+    lut_simulations = lut.samples
+    lut_simulations.attrs['lut_metadata'] = lut_metadata
+    lut_simulations.attrs['simulation_shards'] = [
+        {k: v for k, v in x.items() if k != 'samples'} for x in results
+    ]
     # linearize LAI as proposed by Verhoef et al. (2018,
     # https://doi.org/10.1016/j.rse.2017.08.006)
     if linearize_lai:
         lut_simulations['lai'] = transform_lai(
             lut_simulations['lai'], inverse=False)
     return lut_simulations
-
@@ -0,0 +1,319 @@
+'''
+Content-addressed disk cache of lookup-tables (LUTs) shared across scenes
+and runs. A LUT depends only on the LUT parameters, the sensor, the
+spectral response function, the angles, the sampling setup (method, size,
+seed, constraints) and the RTM options. Cache entries are LUTs in the
+columnar format (see `rtm_inv.core.lut_io`) named after a hash of these
+inputs, with the angles rounded to a tolerance so that scenes of (almost)
+the same geometry share a LUT. Scene directories hold symbolic links to
+the cache entries instead of copies. The size of the cache can be bounded,
+in which case the least recently used entries are evicted.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from rtm_inv.core.lut_io import lut_suffix, meta_fname, params_hash, write_lut
+from rtm_inv.core.result_cache import _update_digest
+
+# values assumed for the LUT generation options not set explicitly (defaults
+# of `generate_lut`, `LookupTable.generate_samples` and `simulate_from_lut`)
+key_defaults: Dict[str, Any] = {
+    'lut_size': 50000,
+    'sampling_method': 'LHS',
+    'seed_value': 0,
+    'apply_glai_ccc_constraint': True,
+    'apply_chlorophyll_carotiniod_constraint': True,
+    'fixed_angles': False,
+    'rtm_name': 'prosail',
+    'fpath_srf': None,
+    'remove_invalid_green_peaks': False,
+    'linearize_lai': False
+}
+# options that do not change the LUT and are not part of the key
+ignored_keys: List[str] = ['n_workers', 'batch_size', 'chunk_size']
+# default tolerance of the angles in degrees
+default_angle_tolerance: float = 0.5
+
+
+def _file_hash(fpath: Path) -> str:
+    with open(fpath, 'rb') as src:
+        return hashlib.sha1(src.read()).hexdigest()
+
+
+def _dir_size(fpath: Path) -> int:
+    return sum(x.stat().st_size for x in fpath.iterdir() if x.is_file())
+
+
+def lut_key(
+        lut_params: Path | pd.DataFrame,
+        **config
+) -> str:
+    """
+    Hash identifying the content of a LUT
+
+    :param lut_params:
+        CSV file or DataFrame with the LUT parameters
+    :param config:
+        keyword arguments of `generate_lut` and `simulate_from_lut`
+        (sensor, fpath_srf, angles, lut_size, sampling_method, seed_value,
+        constraint flags, RTM options) and further options changing the
+        LUT content (e.g., the traits derived from the RTM parameters).
+        Options not set are filled with their defaults. Arrays (e.g., soil
+        spectra) are hashed by their content.
+    :returns:
+        hex digest identifying the LUT
+    """
+    config = dict(key_defaults, **config)
+    for name in ignored_keys:
+        config.pop(name, None)
+    config['sampling_method'] = str(config['sampling_method']).upper()
+    if config['fpath_srf'] is not None:
+        config['fpath_srf'] = _file_hash(config['fpath_srf'])
+    config['lut_params'] = params_hash(lut_params)
+    arrays = {
+        name: np.asarray(config.pop(name)) for name in list(config)
+        if isinstance(config[name], (np.ndarray, pd.Series))
+    }
+    content = json.dumps(config, sort_keys=True, default=str)
+    digest = hashlib.sha1(content.encode())
+    for name in sorted(arrays):
+        digest.update(name.encode())
+        _update_digest(digest, arrays[name])
+    return digest.hexdigest()
+
+
+class LUTCache(object):
+    """
+    Disk cache of LUTs in the columnar format.
+
+    :attrib cache_dir:
+        directory with the cached LUTs
+    :attrib max_size:
+        maximum size of the cache in bytes (None for no limit)
+    :attrib angle_tolerance:
+        tolerance in degrees the angles are rounded to
+    :attrib hits:
+        number of LUTs found in the cache
+    :attrib misses:
+        number of LUTs looked up but not found in the cache
+    """
+    def __init__(
+            self,
+            cache_dir: Path,
+            max_size: Optional[int] = None,
+            angle_tolerance: Optional[float] = default_angle_tolerance
+    ):
+        """
+        Opens a ``LUTCache``
+
+        :param cache_dir:
+            directory with the cached LUTs (created if it does not exist)
+        :param max_size:
+            maximum size of the cache in bytes. If exceeded, the least
+            recently used LUTs are evicted. No limit by default.
+        :param angle_tolerance:
+            tolerance in degrees the angles are rounded to (0.5 degrees by
+            default). Use 0 to key the LUTs on the exact angles.
+        """
+        if max_size is not None and max_size <= 0:
+            raise ValueError('Maximum cache size must be > 0')
+        if angle_tolerance < 0:
+            raise ValueError('Angle tolerance must be >= 0')
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.angle_tolerance = angle_tolerance
+        self.hits = 0
+        self.misses = 0
+
+    def round_angles(self, config: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Rounds the angles (options ending with '_angle') of a LUT
+        configuration to the angle tolerance. LUTs should be generated with
+        the rounded angles so that a cache entry depends on its key only.
+
+        :param config:
+            keyword arguments of `generate_lut` and `simulate_from_lut`
+        :returns:
+            copy of the configuration with rounded angles
+        """
+        config = dict(config)
+        if self.angle_tolerance == 0:
+            return config
+        for name, value in config.items():
+            if name.endswith('_angle') and value is not None:
+                config[name] = round(
+                    round(float(value) / self.angle_tolerance) *
+                    self.angle_tolerance, 6)
+        return config
+
+    def key(
+            self,
+            lut_params: Path | pd.DataFrame,
+            **config
+    ) -> str:
+        """
+        Cache key of a LUT (see `lut_key`) with the angles rounded to the
+        angle tolerance
+
+        :param lut_params:
+            CSV file or DataFrame with the LUT parameters
+        :param config:
+            keyword arguments of `generate_lut` and `simulate_from_lut`
+            and further options changing the LUT content
+        :returns:
+            hex digest identifying the LUT
+        """
+        return lut_key(lut_params, **self.round_angles(config))
+
+    def _fpath(self, key: str) -> Path:
+        return self.cache_dir.joinpath(key + lut_suffix)
+
+    def _touch(self, fpath_entry: Path) -> None:
+        # the modification time of the metadata marks the last use
+        os.utime(fpath_entry.joinpath(meta_fname))
+
+    def get(self, key: str) -> Path | None:
+        """
+        Looks up a cached LUT
+
+        :param key:
+            cache key (see `key`)
+        :returns:
+            directory of the cached LUT or None if the LUT is not cached
+        """
+        fpath_entry = self._fpath(key)
+        if not fpath_entry.joinpath(meta_fname).exists():
+            self.misses += 1
+            print(f'LUT cache miss: {key}')
+            return None
+        self.hits += 1
+        self._touch(fpath_entry)
+        print(f'LUT cache hit: {key}')
+        return fpath_entry
+
+    def put(
+            self,
+            key: str,
+            lut: pd.DataFrame,
+            metadata: Optional[Dict[str, Any]] = None
+    ) -> Path:
+        """
+        Adds a LUT to the cache and evicts the least recently used LUTs if
+        the cache exceeds its maximum size
+
+        :param key:
+            cache key (see `key`)
+        :param lut:
+            LUT to cache
+        :param metadata:
+            metadata to store with the LUT (see
+            `rtm_inv.core.lut_io.write_lut`)
+        :returns:
+            directory of the cached LUT
+        """
+        metadata = dict(metadata or {}, cache_key=key)
+        fpath_entry = write_lut(
+            lut, self._fpath(key), metadata=metadata, overwrite=True)
+        self.evict(keep=[key])
+        return fpath_entry
+
+    def size(self) -> int:
+        """
+        Size of the cached LUTs in bytes
+        """
+        return sum(_dir_size(x) for x in self._entries())
+
+    def _entries(self) -> List[Path]:
+        return [
+            x for x in self.cache_dir.glob('*' + lut_suffix)
+            if x.joinpath(meta_fname).exists()
+        ]
+
+    def evict(self, keep: Optional[List[str]] = None) -> List[str]:
+        """
+        Evicts the least recently used LUTs until the cache does not exceed
+        its maximum size. References to evicted LUTs in scene directories
+        become dangling and are regenerated on the next use.
+
+        :param keep:
+            keys of LUTs not to evict
+        :returns:
+            keys of the evicted LUTs
+        """
+        if self.max_size is None:
+            return []
+        keep = keep or []
+        entries = sorted(
+            self._entries(),
+            key=lambda x: x.joinpath(meta_fname).stat().st_mtime)
+        sizes = {x: _dir_size(x) for x in entries}
+        total = sum(sizes.values())
+        evicted = []
+        for fpath_entry in entries:
+            if total <= self.max_size:
+                break
+            if fpath_entry.stem in keep:
+                continue
+            shutil.rmtree(fpath_entry)
+            total -= sizes[fpath_entry]
+            evicted.append(fpath_entry.stem)
+            print(f'LUT cache evicted: {fpath_entry.stem}')
+        return evicted
+
+    def link(self, key: str, fpath_lut: Path) -> Path:
+        """
+        Creates a reference (symbolic link) to a cached LUT, e.g., in a scene
+        directory. The LUT is copied if the file system does not support
+        symbolic links.
+
+        :param key:
+            cache key (see `key`)
+        :param fpath_lut:
+            path of the reference (`.lut` is appended if the suffix is
+            missing)
+        :returns:
+            path of the reference
+        """
+        fpath_lut = Path(fpath_lut)
+        if fpath_lut.suffix != lut_suffix:
+            fpath_lut = fpath_lut.with_name(fpath_lut.name + lut_suffix)
+        fpath_entry = self._fpath(key)
+        if not fpath_entry.joinpath(meta_fname).exists():
+            raise ValueError(f'LUT {key} is not cached')
+        # references to evicted LUTs are replaced
+        if fpath_lut.is_symlink():
+            fpath_lut.unlink()
+        elif fpath_lut.exists():
+            raise ValueError(f'{fpath_lut} already exists')
+        try:
+            fpath_lut.symlink_to(
+                fpath_entry.resolve(), target_is_directory=True)
+        except OSError:
+            shutil.copytree(fpath_entry, fpath_lut)
+        return fpath_lut
@@ -0,0 +1,469 @@
+'''
+Data structures over the spectra of a lookup-table (LUT) that speed up the
+search of the best solutions:
+
+    - a spatial index for exact k-nearest neighbour (k-NN) inversion. For the
+      Euclidean-type cost functions ('rmse', 'squared_sum_of_differences')
+      and the 'mae' (L1 or Manhattan metric), finding the *n* best solutions
+      is a plain k-NN query that a KD-tree answers in sub-linear time.
+    - a principal component projection for searching candidates in a
+      reduced space that are then re-ranked on full spectra ('rmse' and
+      'squared_sum_of_differences').
+
+Both are persisted next to the LUT file. In addition, a neighbour graph
+between the rows of two LUTs provides candidate solutions when inverting
+time series of scenes starting from the solutions of the previous scene.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import hashlib
+import numpy as np
+import pickle
+
+from pathlib import Path
+from scipy.spatial import cKDTree
+from typing import Optional, Tuple
+
+from rtm_inv.core.cost_functions import CostFunction, get_cost_function
+from rtm_inv.core.precision import is_no_solution
+
+
+def lut_fingerprint(lut: np.ndarray) -> str:
+    """
+    Content hash of the LUT spectra used to check if a persisted index
+    still belongs to a LUT
+
+    :param lut:
+        LUT spectra of shape (num_spectra, num_bands)
+    :returns:
+        hex digest of the LUT shape and content
+    """
+    lut = np.ascontiguousarray(lut, dtype='float64')
+    digest = hashlib.sha1(str(lut.shape).encode())
+    digest.update(lut.tobytes())
+    return digest.hexdigest()
+
+
+class _LUTCompanion(object):
+    """
+    Base class of data structures derived from the spectra of a LUT that
+    are persisted next to the LUT file.
+
+    :attrib fingerprint:
+        content hash of the LUT spectra the structure was built on
+    :attrib n_bands:
+        number of spectral bands in the LUT
+    """
+    # suffix appended to the name of the LUT file when persisting
+    suffix: str = ''
+
+    def to_file(self, fpath: Path) -> None:
+        """
+        Saves the instance to file
+
+        :param fpath:
+            file-path where to pickle the instance to
+        """
+        with open(fpath, 'wb+') as dst:
+            pickle.dump(self, dst)
+
+    @classmethod
+    def from_file(cls, fpath: Path):
+        """
+        Loads an instance from file
+
+        :param fpath:
+            file-path to the pickled instance
+        :returns:
+            instance of the class
+        """
+        with open(fpath, 'rb') as src:
+            instance = pickle.load(src)
+        if not isinstance(instance, cls):
+            raise TypeError(f'{fpath} does not contain a {cls.__name__}')
+        return instance
+
+    @classmethod
+    def fpath_from_lut(cls, fpath_lut: Path) -> Path:
+        """
+        File-path of the instance persisted next to a LUT file (e.g.,
+        `all_phases_lai-ccc_lut.pkl` -> `all_phases_lai-ccc_lut_kdtree.pkl`)
+
+        :param fpath_lut:
+            file-path to the LUT
+        :returns:
+            file-path to the persisted instance
+        """
+        fpath_lut = Path(fpath_lut)
+        return fpath_lut.parent.joinpath(
+            f'{fpath_lut.stem}_{cls.suffix}.pkl')
+
+    @classmethod
+    def from_lut_file(
+            cls,
+            fpath_lut: Path,
+            lut: np.ndarray,
+            **kwargs
+    ):
+        """
+        Loads the instance persisted next to a LUT file. If there is none
+        yet or it was built on different spectra (e.g., because the LUT was
+        sub-sampled differently), it is (re)built and saved.
+
+        :param fpath_lut:
+            file-path to the LUT the spectra were read from
+        :param lut:
+            LUT spectra of shape (num_spectra, num_bands)
+        :param kwargs:
+            optional keyword arguments to pass to the class constructor
+        :returns:
+            instance of the class
+        """
+        fpath = cls.fpath_from_lut(fpath_lut)
+        if fpath.exists():
+            instance = cls.from_file(fpath)
+            if instance.fingerprint == lut_fingerprint(lut):
+                return instance
+        instance = cls(lut=lut, **kwargs)
+        instance.to_file(fpath)
+        return instance
+
+
+class LUTIndex(_LUTCompanion):
+    """
+    KD-tree over the spectra of a LUT.
+
+    The same tree serves all cost functions that are a function of a
+    Minkowski distance (i.e., have a `minkowski_p`) as only the p-norm of
+    the query changes.
+
+    :attrib fingerprint:
+        content hash of the LUT spectra the tree was built on
+    :attrib n_bands:
+        number of spectral bands in the LUT
+    """
+    suffix: str = 'kdtree'
+
+    def __init__(
+            self,
+            lut: np.ndarray,
+            leafsize: Optional[int] = 16
+    ):
+        """
+        Builds a new ``LUTIndex`` instance
+
+        :param lut:
+            LUT spectra of shape (num_spectra, num_bands)
+        :param leafsize:
+            number of points at which the tree switches to brute force
+        """
+        lut = np.ascontiguousarray(lut, dtype='float64')
+        self.fingerprint = lut_fingerprint(lut)
+        self.n_bands = lut.shape[1]
+        self._tree = cKDTree(lut, leafsize=leafsize)
+
+    @property
+    def size(self) -> int:
+        """
+        Number of spectra in the index
+        """
+        return self._tree.n
+
+    def query(
+            self,
+            pixels: np.ndarray,
+            cost_function: str | CostFunction,
+            n_solutions: int,
+            n_jobs: Optional[int] = -1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the `n_solutions` best matching LUT spectra per pixel
+
+        :param pixels:
+            observed spectra of shape (num_pixels, num_bands)
+        :param cost_function:
+            name of a registered cost function or ``CostFunction`` based
+            on a Minkowski distance (e.g., 'rmse', 'mae')
+        :param n_solutions:
+            number of best solutions to return
+        :param n_jobs:
+            number of workers to use for querying. -1 (default) uses all
+            cores.
+        :returns:
+            tuple with LUT indices (int32) and cost function values
+            (float32) of the best solutions in ascending order, each of
+            shape (num_pixels, n_solutions)
+        """
+        cost_function = get_cost_function(cost_function)
+        if cost_function.minkowski_p is None or not cost_function.minimize:
+            raise ValueError(
+                f'Cost function {cost_function.name} is not supported by ' +
+                'the LUT index. Use a cost function based on a Minkowski ' +
+                'distance (e.g., rmse or mae)'
+            )
+        if not 0 < n_solutions <= self.size:
+            raise ValueError(
+                'The number of solutions must be between 1 and the ' +
+                'lookup-table size'
+            )
+        pixels = np.ascontiguousarray(pixels, dtype='float64')
+        dist, idxs = self._tree.query(
+            pixels,
+            k=n_solutions,
+            p=cost_function.minkowski_p,
+            workers=n_jobs
+        )
+        # scipy squeezes the solution axis for k=1
+        dist = dist.reshape(pixels.shape[0], n_solutions)
+        idxs = idxs.reshape(pixels.shape[0], n_solutions)
+        # convert distances into cost function values
+        dist = cost_function.from_distance(dist, self.n_bands)
+        return idxs.astype('int32'), dist.astype('float32')
+
+
+class LUTProjection(_LUTCompanion):
+    """
+    Projection of the LUT spectra onto their leading principal components
+    with a KD-tree over the projected spectra.
+
+    Euclidean distances in the reduced space are a lower bound of the
+    Euclidean distances between full spectra since the projection onto
+    orthonormal components is a contraction. The search therefore selects
+    an over-sized candidate set in the (low-dimensional) reduced space and
+    re-ranks it using the exact cost function on full spectra.
+
+    :attrib fingerprint:
+        content hash of the LUT spectra the projection was fitted on
+    :attrib n_bands:
+        number of spectral bands in the LUT
+    :attrib mean:
+        mean LUT spectrum
+    :attrib components:
+        principal components of shape (n_components, num_bands)
+    :attrib oversampling:
+        size of the candidate set relative to the number of solutions
+    """
+    suffix: str = 'pca'
+
+    def __init__(
+            self,
+            lut: np.ndarray,
+            n_components: Optional[int] = None,
+            explained_variance: Optional[float] = 0.999,
+            oversampling: Optional[float] = 2.,
+            leafsize: Optional[int] = 16
+    ):
+        """
+        Fits a new ``LUTProjection`` instance
+
+        :param lut:
+            LUT spectra of shape (num_spectra, num_bands)
+        :param n_components:
+            number of principal components to keep. If not provided, the
+            smallest number of components explaining `explained_variance`
+            of the LUT variance is used.
+        :param explained_variance:
+            share of variance to explain if `n_components` is not provided
+        :param oversampling:
+            size of the candidate set searched in the reduced space relative
+            to the number of solutions (at least 1). 2 by default.
+        :param leafsize:
+            number of points at which the tree switches to brute force
+        """
+        if oversampling < 1:
+            raise ValueError('Oversampling must be >= 1')
+        lut = np.ascontiguousarray(lut, dtype='float64')
+        self.fingerprint = lut_fingerprint(lut)
+        self.n_bands = lut.shape[1]
+        self.oversampling = oversampling
+        self.mean = lut.mean(axis=0)
+        _, singular_values, components = np.linalg.svd(
+            lut - self.mean, full_matrices=False)
+        if n_components is None:
+            variance = singular_values**2
+            cum_variance = np.cumsum(variance) / max(variance.sum(), 1e-300)
+            n_components = int(
+                np.searchsorted(cum_variance, explained_variance) + 1)
+        n_components = min(max(1, n_components), components.shape[0])
+        self.components = components[:n_components, :]
+        self._tree = cKDTree(self.transform(lut), leafsize=leafsize)
+
+    @property
+    def size(self) -> int:
+        """
+        Number of spectra in the projected LUT
+        """
+        return self._tree.n
+
+    @property
+    def n_components(self) -> int:
+        """
+        Number of principal components kept
+        """
+        return self.components.shape[0]
+
+    def transform(self, spectra: np.ndarray) -> np.ndarray:
+        """
+        Projects spectra onto the principal components
+
+        :param spectra:
+            spectra of shape (num_spectra, num_bands)
+        :returns:
+            projected spectra of shape (num_spectra, n_components)
+        """
+        return (np.asarray(spectra, dtype='float64') - self.mean) @ \
+            self.components.T
+
+    def query_candidates(
+            self,
+            pixels: np.ndarray,
+            n_candidates: int,
+            n_jobs: Optional[int] = -1
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Finds the `n_candidates` closest LUT spectra per pixel in the
+        reduced space
+
+        :param pixels:
+            observed spectra of shape (num_pixels, num_bands)
+        :param n_candidates:
+            number of candidates to return
+        :param n_jobs:
+            number of workers to use for querying. -1 (default) uses all
+            cores.
+        :returns:
+            tuple with the LUT indices of the candidates of shape
+            (num_pixels, n_candidates) and the squared Euclidean distance
+            of the closest LUT spectrum not returned per pixel (a lower
+            bound of the squared Euclidean distance between the full spectra
+            of the pixel and any LUT spectrum not returned; inf if all LUT
+            spectra are returned)
+        """
+        n_candidates = min(n_candidates, self.size)
+        n_query = min(n_candidates + 1, self.size)
+        dist, idxs = self._tree.query(
+            self.transform(pixels), k=n_query, workers=n_jobs)
+        dist = dist.reshape(-1, n_query)
+        idxs = idxs.reshape(-1, n_query)
+        if n_query > n_candidates:
+            bound = dist[:, n_candidates]**2
+        else:
+            bound = np.full(dist.shape[0], np.inf)
+        return idxs[:, :n_candidates], bound
+
+
+class LUTNeighbourGraph(object):
+    """
+    Neighbour graph from the rows of a source LUT to the rows of a target
+    LUT, e.g., from the LUT of the previous scene of a time series to the
+    LUT of the current one. Neighbours are searched in the space of the RTM
+    input parameters (standardized using the target LUT) so that the
+    graph also links LUTs that were sampled independently. If source and
+    target are the same LUT, every row is linked to itself and its closest
+    neighbours.
+
+    :attrib neighbours:
+        indices of the target rows closest to every source row of shape
+        (num_source_spectra, n_neighbours)
+    """
+    def __init__(
+            self,
+            source: np.ndarray,
+            target: Optional[np.ndarray] = None,
+            n_neighbours: Optional[int] = 4,
+            leafsize: Optional[int] = 16,
+            n_jobs: Optional[int] = -1
+    ):
+        """
+        Builds a new ``LUTNeighbourGraph`` instance
+
+        :param source:
+            RTM input parameters of the source LUT of shape
+            (num_source_spectra, num_parameters)
+        :param target:
+            RTM input parameters of the target LUT of shape
+            (num_target_spectra, num_parameters). The source LUT is used
+            if not provided.
+        :param n_neighbours:
+            number of target rows to link to every source row
+        :param leafsize:
+            number of points at which the tree switches to brute force
+        :param n_jobs:
+            number of workers to use for querying. -1 (default) uses all
+            cores.
+        """
+        source = np.asarray(source, dtype='float64')
+        target = source if target is None else \
+            np.asarray(target, dtype='float64')
+        if source.ndim != 2 or target.ndim != 2 or \
+                source.shape[1] != target.shape[1]:
+            raise ValueError(
+                'Source and target must be of shape (num_spectra, ' +
+                'num_parameters) with the same parameters')
+        if not 0 < n_neighbours <= target.shape[0]:
+            raise ValueError(
+                'The number of neighbours must be between 1 and the size ' +
+                'of the target LUT')
+        # parameters that are constant in the target LUT (e.g., angles)
+        # carry no information
+        std = target.std(axis=0)
+        varying = std > 0
+        mean = target.mean(axis=0)
+        source = (source[:, varying] - mean[varying]) / std[varying]
+        target = (target[:, varying] - mean[varying]) / std[varying]
+        tree = cKDTree(target, leafsize=leafsize)
+        _, neighbours = tree.query(source, k=n_neighbours, workers=n_jobs)
+        self.neighbours = neighbours.reshape(
+            source.shape[0], n_neighbours).astype('int32')
+        self.n_target = target.shape[0]
+
+    @property
+    def n_neighbours(self) -> int:
+        """
+        Number of target rows linked to every source row
+        """
+        return self.neighbours.shape[1]
+
+    def candidates(self, source_idxs: np.ndarray) -> np.ndarray:
+        """
+        Maps solutions in the source LUT to candidate solutions in the
+        target LUT
+
+        :param source_idxs:
+            source LUT indices of shape (n_solutions, ...) such as the
+            output of `inv_img`. Pixels without solutions (masked pixels,
+            see `rtm_inv.core.precision.no_solution`) are passed on.
+        :returns:
+            target LUT indices (int32) of shape
+            (n_solutions * n_neighbours, ...) with -1 where the source
+            index marked a pixel without solution
+        """
+        source_idxs = np.asarray(source_idxs)
+        invalid = is_no_solution(source_idxs)
+        # gather into the final layout (n_solutions, n_neighbours, ...) so
+        # that no intermediate copy of the candidates is created
+        candidates = np.empty(
+            (source_idxs.shape[0], self.n_neighbours) +
+            source_idxs.shape[1:],
+            dtype='int32')
+        safe_idxs = np.where(invalid, 0, source_idxs)
+        for ndx in range(self.n_neighbours):
+            candidates[:, ndx] = self.neighbours[safe_idxs, ndx]
+            candidates[:, ndx][invalid] = -1
+        return candidates.reshape((-1,) + source_idxs.shape[1:])
@@ -0,0 +1,333 @@
+'''
+Columnar storage format of lookup-tables (LUTs) with metadata.
+
+A LUT is stored as a directory (suffix `.lut`) with one `.npy` file per
+column (float32 by default) and a `meta.json` file with the column names
+and a metadata block describing how the LUT was generated (hash of the
+LUT parameters, sensor, angles, sampling method, constraints, seed, ...).
+Columns are memory-mapped when reading, so selected columns (e.g., only the
+spectral bands or only 'lai') can be read without reading the whole LUT:
+
+    lut = read_lut(fpath_lut, columns='bands')
+
+LUTs pickled as pandas `DataFrame` (legacy format) are still read by
+`read_lut`.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import hashlib
+import json
+import numpy as np
+import os
+import pandas as pd
+import shutil
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+# suffix of LUT directories in the columnar format
+lut_suffix: str = '.lut'
+# name of the file with the column names and metadata
+meta_fname: str = 'meta.json'
+# version of the columnar format
+format_version: int = 1
+
+
+def params_hash(lut_params: Path | pd.DataFrame) -> str:
+    """
+    Hash of LUT parameters (e.g., to record them in the LUT metadata)
+
+    :param lut_params:
+        CSV file or DataFrame with the LUT parameters
+    :returns:
+        SHA-1 hex digest of the CSV content
+    """
+    if isinstance(lut_params, pd.DataFrame):
+        content = lut_params.to_csv(index=False).encode()
+    else:
+        with open(lut_params, 'rb') as src:
+            content = src.read()
+    return hashlib.sha1(content).hexdigest()
+
+
+def is_band(column: str) -> bool:
+    """
+    Checks if a LUT column holds a spectral band (B01, B02, etc.)
+    """
+    return str(column).startswith('B')
+
+
+def _to_json(obj: Any) -> Any:
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    return str(obj)
+
+
+def write_lut(
+        lut: pd.DataFrame,
+        fpath_lut: Path,
+        metadata: Optional[Dict[str, Any]] = None,
+        dtype: Optional[str] = 'float32',
+        overwrite: Optional[bool] = False
+) -> Path:
+    """
+    Writes a LUT in the columnar format. The LUT is written to a temporary
+    directory first, so interrupted runs do not leave partial LUTs behind.
+
+    :param lut:
+        LUT with spectral bands and traits (numeric columns only)
+    :param fpath_lut:
+        directory where to write the LUT to (`.lut` is appended if the
+        suffix is missing)
+    :param metadata:
+        metadata to store with the LUT. Updates the metadata recorded in
+        `lut.attrs['lut_metadata']` when generating the LUT (see
+        `rtm_inv.core.lookup_table.simulate_from_lut`).
+    :param dtype:
+        floating point type of the columns on disk (float32 by default)
+    :param overwrite:
+        if False (default), writing to an existing LUT raises an error
+    :returns:
+        path of the LUT directory
+    """
+    fpath_lut = Path(fpath_lut)
+    if fpath_lut.suffix != lut_suffix:
+        fpath_lut = fpath_lut.with_name(fpath_lut.name + lut_suffix)
+    non_numeric = lut.select_dtypes(exclude='number').columns.tolist()
+    if non_numeric:
+        raise ValueError(f'Columns {non_numeric} are not numeric')
+    if fpath_lut.exists():
+        if not overwrite:
+            raise ValueError(f'{fpath_lut} already exists')
+        if not fpath_lut.joinpath(meta_fname).exists():
+            raise ValueError(f'{fpath_lut} is not a LUT in columnar format')
+
+    lut_metadata = dict(lut.attrs.get('lut_metadata', {}))
+    lut_metadata.update(metadata or {})
+    columns = [str(x) for x in lut.columns]
+    meta = {
+        'format_version': format_version,
+        'n_rows': int(lut.shape[0]),
+        'columns': columns,
+        'dtype': str(np.dtype(dtype)),
+        'metadata': lut_metadata
+    }
+    fpath_tmp = fpath_lut.with_name(fpath_lut.name + '.tmp')
+    if fpath_tmp.exists():
+        shutil.rmtree(fpath_tmp)
+    fpath_tmp.mkdir(parents=True)
+    for idx, column in enumerate(lut.columns):
+        np.save(
+            fpath_tmp.joinpath(f'{idx:04d}.npy'),
+            np.ascontiguousarray(lut[column].values, dtype=dtype)
+        )
+    with open(fpath_tmp.joinpath(meta_fname), 'w+') as dst:
+        json.dump(meta, dst, indent=2, default=_to_json)
+    if fpath_lut.exists():
+        shutil.rmtree(fpath_lut)
+    os.replace(fpath_tmp, fpath_lut)
+    return fpath_lut
+
+
+class ColumnarLUT(object):
+    """
+    LUT stored in the columnar format.
+
+    :attrib fpath_lut:
+        directory with the LUT
+    :attrib columns:
+        names of the LUT columns
+    :attrib n_rows:
+        number of LUT rows (spectra)
+    :attrib dtype:
+        data type of the columns on disk
+    :attrib metadata:
+        metadata stored with the LUT
+    """
+    def __init__(self, fpath_lut: Path):
+        """
+        Opens a LUT in the columnar format
+
+        :param fpath_lut:
+            directory with the LUT
+        """
+        self.fpath_lut = Path(fpath_lut)
+        fpath_meta = self.fpath_lut.joinpath(meta_fname)
+        if not fpath_meta.exists():
+            raise FileNotFoundError(f'No columnar LUT found in {fpath_lut}')
+        with open(fpath_meta, 'r') as src:
+            meta = json.load(src)
+        if meta['format_version'] > format_version:
+            raise ValueError(
+                f'LUT format version {meta["format_version"]} is not ' +
+                'supported')
+        self.columns = meta['columns']
+        self.n_rows = meta['n_rows']
+        self.dtype = meta['dtype']
+        self.metadata = meta['metadata']
+
+    @property
+    def band_names(self) -> List[str]:
+        """
+        Names of the spectral bands in the LUT
+        """
+        return [x for x in self.columns if is_band(x)]
+
+    @property
+    def trait_names(self) -> List[str]:
+        """
+        Names of the traits (all columns but the spectral bands)
+        """
+        return [x for x in self.columns if not is_band(x)]
+
+    def select(self, columns: Optional[List[str] | str] = None) -> List[str]:
+        """
+        Resolves a column selection
+
+        :param columns:
+            list of column names, 'bands' (spectral bands), 'traits' or
+            None (all columns)
+        :returns:
+            list of column names
+        """
+        if columns is None:
+            return list(self.columns)
+        if columns == 'bands':
+            return self.band_names
+        if columns == 'traits':
+            return self.trait_names
+        if isinstance(columns, str):
+            columns = [columns]
+        missing = [x for x in columns if x not in self.columns]
+        if missing:
+            raise ValueError(f'Columns {missing} are not in the LUT')
+        return list(columns)
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        Memory-maps a single column read-only
+
+        :param name:
+            name of the column
+        :returns:
+            values of the column of shape (n_rows,)
+        """
+        idx = self.columns.index(self.select(name)[0])
+        return np.load(
+            self.fpath_lut.joinpath(f'{idx:04d}.npy'), mmap_mode='r')
+
+    def values(
+            self,
+            columns: Optional[List[str] | str] = None,
+            dtype: Optional[str] = None
+    ) -> np.ndarray:
+        """
+        Reads selected columns into an array
+
+        :param columns:
+            column selection (see `select`)
+        :param dtype:
+            data type of the array (data type on disk by default)
+        :returns:
+            values of shape (n_rows, n_columns)
+        """
+        columns = self.select(columns)
+        out = np.empty((self.n_rows, len(columns)), dtype=dtype or self.dtype)
+        for idx, column in enumerate(columns):
+            out[:, idx] = self.column(column)
+        return out
+
+    def to_dataframe(
+            self,
+            columns: Optional[List[str] | str] = None
+    ) -> pd.DataFrame:
+        """
+        Reads selected columns into a DataFrame. The metadata is available
+        as `attrs['lut_metadata']`.
+
+        :param columns:
+            column selection (see `select`)
+        :returns:
+            LUT as `DataFrame`
+        """
+        columns = self.select(columns)
+        lut = pd.DataFrame(self.values(columns), columns=columns)
+        lut.attrs['lut_metadata'] = dict(self.metadata)
+        return lut
+
+
+def is_columnar_lut(fpath_lut: Path) -> bool:
+    """
+    Checks if a path is a LUT in the columnar format
+    """
+    return Path(fpath_lut).joinpath(meta_fname).exists()
+
+
+def read_lut(
+        fpath_lut: Path,
+        columns: Optional[List[str] | str] = None
+) -> pd.DataFrame:
+    """
+    Reads a LUT in the columnar or the legacy (pickled DataFrame) format
+
+    :param fpath_lut:
+        LUT directory or pickle file
+    :param columns:
+        list of column names, 'bands' (spectral bands), 'traits' or None
+        (all columns)
+    :returns:
+        LUT as `DataFrame`
+    """
+    if is_columnar_lut(fpath_lut):
+        return ColumnarLUT(fpath_lut).to_dataframe(columns)
+    lut = pd.read_pickle(fpath_lut)
+    if columns is None:
+        return lut
+    if columns == 'bands':
+        columns = [x for x in lut.columns if is_band(x)]
+    elif columns == 'traits':
+        columns = [x for x in lut.columns if not is_band(x)]
+    elif isinstance(columns, str):
+        columns = [columns]
+    return lut[columns]
+
+
+def find_luts(directory: Path, pattern: Optional[str] = '*') -> List[Path]:
+    """
+    Finds LUTs in the columnar and the legacy (`.pkl`) format in a
+    directory. Legacy LUTs are skipped if a columnar LUT of the same name
+    exists, and so are references to LUTs evicted from the LUT cache (see
+    `rtm_inv.core.lut_cache.LUTCache`).
+
+    :param directory:
+        directory to search
+    :param pattern:
+        glob pattern of the LUT names without suffix
+    :returns:
+        list of LUT paths
+    """
+    directory = Path(directory)
+    fpaths = sorted(
+        x for x in directory.glob(pattern + lut_suffix) if x.exists())
+    stems = {x.stem for x in fpaths}
+    fpaths += sorted(
+        x for x in directory.glob(pattern + '.pkl') if x.stem not in stems)
+    return fpaths
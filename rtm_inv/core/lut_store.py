@@ -0,0 +1,233 @@
+'''
+Sharded, out-of-core storage of lookup-tables (LUTs) too large to be held
+in memory as a whole (e.g., all angle buckets of a season). Spectra and
+trait values are written shard by shard as `.npy` files that are memory
+mapped when searching so that only one shard has to be read at a time.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import json
+import numpy as np
+import pandas as pd
+
+from pathlib import Path
+from typing import Iterator, List, Optional, Tuple
+
+# name of the file with the store's metadata
+meta_fname: str = 'meta.json'
+
+
+class ShardedLUT(object):
+    """
+    LUT stored as a sequence of shards on disk.
+
+    LUT rows are indexed globally across shards, i.e., row `i` of shard `s`
+    has the index `offsets[s] + i`.
+
+    :attrib store_dir:
+        directory with the shards and metadata
+    :attrib band_names:
+        names of the spectral bands (columns of the spectra)
+    :attrib trait_names:
+        names of the traits stored alongside the spectra
+    :attrib shard_sizes:
+        number of LUT rows per shard
+    """
+    def __init__(self, store_dir: Path):
+        """
+        Opens an existing ``ShardedLUT``
+
+        :param store_dir:
+            directory with the shards and metadata
+        """
+        self.store_dir = Path(store_dir)
+        fpath_meta = self.store_dir.joinpath(meta_fname)
+        if not fpath_meta.exists():
+            raise FileNotFoundError(f'No sharded LUT found in {store_dir}')
+        with open(fpath_meta, 'r') as src:
+            meta = json.load(src)
+        self.band_names = meta['band_names']
+        self.trait_names = meta['trait_names']
+        self.shard_sizes = meta['shard_sizes']
+        self.dtype = meta['dtype']
+
+    @classmethod
+    def create(
+            cls,
+            store_dir: Path,
+            band_names: List[str],
+            trait_names: List[str],
+            dtype: Optional[str] = 'float64'
+    ) -> ShardedLUT:
+        """
+        Creates a new, empty ``ShardedLUT``. Shards are added using
+        `append`.
+
+        :param store_dir:
+            directory where to write the shards to. Must not contain a
+            sharded LUT already.
+        :param band_names:
+            names of the spectral bands
+        :param trait_names:
+            names of the traits to store alongside the spectra
+        :param dtype:
+            data type of the spectra and trait values on disk
+        :returns:
+            empty ``ShardedLUT`` instance
+        """
+        store_dir = Path(store_dir)
+        store_dir.mkdir(parents=True, exist_ok=True)
+        if store_dir.joinpath(meta_fname).exists():
+            raise ValueError(f'{store_dir} already contains a sharded LUT')
+        meta = {
+            'band_names': list(band_names),
+            'trait_names': list(trait_names),
+            'shard_sizes': [],
+            'dtype': dtype
+        }
+        with open(store_dir.joinpath(meta_fname), 'w+') as dst:
+            json.dump(meta, dst)
+        return cls(store_dir)
+
+    @classmethod
+    def from_lut(
+            cls,
+            lut: pd.DataFrame,
+            store_dir: Path,
+            band_names: List[str],
+            trait_names: List[str],
+            shard_size: Optional[int] = 1_000_000,
+            dtype: Optional[str] = 'float64'
+    ) -> ShardedLUT:
+        """
+        Writes a LUT held in memory into a new ``ShardedLUT``
+
+        :param lut:
+            LUT with spectra and traits
+        :param store_dir:
+            directory where to write the shards to
+        :param band_names:
+            names of the spectral bands in `lut`
+        :param trait_names:
+            names of the traits in `lut` to store alongside the spectra
+        :param shard_size:
+            maximum number of LUT rows per shard
+        :param dtype:
+            data type of the spectra and trait values on disk
+        :returns:
+            ``ShardedLUT`` instance
+        """
+        if shard_size <= 0:
+            raise ValueError('Shard size must be > 0')
+        store = cls.create(
+            store_dir=store_dir,
+            band_names=band_names,
+            trait_names=trait_names,
+            dtype=dtype
+        )
+        for start in range(0, lut.shape[0], shard_size):
+            store.append(lut.iloc[start:start + shard_size])
+        return store
+
+    def _fpath_shard(self, shard: int, kind: str) -> Path:
+        return self.store_dir.joinpath(f'shard_{shard:05d}_{kind}.npy')
+
+    def append(self, lut: pd.DataFrame) -> None:
+        """
+        Appends a chunk of LUT rows (e.g., a single forward run) as new
+        shard
+
+        :param lut:
+            LUT rows with the spectral bands and traits of the store
+        """
+        shard = len(self.shard_sizes)
+        np.save(
+            self._fpath_shard(shard, 'spectra'),
+            np.ascontiguousarray(lut[self.band_names].values, dtype=self.dtype)
+        )
+        np.save(
+            self._fpath_shard(shard, 'traits'),
+            np.ascontiguousarray(
+                lut[self.trait_names].values, dtype=self.dtype)
+        )
+        self.shard_sizes.append(int(lut.shape[0]))
+        meta = {
+            'band_names': self.band_names,
+            'trait_names': self.trait_names,
+            'shard_sizes': self.shard_sizes,
+            'dtype': self.dtype
+        }
+        with open(self.store_dir.joinpath(meta_fname), 'w+') as dst:
+            json.dump(meta, dst)
+
+    @property
+    def n_shards(self) -> int:
+        """
+        Number of shards in the store
+        """
+        return len(self.shard_sizes)
+
+    @property
+    def offsets(self) -> np.ndarray:
+        """
+        Global index of the first row of every shard (plus the total
+        number of rows as last element)
+        """
+        return np.cumsum([0] + self.shard_sizes)
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        """
+        Shape of the spectra in the store (num_spectra, num_bands)
+        """
+        return int(sum(self.shard_sizes)), len(self.band_names)
+
+    def shards(self) -> Iterator[Tuple[int, np.ndarray]]:
+        """
+        Iterates over the spectra of the shards. Every shard is memory
+        mapped so it is read from disk when it is accessed.
+
+        :returns:
+            iterator over tuples of the global index of the first row of
+            the shard and the spectra of the shard of shape
+            (shard_size, num_bands)
+        """
+        for shard, offset in enumerate(self.offsets[:-1]):
+            yield int(offset), np.load(
+                self._fpath_shard(shard, 'spectra'), mmap_mode='r')
+
+    def trait_values(self, traits: List[str]) -> np.ndarray:
+        """
+        Reads the values of selected traits of all LUT rows in the order
+        of the global LUT indices
+
+        :param traits:
+            names of the traits to read
+        :returns:
+            trait values of shape (num_spectra, n_traits)
+        """
+        missing = set(traits) - set(self.trait_names)
+        if missing:
+            raise ValueError(f'Traits {missing} are not in the sharded LUT')
+        cols = [self.trait_names.index(x) for x in traits]
+        trait_values = np.empty((self.shape[0], len(traits)), dtype=self.dtype)
+        for shard, offset in enumerate(self.offsets[:-1]):
+            vals = np.load(self._fpath_shard(shard, 'traits'), mmap_mode='r')
+            trait_values[offset:offset + vals.shape[0], :] = vals[:, cols]
+        return trait_values
@@ -0,0 +1,160 @@
+'''
+Precision policy of the inversion outputs. The policy sets the data types
+of the image-shaped arrays returned by the inversion (LUT indices, cost
+function values and trait values) and is configured in one place with
+`set_precision_policy`, e.g.
+
+    set_precision_policy(PrecisionPolicy(cost_dtype='float16'))
+
+LUT indices are stored in the smallest unsigned integer type able to hold
+all indices of the LUT (uint16 for LUTs with up to 65535 rows). Pixels
+without solutions (e.g., masked pixels) are marked by the largest value of
+the type (see `no_solution`) instead of -1.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import numpy as np
+
+from typing import Optional
+
+# data types supported for the cost function values and trait values
+cost_dtypes = ['float16', 'float32']
+trait_dtypes = ['float32', 'float64']
+
+
+class PrecisionPolicy(object):
+    """
+    Data types of the inversion outputs.
+
+    :attrib compact_indices:
+        if True (default), LUT indices are stored as uint16 or uint32
+        depending on the LUT size. Otherwise, int32 with -1 for pixels
+        without solutions is used.
+    :attrib cost_dtype:
+        data type of the cost function values (float32 by default)
+    :attrib trait_dtype:
+        data type of the retrieved trait values and their quantiles
+        (float32 by default)
+    """
+    def __init__(
+            self,
+            compact_indices: Optional[bool] = True,
+            cost_dtype: Optional[str] = 'float32',
+            trait_dtype: Optional[str] = 'float32'
+    ):
+        if cost_dtype not in cost_dtypes:
+            raise ValueError(
+                f'Cost function values must be one of {cost_dtypes}')
+        if trait_dtype not in trait_dtypes:
+            raise ValueError(f'Trait values must be one of {trait_dtypes}')
+        self.compact_indices = compact_indices
+        self.cost_dtype = np.dtype(cost_dtype)
+        self.trait_dtype = np.dtype(trait_dtype)
+
+    def __repr__(self) -> str:
+        return f'PrecisionPolicy(compact_indices={self.compact_indices}, ' + \
+            f'cost_dtype={self.cost_dtype}, trait_dtype={self.trait_dtype})'
+
+    def index_dtype(self, lut_size: int) -> np.dtype:
+        """
+        Data type of the indices into a LUT
+
+        :param lut_size:
+            number of rows of the LUT
+        :returns:
+            smallest unsigned integer type that holds all indices and the
+            `no_solution` marker or int32 if `compact_indices` is False
+        """
+        if not self.compact_indices:
+            return np.dtype('int32')
+        for dtype in ['uint16', 'uint32']:
+            # the largest value is reserved for `no_solution`
+            if lut_size <= np.iinfo(dtype).max:
+                return np.dtype(dtype)
+        return np.dtype('int64')
+
+
+# policy used by the inversion functions
+policy: PrecisionPolicy = PrecisionPolicy()
+
+
+def set_precision_policy(precision_policy: PrecisionPolicy) -> None:
+    """
+    Sets the precision policy used by the inversion functions
+
+    :param precision_policy:
+        ``PrecisionPolicy`` to use
+    """
+    global policy
+    policy = precision_policy
+
+
+def get_precision_policy() -> PrecisionPolicy:
+    """
+    Returns the precision policy used by the inversion functions
+    """
+    return policy
+
+
+def no_solution(dtype: np.dtype) -> int:
+    """
+    Marker of pixels without solutions in arrays of LUT indices
+
+    :param dtype:
+        data type of the LUT indices
+    :returns:
+        -1 for signed and the largest value for unsigned integer types
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        return int(np.iinfo(dtype).max)
+    return -1
+
+
+def is_no_solution(lut_idxs: np.ndarray) -> np.ndarray:
+    """
+    Marks the entries of LUT indices without solution
+
+    :param lut_idxs:
+        LUT indices of any data type
+    :returns:
+        boolean array of the shape of `lut_idxs`
+    """
+    lut_idxs = np.asarray(lut_idxs)
+    if lut_idxs.dtype.kind == 'u':
+        return lut_idxs == no_solution(lut_idxs.dtype)
+    return lut_idxs < 0
+
+
+def signed_indices(lut_idxs: np.ndarray) -> np.ndarray:
+    """
+    Converts LUT indices of any data type to a signed integer type with -1
+    for entries without solution (as used internally by the LUT search)
+
+    :param lut_idxs:
+        LUT indices of any data type
+    :returns:
+        LUT indices of a signed integer type (int64 for unsigned input)
+    """
+    lut_idxs = np.asarray(lut_idxs)
+    if lut_idxs.dtype.kind != 'u':
+        return lut_idxs
+    signed = lut_idxs.astype('int64')
+    signed[lut_idxs == no_solution(lut_idxs.dtype)] = -1
+    return signed
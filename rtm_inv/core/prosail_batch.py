@@ -0,0 +1,683 @@
+'''
+Batched ProSAIL (Prospect-5 or Prospect-D and 4SAIL) forward model.
+
+Evaluates the directional reflectance factor of N parameter vectors at
+once as (N, 2101) arrays between 400 and 2500 nm instead of calling
+`prosail.run_prosail` once per parameter vector. Spectral libraries are
+taken from the `prosail` package and the computations follow its
+implementation term by term (including the order of summation), so
+results agree with `prosail.run_prosail` to floating point precision.
+`run_prosail_batch_angles` simulates a batch at several sun-view
+geometries running PROSPECT only once.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+from prosail import spectral_lib
+from scipy.special import expi
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+# wavelengths of the ProSAIL output (nm)
+wavelengths = np.arange(400, 2501)
+# number of leaf inclination angles of the leaf angle distribution
+n_leaf_angles: int = 18
+# default values of optional ProSAIL parameters
+defaults: Dict[str, float] = {
+    'ant': 0.,
+    'alpha': 40.,
+    'typelidf': 2.,
+    'lidfb': 0.
+}
+
+
+def _calctav(alpha: float, nr: np.ndarray) -> np.ndarray:
+    """
+    Transmissivity of a dielectric plane surface averaged over all
+    directions of incidence up to `alpha` (Stern, 1964; Allen, 1973)
+    """
+    n2 = nr * nr
+    npx = n2 + 1
+    nm = n2 - 1
+    a = (nr + 1) * (nr + 1) / 2.
+    k = -(n2 - 1) * (n2 - 1) / 4.
+    sa = np.sin(np.deg2rad(alpha))
+
+    if alpha != 90:
+        b1 = np.sqrt((sa * sa - npx / 2) * (sa * sa - npx / 2) + k)
+    else:
+        b1 = 0.
+    b2 = sa * sa - npx / 2
+    b = b1 - b2
+    b3 = b**3
+    a3 = a**3
+    ts = (k**2 / (6 * b3) + k / b - b / 2) - (k**2. / (6 * a3) + k / a - a / 2)
+
+    tp1 = -2 * n2 * (b - a) / (npx**2)
+    tp2 = -2 * n2 * npx * np.log(b / a) / (nm**2)
+    tp3 = n2 * (1 / b - 1 / a) / 2
+    tp4 = 16 * n2**2 * (n2**2 + 1) * np.log(
+        (2 * npx * b - nm**2) / (2 * npx * a - nm**2)) / (npx**3 * nm**2)
+    tp5 = 16 * n2**3 * (
+        1. / (2 * npx * b - nm**2) - 1 / (2 * npx * a - nm**2)) / (npx**3)
+    tp = tp1 + tp2 + tp3 + tp4 + tp5
+    return (ts + tp) / (2 * sa**2)
+
+
+def prospect_batch(
+        n: np.ndarray,
+        cab: np.ndarray,
+        car: np.ndarray,
+        cbrown: np.ndarray,
+        cw: np.ndarray,
+        cm: np.ndarray,
+        ant: np.ndarray,
+        alpha: np.ndarray,
+        prospect_version: Optional[str] = '5'
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Leaf reflectance and transmittance of N leaves (Prospect-5 or D)
+
+    :param n:
+        leaf structure parameters of shape (N,)
+    :param cab:
+        leaf chlorophyll contents
+    :param car:
+        leaf carotenoid contents
+    :param cbrown:
+        senescent pigment contents
+    :param cw:
+        equivalent water thicknesses
+    :param cm:
+        leaf dry matter contents
+    :param ant:
+        leaf anthocyanin contents (ignored by Prospect-5)
+    :param alpha:
+        maximum incidence angles (deg) at the leaf surface
+    :param prospect_version:
+        '5' (default) or 'D'
+    :returns:
+        tuple with leaf reflectance and transmittance of shape (N, 2101)
+    """
+    if prospect_version == '5':
+        lib = spectral_lib.prospect5
+        kant = np.zeros_like(lib.km)
+        ant = np.zeros_like(ant)
+    elif prospect_version.upper() == 'D':
+        lib = spectral_lib.prospectd
+        kant = lib.kant
+    else:
+        raise ValueError('prospect_version can only be 5 or D!')
+    n, cab, car, cbrown, cw, cm, ant = [
+        np.asarray(x, dtype='float64')[:, np.newaxis]
+        for x in [n, cab, car, cbrown, cw, cm, ant]
+    ]
+
+    kall = (cab * lib.kab + car * lib.kcar + ant * kant +
+            cbrown * lib.kbrown + cw * lib.kw + cm * lib.km) / n
+    j = kall > 0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t1 = (1 - kall) * np.exp(-kall)
+        t2 = kall**2 * (-expi(-kall))
+    tau = np.ones_like(t1)
+    tau[j] = t1[j] + t2[j]
+
+    # reflectance and transmittance of one layer (Allen et al., 1969). The
+    # interface terms only depend on the refractive index and alpha
+    nr = lib.nr
+    t12 = _calctav(90, nr)
+    r12 = 1. - t12
+    t21 = t12 / (nr * nr)
+    r21 = 1 - t21
+    alpha = np.asarray(alpha, dtype='float64')
+    talf = np.empty_like(tau)
+    for value in np.unique(alpha):
+        talf[alpha == value] = _calctav(value, nr)
+    ralf = 1.0 - talf
+
+    denom = 1. - r21 * r21 * tau * tau
+    Ta = talf * tau * t21 / denom
+    Ra = ralf + r21 * tau * Ta
+    t = t12 * tau * t21 / denom
+    r = r12 + r21 * tau * t
+
+    # reflectance and transmittance of N layers (Stokes, 1862)
+    D = np.sqrt((1 + r + t) * (1 + r - t) * (1. - r + t) * (1. - r - t))
+    rq = r * r
+    tq = t * t
+    a = (1 + rq - tq + D) / (2 * r)
+    b = (1 - rq + tq + D) / (2 * t)
+
+    bNm1 = np.power(b, n - 1)
+    bN2 = bNm1 * bNm1
+    a2 = a * a
+    denom = a2 * bN2 - 1
+    Rsub = a * (bN2 - 1) / denom
+    Tsub = bNm1 * (a2 - 1) / denom
+
+    # case of zero absorption
+    j = r + t >= 1.
+    n_full = np.broadcast_to(n, j.shape)
+    Tsub[j] = t[j] / (t[j] + (1 - t[j]) * (n_full[j] - 1))
+    Rsub[j] = 1 - Tsub[j]
+
+    # combine the top layer with the next N-1 layers
+    denom = 1 - Rsub * r
+    tran = Ta * Tsub / denom
+    refl = Ra + Ta * Rsub * t / denom
+    return refl, tran
+
+
+def _campbell(alpha: np.ndarray) -> np.ndarray:
+    """
+    Ellipsoidal leaf angle distribution (Campbell, 1990) for N mean leaf
+    angles (deg) of shape (N,). Returns shape (N, n_leaf_angles).
+    """
+    excent = np.exp(
+        -1.6184e-5 * alpha**3. + 2.1145e-3 * alpha**2. -
+        1.2390e-1 * alpha + 3.2491)
+    freq = np.zeros((alpha.size, n_leaf_angles))
+    step = 90.0 / n_leaf_angles
+    alph = excent / np.sqrt(np.abs(1. - excent**2.))
+    alph2 = alph**2.
+    for i in range(n_leaf_angles):
+        tl1 = np.radians(i * step)
+        tl2 = np.radians((i + 1.) * step)
+        x1 = excent / (np.sqrt(1. + excent**2. * np.tan(tl1)**2.))
+        x2 = excent / (np.sqrt(1. + excent**2. * np.tan(tl2)**2.))
+        x12 = x1**2.
+        x22 = x2**2.
+        with np.errstate(divide='ignore', invalid='ignore'):
+            alpx1 = np.sqrt(alph2 + x12)
+            alpx2 = np.sqrt(alph2 + x22)
+            dum = x1 * alpx1 + alph2 * np.log(x1 + alpx1)
+            freq_gt = np.abs(dum - (x2 * alpx2 + alph2 * np.log(x2 + alpx2)))
+            almx1 = np.sqrt(alph2 - x12)
+            almx2 = np.sqrt(alph2 - x22)
+            dum = x1 * almx1 + alph2 * np.arcsin(x1 / alph)
+            freq_lt = np.abs(
+                dum - (x2 * almx2 + alph2 * np.arcsin(x2 / alph)))
+        freq[:, i] = np.where(
+            excent == 1.,
+            abs(np.cos(tl1) - np.cos(tl2)),
+            np.where(excent > 1., freq_gt, freq_lt)
+        )
+    # sum sequentially as the reference implementation does
+    sum0 = np.zeros(alpha.size)
+    for i in range(n_leaf_angles):
+        sum0 += freq[:, i]
+    return freq / sum0[:, np.newaxis]
+
+
+def _verhoef_bimodal(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Bimodal leaf angle distribution (Verhoef, 1998) for N parameter pairs
+    of shape (N,). Returns shape (N, n_leaf_angles).
+    """
+    step = 90.0 / n_leaf_angles
+    lidf = np.zeros((a.size, n_leaf_angles))
+    freq = np.ones(a.size)
+    angles = (np.arange(n_leaf_angles) * step)[::-1]
+    eps = 1e-8
+    for i, angle in enumerate(angles):
+        tl1 = np.radians(angle)
+        # fixed-point iteration, stopped per parameter pair on convergence
+        x = np.full(a.size, 2.0 * tl1)
+        p = 2.0 * tl1
+        y = np.zeros(a.size)
+        active = a <= 1.0
+        while active.any():
+            y_new = a * np.sin(x) + .5 * b * np.sin(2. * x)
+            dx = .5 * (y_new - x + p)
+            y = np.where(active, y_new, y)
+            x = np.where(active, x + dx, x)
+            active &= np.abs(dx) >= eps
+        f = np.where(a > 1.0, 1.0 - np.cos(tl1), (2. * y + p) / np.pi)
+        lidf[:, i] = freq - f
+        freq = f
+    return lidf[:, ::-1]
+
+
+def _volscatt(
+        tts: np.ndarray,
+        tto: np.ndarray,
+        psi: np.ndarray,
+        ttl: float
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Volume scattering functions and interception coefficients for a leaf
+    inclination angle `ttl` and N geometries of shape (N,)
+    """
+    cts = np.cos(np.radians(tts))
+    cto = np.cos(np.radians(tto))
+    sts = np.sin(np.radians(tts))
+    sto = np.sin(np.radians(tto))
+    cospsi = np.cos(np.radians(psi))
+    psir = np.radians(psi)
+    cttl = np.cos(np.radians(ttl))
+    sttl = np.sin(np.radians(ttl))
+    cs = cttl * cts
+    co = cttl * cto
+    ss = sttl * sts
+    so = sttl * sto
+    with np.errstate(divide='ignore', invalid='ignore'):
+        cosbts = np.where(np.abs(ss) > 1e-6, -cs / ss, 5.)
+        cosbto = np.where(np.abs(so) > 1e-6, -co / so, 5.)
+        bts = np.where(np.abs(cosbts) < 1.0, np.arccos(cosbts), np.pi)
+        ds = np.where(np.abs(cosbts) < 1.0, ss, cs)
+    chi_s = 2. / np.pi * ((bts - np.pi * 0.5) * cs + np.sin(bts) * ss)
+    with np.errstate(invalid='ignore'):
+        bto = np.where(
+            np.abs(cosbto) < 1.0, np.arccos(cosbto),
+            np.where(tto < 90., np.pi, 0.0))
+    do_ = np.where(
+        np.abs(cosbto) < 1.0, so, np.where(tto < 90., co, -co))
+    chi_o = 2.0 / np.pi * ((bto - np.pi * 0.5) * co + np.sin(bto) * so)
+    btran1 = np.abs(bts - bto)
+    btran2 = np.pi - np.abs(bts + bto - np.pi)
+    bt1 = np.where(psir <= btran1, psir, btran1)
+    bt2 = np.where(
+        psir <= btran1, btran1, np.where(psir <= btran2, psir, btran2))
+    bt3 = np.where(
+        psir <= btran1, btran2, np.where(psir <= btran2, btran2, psir))
+    t1 = 2. * cs * co + ss * so * cospsi
+    t2 = np.where(
+        bt2 > 0.,
+        np.sin(bt2) * (2. * ds * do_ + ss * so * np.cos(bt1) * np.cos(bt3)),
+        0.
+    )
+    denom = 2. * np.pi**2
+    frho = np.maximum(((np.pi - bt2) * t1 + t2) / denom, 0.)
+    ftau = np.maximum((-bt2 * t1 + t2) / denom, 0.)
+    return chi_s, chi_o, frho, ftau
+
+
+def _weighted_sum_over_lidf(
+        lidf: np.ndarray,
+        tts: np.ndarray,
+        tto: np.ndarray,
+        psi: np.ndarray
+) -> Tuple[np.ndarray, ...]:
+    """
+    Extinction and scattering coefficients of N canopies weighted by their
+    leaf angle distributions of shape (N, n_leaf_angles)
+    """
+    ks, ko, bf, sob, sof = [np.zeros(tts.size) for _ in range(5)]
+    cts = np.cos(np.radians(tts))
+    cto = np.cos(np.radians(tto))
+    ctscto = cts * cto
+    angle_step = float(90.0 / n_leaf_angles)
+    litab = np.arange(n_leaf_angles) * angle_step + (angle_step * 0.5)
+    for i, ili in enumerate(litab):
+        ttl = 1. * ili
+        cttl = np.cos(np.radians(ttl))
+        chi_s, chi_o, frho, ftau = _volscatt(tts, tto, psi, ttl)
+        ksli = chi_s / cts
+        koli = chi_o / cto
+        sobli = frho * np.pi / ctscto
+        sofli = ftau * np.pi / ctscto
+        bfli = cttl**2.
+        ks += ksli * lidf[:, i]
+        ko += koli * lidf[:, i]
+        bf += bfli * lidf[:, i]
+        sob += sobli * lidf[:, i]
+        sof += sofli * lidf[:, i]
+    return ks, ko, bf, sob, sof
+
+
+def _hotspot(
+        alf: np.ndarray,
+        lai: np.ndarray,
+        ko: np.ndarray,
+        ks: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Hotspot effect integrated by the exponential Simpson method in 20
+    steps for N canopies
+    """
+    fhot = lai * np.sqrt(ko * ks)
+    x1 = np.zeros(alf.size)
+    y1 = np.zeros(alf.size)
+    f1 = np.ones(alf.size)
+    fint = (1. - np.exp(-alf)) * .05
+    sumint = np.zeros(alf.size)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for istep in range(1, 21):
+            if istep < 20:
+                x2 = -np.log(1. - istep * fint) / alf
+            else:
+                x2 = np.ones(alf.size)
+            y2 = -(ko + ks) * lai * x2 + fhot * (1. - np.exp(-alf * x2)) / alf
+            f2 = np.exp(y2)
+            sumint = sumint + (f2 - f1) * (x2 - x1) / (y2 - y1)
+            x1 = x2
+            y1 = y2
+            f1 = f2
+    sumint[np.isnan(sumint)] = 0.
+    return f1, sumint
+
+
+def _jfunc1(k: np.ndarray, l: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """
+    J1 function with avoidance of the singularity problem
+    """
+    del_ = (k - l) * t
+    with np.errstate(divide='ignore', invalid='ignore'):
+        far = (np.exp(-l * t) - np.exp(-k * t)) / (k - l)
+    near = 0.5 * t * (np.exp(-k * t) + np.exp(-l * t)) * \
+        (1. - (del_**2.) / 12.)
+    return np.where(np.abs(del_) > 1e-3, far, near)
+
+
+def _jfunc2(k: np.ndarray, l: np.ndarray, t: np.ndarray) -> np.ndarray:
+    """
+    J2 function
+    """
+    return (1. - np.exp(-(k + l) * t)) / (k + l)
+
+
+def foursail_batch(
+        rho: np.ndarray,
+        tau: np.ndarray,
+        lidfa: np.ndarray,
+        lidfb: np.ndarray,
+        typelidf: np.ndarray,
+        lai: np.ndarray,
+        hspot: np.ndarray,
+        tts: np.ndarray,
+        tto: np.ndarray,
+        psi: np.ndarray,
+        rsoil: np.ndarray
+) -> np.ndarray:
+    """
+    Bidirectional surface reflectance factor of N canopies (4SAIL)
+
+    :param rho:
+        leaf reflectance of shape (N, 2101)
+    :param tau:
+        leaf transmittance of shape (N, 2101)
+    :param lidfa:
+        leaf angle distribution parameters a of shape (N,) (mean leaf angle
+        for the ellipsoidal distribution)
+    :param lidfb:
+        leaf angle distribution parameters b (bimodal distribution only)
+    :param typelidf:
+        type of the leaf angle distribution (1: bimodal, 2: ellipsoidal)
+    :param lai:
+        leaf area indices
+    :param hspot:
+        hotspot parameters
+    :param tts:
+        solar zenith angles (deg)
+    :param tto:
+        observer zenith angles (deg)
+    :param psi:
+        relative azimuth angles (deg)
+    :param rsoil:
+        soil reflectance of shape (N, 2101) or (2101,)
+    :returns:
+        surface bidirectional reflectance factor of shape (N, 2101)
+    """
+    n_spectra = rho.shape[0]
+    typelidf = np.asarray(typelidf)
+    if not np.isin(typelidf, [1, 2]).all():
+        raise ValueError(
+            'lidftype can only be 1 (Campbell) or 2 (ellipsoidal)')
+    lidf = np.empty((n_spectra, n_leaf_angles))
+    bimodal = typelidf == 1
+    if bimodal.any():
+        lidf[bimodal] = _verhoef_bimodal(lidfa[bimodal], lidfb[bimodal])
+    if (~bimodal).any():
+        lidf[~bimodal] = _campbell(lidfa[~bimodal])
+
+    # geometric constants
+    tants = np.tan(np.radians(tts))
+    tanto = np.tan(np.radians(tto))
+    cospsi = np.cos(np.radians(psi))
+    dso = np.sqrt(tants**2. + tanto**2. - 2. * tants * tanto * cospsi)
+
+    ks, ko, bf, sob, sof = _weighted_sum_over_lidf(lidf, tts, tto, psi)
+    # hotspot effect (correction 2/(K+k) suggested by F.-M. Breon)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        alf = np.where(hspot > 0., (dso / hspot) * 2. / (ks + ko), 1e36)
+        tsstoo, sumint = _hotspot(alf, lai, ko, ks)
+    tss = np.exp(-ks * lai)
+    too = np.exp(-ko * lai)
+    pure_hotspot = alf == 0.
+    tsstoo = np.where(pure_hotspot, tss, tsstoo)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        sumint = np.where(pure_hotspot, (1. - tss) / (ks * lai), sumint)
+
+    # per canopy scalars as columns to broadcast against the spectra
+    ks, ko, bf, sob, sof, lai, tss, too, tsstoo, sumint = [
+        x[:, np.newaxis]
+        for x in [ks, ko, bf, sob, sof, lai, tss, too, tsstoo, sumint]
+    ]
+    sdb = 0.5 * (ks + bf)
+    sdf = 0.5 * (ks - bf)
+    dob = 0.5 * (ko + bf)
+    dof = 0.5 * (ko - bf)
+    ddb = 0.5 * (1.0 + bf)
+    ddf = 0.5 * (1.0 - bf)
+
+    sigb = ddb * rho + ddf * tau
+    sigf = ddf * rho + ddb * tau
+    sigf[sigf == 0.0] = 1.e-36
+    sigb[sigb == 0.0] = 1.0e-36
+    att = 1. - sigf
+    m = np.sqrt(att**2. - sigb**2.)
+    sb = sdb * rho + sdf * tau
+    sf = sdf * rho + sdb * tau
+    vb = dob * rho + dof * tau
+    vf = dof * rho + dob * tau
+    w = sob * rho + sof * tau
+
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        e1 = np.exp(-m * lai)
+        e2 = e1**2.
+        rinf = (att - m) / sigb
+        rinf2 = rinf**2.
+        re = rinf * e1
+        denom = 1. - rinf2 * e2
+        J1ks = _jfunc1(ks, m, lai)
+        J2ks = _jfunc2(ks, m, lai)
+        J1ko = _jfunc1(ko, m, lai)
+        J2ko = _jfunc2(ko, m, lai)
+        Pss = (sf + sb * rinf) * J1ks
+        Qss = (sf * rinf + sb) * J2ks
+        Pv = (vf + vb * rinf) * J1ko
+        Qv = (vf * rinf + vb) * J2ko
+        rdd = rinf * (1. - e2) / denom
+        tsd = (Pss - re * Qss) / denom
+        tdo = (Pv - re * Qv) / denom
+        rdo = (Qv - re * Pv) / denom
+        z = _jfunc2(ks, ko, lai)
+        g1 = (z - J1ks * too) / (ko + m)
+        g2 = (z - J1ko * tss) / (ks + m)
+        Tv1 = (vf * rinf + vb) * g1
+        Tv2 = (vf + vb * rinf) * g2
+        T1 = Tv1 * (sf + sb * rinf)
+        T2 = Tv2 * (sf * rinf + sb)
+        T3 = (rdo * Qss + tdo * Pss) * rinf
+        # multiple scattering contribution to bidirectional reflectance
+        rsod = (T1 + T2 - T3) / (1. - rinf2)
+        # single scattering contribution
+        rsos = w * lai * sumint
+        rso = rsos + rsod
+
+        # interaction with the soil
+        dn = 1. - rsoil * rdd
+        dn[dn < 1e-36] = 1e-36
+        rsodt = ((tss + tsd) * tdo + (tsd + tss * rsoil * rdd) * too) * \
+            rsoil / dn
+        rsost = rso + tsstoo * rsoil
+        rsot = rsost + rsodt
+
+    # without canopy the soil is seen
+    no_canopy = lai[:, 0] <= 0
+    if no_canopy.any():
+        rsot[no_canopy] = np.broadcast_to(rsoil, rsot.shape)[no_canopy]
+    return rsot
+
+
+def _leaf_and_soil(
+        params: pd.DataFrame,
+        prospect_version: str,
+        rsoil0: Optional[np.ndarray],
+        soil_spectrum1: Optional[np.ndarray],
+        soil_spectrum2: Optional[np.ndarray]
+) -> Tuple[Callable[[str], np.ndarray], np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Parameter lookup, leaf optical properties (PROSPECT) and soil
+    reflectance of a batch of parameter vectors. These do not depend on
+    the sun-view geometry.
+    """
+    def _col(name: str) -> np.ndarray:
+        if name in params.columns:
+            return params[name].values.astype('float64')
+        if name in defaults:
+            return np.full(params.shape[0], defaults[name])
+        raise ValueError(f'ProSAIL parameter {name} is missing')
+
+    if rsoil0 is None:
+        if soil_spectrum1 is None:
+            soil_spectrum1 = spectral_lib.soil.rsoil1
+        if soil_spectrum2 is None:
+            soil_spectrum2 = spectral_lib.soil.rsoil2
+        if len(soil_spectrum1) != wavelengths.size or \
+                len(soil_spectrum2) != wavelengths.size:
+            raise ValueError('Soil spectra must have 2101 values')
+        rsoil = _col('rsoil')[:, np.newaxis]
+        psoil = _col('psoil')[:, np.newaxis]
+        rsoil0 = rsoil * (
+            psoil * soil_spectrum1 + (1. - psoil) * soil_spectrum2)
+
+    refl, trans = prospect_batch(
+        n=_col('n'),
+        cab=_col('cab'),
+        car=_col('car'),
+        cbrown=_col('cbrown'),
+        cw=_col('cw'),
+        cm=_col('cm'),
+        ant=_col('ant'),
+        alpha=_col('alpha'),
+        prospect_version=prospect_version
+    )
+    return _col, refl, trans, np.asarray(rsoil0, dtype='float64')
+
+
+def run_prosail_batch(
+        params: pd.DataFrame,
+        prospect_version: Optional[str] = '5',
+        rsoil0: Optional[np.ndarray] = None,
+        soil_spectrum1: Optional[np.ndarray] = None,
+        soil_spectrum2: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Runs ProSAIL for a batch of parameter vectors. Returns the same
+    directional reflectance factor ('SDR') as `prosail.run_prosail`.
+
+    :param params:
+        ProSAIL parameters (one row per simulation) named as the arguments
+        of `prosail.run_prosail` ('n', 'cab', 'car', 'cbrown', 'cw', 'cm',
+        'lai', 'lidfa', 'hspot', 'tts', 'tto', 'psi' and, unless `rsoil0`
+        is given, 'rsoil' and 'psoil'). 'ant', 'alpha', 'typelidf' and
+        'lidfb' are optional.
+    :param prospect_version:
+        '5' (default) or 'D'
+    :param rsoil0:
+        soil reflectance (2101 values between 400 and 2500 nm) used for
+        all simulations. If not provided, the soil reflectance is
+        rsoil * (psoil * soil_spectrum1 + (1 - psoil) * soil_spectrum2).
+    :param soil_spectrum1:
+        dry soil spectrum (2101 values). Defaults to the `prosail` one.
+    :param soil_spectrum2:
+        wet soil spectrum (2101 values). Defaults to the `prosail` one.
+    :returns:
+        simulated spectra of shape (N, 2101)
+    """
+    _col, refl, trans, rsoil = _leaf_and_soil(
+        params, prospect_version, rsoil0, soil_spectrum1, soil_spectrum2)
+    return foursail_batch(
+        rho=refl,
+        tau=trans,
+        lidfa=_col('lidfa'),
+        lidfb=_col('lidfb'),
+        typelidf=_col('typelidf'),
+        lai=_col('lai'),
+        hspot=_col('hspot'),
+        tts=_col('tts'),
+        tto=_col('tto'),
+        psi=_col('psi'),
+        rsoil=rsoil
+    )
+
+
+def run_prosail_batch_angles(
+        params: pd.DataFrame,
+        angles: np.ndarray,
+        prospect_version: Optional[str] = '5',
+        rsoil0: Optional[np.ndarray] = None,
+        soil_spectrum1: Optional[np.ndarray] = None,
+        soil_spectrum2: Optional[np.ndarray] = None
+) -> Iterator[np.ndarray]:
+    """
+    Runs ProSAIL for a batch of parameter vectors at several sun-view
+    geometries. The leaf optical properties (PROSPECT) and the soil
+    reflectance are computed once for all geometries.
+
+    :param params:
+        ProSAIL parameters (see `run_prosail_batch`). Angles in `params`
+        are ignored.
+    :param angles:
+        solar zenith, observer zenith and relative azimuth angles (deg) of
+        shape (n_angles, 3)
+    :param prospect_version:
+        '5' (default) or 'D'
+    :param rsoil0:
+        soil reflectance (see `run_prosail_batch`)
+    :param soil_spectrum1:
+        dry soil spectrum (see `run_prosail_batch`)
+    :param soil_spectrum2:
+        wet soil spectrum (see `run_prosail_batch`)
+    :returns:
+        iterator over the simulated spectra of shape (N, 2101), one array
+        per sun-view geometry
+    """
+    angles = np.asarray(angles, dtype='float64')
+    if angles.ndim != 2 or angles.shape[1] != 3:
+        raise ValueError('Angles must be of shape (n_angles, 3)')
+    _col, refl, trans, rsoil = _leaf_and_soil(
+        params, prospect_version, rsoil0, soil_spectrum1, soil_spectrum2)
+    canopy = {
+        name: _col(name)
+        for name in ['lidfa', 'lidfb', 'typelidf', 'lai', 'hspot']
+    }
+    ones = np.ones(params.shape[0])
+    for tts, tto, psi in angles:
+        yield foursail_batch(
+            rho=refl,
+            tau=trans,
+            tts=tts * ones,
+            tto=tto * ones,
+            psi=psi * ones,
+            rsoil=rsoil,
+            **canopy
+        )
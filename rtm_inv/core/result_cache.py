@@ -0,0 +1,214 @@
+'''
+Content-addressed disk cache of the solutions of LUT searches. The best
+solutions of an image (LUT indices and cost function values) depend only
+on the LUT spectra, the image, the mask, the cost function and the number
+of solutions. They are stored as `.npy` files named after a hash of these
+inputs, so re-aggregating the solutions with another measure or other
+traits can memory-map them instead of searching the LUT again.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import hashlib
+import numpy as np
+import os
+import uuid
+
+from pathlib import Path
+from typing import Optional, Tuple
+
+from rtm_inv.core.cost_functions import (
+    CostFunction, get_cost_function, registry)
+from rtm_inv.core.lut_index import LUTNeighbourGraph, lut_fingerprint
+from rtm_inv.core.precision import get_precision_policy
+
+
+def _update_digest(digest, arr: np.ndarray) -> None:
+    """
+    Adds the shape, data type and content of an array to a hash
+    """
+    arr = np.ascontiguousarray(arr)
+    digest.update(f'{arr.shape}{arr.dtype.str}'.encode())
+    digest.update(memoryview(arr).cast('B'))
+
+
+class SolutionCache(object):
+    """
+    Disk cache of LUT search results. An entry consists of the LUT indices
+    and the cost function values of shape (n_solutions, num_rows,
+    num_columns) as returned by `rtm_inv.core.inversion.inv_img`.
+
+    :attrib cache_dir:
+        directory with the cached solutions
+    :attrib hits:
+        number of entries found in the cache
+    :attrib misses:
+        number of entries looked up but not found in the cache
+    """
+    def __init__(self, cache_dir: Path):
+        """
+        Opens a ``SolutionCache``
+
+        :param cache_dir:
+            directory with the cached solutions (created if it does not
+            exist)
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        # solutions are written to temporary files unique to this instance,
+        # so workers allocating the same entry do not share files
+        self._tmp_suffix = f'.{os.getpid()}-{uuid.uuid4().hex}.tmp.npy'
+
+    def key(
+            self,
+            lut: np.ndarray,
+            img: np.ndarray,
+            mask: np.ndarray,
+            cost_function: str | CostFunction,
+            n_solutions: int,
+            warm_start: Optional[np.ndarray] = None,
+            warm_start_threshold: Optional[float] = None,
+            warm_start_graph: Optional[LUTNeighbourGraph] = None
+    ) -> str:
+        """
+        Cache key of the solutions of an image. The search backend and
+        deduplication do not change the solutions and are not part of the
+        key; the data types of the precision policy and the parameters of
+        the cost function (e.g., band weights) are. Cost functions that are
+        not registered and do not declare their parameters cannot be
+        cached, as they cannot be told apart from other cost functions of
+        the same name.
+
+        :param lut:
+            LUT spectra of shape (num_spectra, num_bands)
+        :param img:
+            image with sensor spectra of shape (num_bands, num_rows,
+            num_columns)
+        :param mask:
+            mask of the pixels not inverted
+        :param cost_function:
+            name of a registered cost function or ``CostFunction`` instance
+        :param n_solutions:
+            number of best solutions
+        :param warm_start:
+            optional warm start candidates (see
+            `rtm_inv.core.inversion.inv_img`). Solutions accepted from the
+            candidates may differ from those of a full search.
+        :param warm_start_threshold:
+            cost function value for accepting warm starts
+        :param warm_start_graph:
+            optional ``LUTNeighbourGraph`` mapping `warm_start` to the
+            candidates (see `rtm_inv.core.streaming.inv_img_streaming`)
+        :returns:
+            hex digest identifying the solutions
+        """
+        cost_function = get_cost_function(cost_function)
+        if cost_function.params is None and \
+                registry.get(cost_function.name) is not cost_function:
+            raise ValueError(
+                f'Cost function {cost_function.name} is not registered and ' +
+                'has no parameters to cache its solutions by')
+        policy = get_precision_policy()
+        digest = hashlib.sha1(lut_fingerprint(lut).encode())
+        _update_digest(digest, img)
+        _update_digest(digest, np.asarray(mask, dtype='bool'))
+        digest.update(
+            f'{cost_function.name}|{n_solutions}|'
+            f'{policy.index_dtype(lut.shape[0])}|{policy.cost_dtype}'.encode()
+        )
+        for name, value in sorted((cost_function.params or {}).items()):
+            digest.update(name.encode())
+            _update_digest(digest, np.asarray(value))
+        if warm_start is not None:
+            _update_digest(digest, warm_start)
+            digest.update(f'{warm_start_threshold}'.encode())
+            if warm_start_graph is not None:
+                _update_digest(digest, warm_start_graph.neighbours)
+        return digest.hexdigest()
+
+    def _fpaths(self, key: str, tmp: bool = False) -> Tuple[Path, Path]:
+        suffix = self._tmp_suffix if tmp else '.npy'
+        return (
+            self.cache_dir.joinpath(f'{key}_lut_idxs{suffix}'),
+            self.cache_dir.joinpath(f'{key}_costs{suffix}')
+        )
+
+    def get(self, key: str) -> Tuple[np.ndarray, np.ndarray] | None:
+        """
+        Looks up cached solutions
+
+        :param key:
+            cache key (see `key`)
+        :returns:
+            read-only memory-mapped LUT indices and cost function values or
+            None if the solutions are not cached
+        """
+        fpath_idxs, fpath_costs = self._fpaths(key)
+        if not (fpath_idxs.exists() and fpath_costs.exists()):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return (
+            np.load(fpath_idxs, mmap_mode='r'),
+            np.load(fpath_costs, mmap_mode='r')
+        )
+
+    def allocate(
+            self,
+            key: str,
+            shape: Tuple[int, int, int],
+            index_dtype: np.dtype,
+            cost_dtype: np.dtype
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Allocates memory-mapped arrays for new solutions. The entry becomes
+        visible to `get` only after `commit`, so interrupted runs leave no
+        partial entries behind.
+
+        :param key:
+            cache key (see `key`)
+        :param shape:
+            shape of the solutions (n_solutions, num_rows, num_columns)
+        :param index_dtype:
+            data type of the LUT indices
+        :param cost_dtype:
+            data type of the cost function values
+        :returns:
+            writable memory-mapped LUT indices and cost function values
+        """
+        fpath_idxs, fpath_costs = self._fpaths(key, tmp=True)
+        return (
+            np.lib.format.open_memmap(
+                fpath_idxs, mode='w+', dtype=index_dtype, shape=shape),
+            np.lib.format.open_memmap(
+                fpath_costs, mode='w+', dtype=cost_dtype, shape=shape)
+        )
+
+    def commit(self, key: str) -> None:
+        """
+        Adds the solutions written to the arrays returned by `allocate` to
+        the cache
+
+        :param key:
+            cache key (see `key`)
+        """
+        for fpath_tmp, fpath in zip(
+                self._fpaths(key, tmp=True), self._fpaths(key)):
+            os.replace(fpath_tmp, fpath)
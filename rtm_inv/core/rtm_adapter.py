@@ -22,15 +22,16 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import numpy as np
 import pandas as pd
-import prosail
 import SPART as spart
 
+from functools import lru_cache
 from pathlib import Path
 from spectral import BandResampler
-from typing import Optional
+from typing import List, Optional, Tuple
 
+from rtm_inv.core.prosail_batch import run_prosail_batch, wavelengths
 from rtm_inv.core.sensors import Sensors
-from rtm_inv.core.utils import green_is_valid, resample_spectra
+from rtm_inv.core.utils import green_is_valid, resampling_matrix
 
 class RTMRunTimeError(Exception):
     pass
@@ -71,6 +72,54 @@ class ProSAILParameters:
         'rsoil0', 'soil_spectrum1', 'soil_spectrum2', 'alpha'
     ]
 
+@lru_cache(maxsize=None)
+def _resampling_matrix(
+        sensor: str,
+        fpath_srf: Optional[Path] = None
+) -> Tuple[List[str], np.ndarray]:
+    """
+    Weight matrix resampling 1nm ProSAIL output (400 to 2500nm) to the
+    spectral bands of a sensor. The matrix is set up once per sensor and
+    SRF file.
+
+    :param sensor:
+        name of the sensor
+    :param fpath_srf:
+        optional path to file with spectral response function of the spectral
+        bands of the sensor. If not provided, the central wavelength and FWHM
+        of the sensor are used assuming a Gaussian SRF.
+    :returns:
+        band names of the sensor and read-only resampling matrix of shape
+        (n_bands, 2101)
+    """
+    try:
+        sensor = eval(f'Sensors.{sensor}()')
+    except Exception as e:
+        raise Exception(f'No such sensor: {sensor}: {e}')
+
+    # no SRF available
+    if fpath_srf is None:
+        # get central wavelengths and band width per band
+        centers_sensor, fwhm_sensor = sensor.central_wvls, sensor.band_widths
+        # convert band withs to FWHM (full-width-half-maximum)
+        fwhm_sensor = [x*0.5 for x in fwhm_sensor]
+        # spectral convolution from 1nm ProSAIL output to the sensor's
+        # spectral resolution using a Gaussian spectral response function
+        resampler = BandResampler(
+            centers1=wavelengths,
+            centers2=centers_sensor,
+            fwhm1=np.ones(wavelengths.size),
+            fwhm2=fwhm_sensor
+        )
+        matrix = np.array(resampler.matrix)
+    else:
+        srf_df = sensor.read_srf_from_xls(fpath_srf)
+        matrix = resampling_matrix(
+            sat_srf=srf_df, wvls=wavelengths, wl_column='wvl')
+    matrix.flags.writeable = False
+    return list(sensor.band_names), matrix
+
+
 class RTM:
     """
     Class for simulating synthetic vegetation spectra
@@ -175,9 +224,10 @@ class RTM:
         sensor: str,
         fpath_srf: Optional[Path] = None,
         remove_invalid_green_peaks: Optional[bool] = False,
-        rsoil0: Optional[np.array] = False,
-        soil_spectrum1: Optional[np.array] = False,
-        soil_spectrum2: Optional[np.array] = False,
+        rsoil0: Optional[np.array] = None,
+        soil_spectrum1: Optional[np.array] = None,
+        soil_spectrum2: Optional[np.array] = None,
+        batch_size: Optional[int] = 500
     ) -> None:
         """
         Runs the ProSAIL RTM.
@@ -196,7 +246,13 @@ class RTM:
         :param soil_spectrum1: dry soil spectra. (will be scaled by rsoil and psoil in lut params). 2101-element array with reflectance values between 400 and 2500nm. 
             Should be provided with soil_spectrum2
         :param soil_spectrum2: wet soil spectra. 2101-element array with reflectance values between 400 and 2500nm
+        :param batch_size:
+            number of spectra simulated at once (see
+            `rtm_inv.core.prosail_batch.run_prosail_batch`). Larger batches
+            need more memory (about 0.75 MB per spectrum).
         """
+        if batch_size <= 0:
+            raise ValueError('Batch size must be > 0')
         # check if Prospect version
         if set(ProSAILParameters.prospect5).issubset(set(self._lut.samples.columns)):
             prospect_version = '5'
@@ -205,90 +261,48 @@ class RTM:
         else:
             raise ValueError('Cannot determine Prospect Version')
 
-        # get sensor
-        try:
-            sensor = eval(f'Sensors.{sensor}()')
-        except Exception as e:
-            raise Exception(f'No such sensor: {sensor}: {e}')
-
-        # get band names
-        sensor_bands = sensor.band_names
+        # get sensor and the matrix resampling the ProSAIL output to its bands
+        sensor_bands, matrix = _resampling_matrix(
+            sensor=sensor, fpath_srf=fpath_srf)
         self._lut.samples[sensor_bands] = np.nan
 
-        # define centers and bandwidth of ProSAIL output
-        centers_prosail = np.arange(400,2501,1)
-        fwhm_prosail = np.ones(centers_prosail.size)
-
-        # no SRF available
-        if fpath_srf is None:
-            # get central wavelengths and band width per band
-            centers_sensor, fwhm_sensor = sensor.central_wvls, sensor.band_widths
-            # convert band withs to FWHM (full-width-half-maximum)
-            fwhm_sensor = [x*0.5 for x in fwhm_sensor]
-            # initialize spectral sampler object to perform the spectral
-            # convolution from 1nm ProSAIL output to the sensor's spectral
-            # resolution using a Gaussian spectral response function
-            resampler = BandResampler(
-                centers1=centers_prosail,
-                centers2=centers_sensor,
-                fwhm1=fwhm_prosail,
-                fwhm2=fwhm_sensor
-            )
-        else:
-            srf_df = sensor.read_srf_from_xls(fpath_srf)
-
-        # iterate through LUT and run ProSAIL
-        spectrum = None
+        # run ProSAIL for batches of LUT entries and collect the resampled
+        # spectra in a band matrix that is written to the LUT at once
         traits = self._lut.samples.columns
         # drop band columns B01, B02, etc.
         traits = [x for x in traits if not x.startswith('B')]
-        lut = self._lut.samples[traits].copy()
-        for idx, record in lut.iterrows():
-            # set the PROSPECT version
-            record_inp = record.to_dict()
-            record_inp.update({
-                'prospect_version': prospect_version
-            })
-            if rsoil0 is not None:
-                record_inp.update({
-                'rsoil0': rsoil0
-                })
-            if soil_spectrum1 is not None:
-                record_inp.update({
-                'soil_spectrum1': soil_spectrum1,
-                'soil_spectrum2': soil_spectrum2
-                })
-            # run ProSAIL
+        lut = self._lut.samples[traits]
+        n_spectra = lut.shape[0]
+        band_matrix = np.full((n_spectra, len(sensor_bands)), np.nan)
+        for start in range(0, n_spectra, batch_size):
+            stop = min(start + batch_size, n_spectra)
             try:
-                spectrum = prosail.run_prosail(**record_inp)
+                spectra = run_prosail_batch(
+                    params=lut.iloc[start:stop],
+                    prospect_version=prospect_version,
+                    rsoil0=rsoil0,
+                    soil_spectrum1=soil_spectrum1,
+                    soil_spectrum2=soil_spectrum2
+                )
             except Exception as e:
-                raise RTMRunTimeError(f'Simulation of spectrum failed: {e}')
-            if (idx+1)%self._nstep == 0:
-                print(f'Simulated spectrum {idx+1}/{self._lut.samples.shape[0]}')
+                raise RTMRunTimeError(f'Simulation of spectra failed: {e}')
+            for idx in range(start, stop):
+                if (idx+1)%self._nstep == 0:
+                    print(f'Simulated spectrum {idx+1}/{n_spectra}')
 
-            # check if the spectrum has an invalid green peak (optionally, following
+            # check if the spectra have invalid green peaks (optionally, following
             # the approach by Wocher et al., 2020, https://doi.org/10.1016/j.jag.2020.102219)
+            # invalid spectra remain NaN (so they can be filtered out)
+            valid = np.ones(stop - start, dtype=bool)
             if remove_invalid_green_peaks:
-                valid = green_is_valid(wvls=centers_prosail, spectrum=spectrum)
-                # set invalid spectra to NaN (so they can be filtered out) and continue
-                if not valid:
-                    self._lut.samples.loc[idx,sensor_bands] = np.nan
-                    continue
+                valid = green_is_valid(wvls=wavelengths, spectrum=spectra)
 
             # resample to the spectral resolution of sensor
-            if fpath_srf is None:
-                sensor_spectrum = resampler(spectrum)
-            else:
-                # resample RTM output based on true SRFs
-                prosail_df = pd.DataFrame(
-                    {'wvl': centers_prosail, 'prosail': spectrum}
-                )
-                sensor_spectrum = resample_spectra(
-                    spectral_df=prosail_df, sat_srf=srf_df, wl_column='wvl'
-                )
-                sensor_spectrum = sensor_spectrum[0].values
+            sensor_spectra = spectra[valid] @ matrix.T
+
+            band_matrix[start:stop][valid] = sensor_spectra
 
-            self._lut.samples.loc[idx,sensor_bands] = sensor_spectrum
+        self._lut.samples[sensor_bands] = band_matrix
 
     def simulate_spectra(self, sensor: str, **kwargs) -> pd.DataFrame:
         """
@@ -0,0 +1,206 @@
+'''
+Registry of the samplers used to draw RTM parameter samples for
+lookup-tables (LUTs).
+
+A sampler fills a preallocated float32 array of shape (num_samples,
+num_traits) with samples in the unit hypercube. `LookupTable.generate_samples`
+maps these samples to the trait values through the inverse cumulative
+distribution function of each trait (see
+`rtm_inv.core.distributions.Distributions.ppf`). Samplers work on chunks of
+rows, so the memory needed beyond the output array does not grow with the
+number of samples. Samplers currently registered:
+
+    - 'LHS': stratified Latin Hypercube Sampling (O(n))
+    - 'FRS': fully random sampling (independent uniform samples)
+    - 'SOBOL': scrambled Sobol sequence
+    - 'HALTON': scrambled Halton sequence
+
+New samplers are made available with `register_sampler`.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import numpy as np
+import warnings
+
+from scipy.stats import qmc
+from typing import Callable, Dict, List, Optional
+
+# default number of rows generated at once
+default_chunk_size: int = 100_000
+
+
+class Sampler(object):
+    """
+    Sampler of the unit hypercube.
+
+    :attrib name:
+        name under which the sampler is registered (upper case)
+    :attrib fill:
+        callable taking the preallocated output array (num_samples,
+        num_traits), a seed and the chunk size and filling the output
+        array with samples in [0, 1]
+    """
+    def __init__(
+            self,
+            name: str,
+            fill: Callable[[np.ndarray, int, int], None]
+    ):
+        self.name = name.upper()
+        self.fill = fill
+
+    def __repr__(self) -> str:
+        return f'Sampler({self.name})'
+
+
+# registered samplers by name
+registry: Dict[str, Sampler] = {}
+
+
+def register_sampler(
+        sampler: Sampler,
+        overwrite: Optional[bool] = False
+) -> None:
+    """
+    Makes a sampler available to `LookupTable.generate_samples`
+
+    :param sampler:
+        ``Sampler`` to register under its name
+    :param overwrite:
+        if False (default), registering a name twice raises an error
+    """
+    if sampler.name in registry and not overwrite:
+        raise ValueError(f'Sampler {sampler.name} is already registered')
+    registry[sampler.name] = sampler
+
+
+def get_sampler(name: str | Sampler) -> Sampler:
+    """
+    Looks up a registered sampler
+
+    :param name:
+        name of the sampler (case insensitive). ``Sampler`` instances are
+        returned as they are.
+    :returns:
+        ``Sampler`` instance
+    """
+    if isinstance(name, Sampler):
+        return name
+    if name.upper() not in registry:
+        raise NotImplementedError(f'{name} not found')
+    return registry[name.upper()]
+
+
+def available_samplers() -> List[str]:
+    """
+    Names of the registered samplers
+    """
+    return list(registry.keys())
+
+
+def unit_samples(
+        sampler: str | Sampler,
+        num_samples: int,
+        num_traits: int,
+        seed: Optional[int] = 0,
+        chunk_size: Optional[int] = default_chunk_size,
+        out: Optional[np.ndarray] = None
+) -> np.ndarray:
+    """
+    Draws samples in the unit hypercube
+
+    :param sampler:
+        name of a registered sampler or ``Sampler`` instance
+    :param num_samples:
+        number of samples
+    :param num_traits:
+        number of dimensions (traits)
+    :param seed:
+        seed of the random number generator
+    :param chunk_size:
+        number of samples generated at once
+    :param out:
+        optional preallocated array of shape (num_samples, num_traits)
+    :returns:
+        samples of shape (num_samples, num_traits), float32 unless `out` is
+        given
+    """
+    if chunk_size <= 0:
+        raise ValueError('Chunk size must be > 0')
+    if out is None:
+        out = np.empty((num_samples, num_traits), dtype='float32')
+    elif out.shape != (num_samples, num_traits):
+        raise ValueError(
+            f'Expected output of shape {(num_samples, num_traits)}, ' +
+            f'got {out.shape}')
+    get_sampler(sampler).fill(out, seed, chunk_size)
+    return out
+
+
+def _chunks(num_samples: int, chunk_size: int):
+    for start in range(0, num_samples, chunk_size):
+        yield start, min(start + chunk_size, num_samples)
+
+
+def _fill_lhs(out: np.ndarray, seed: int, chunk_size: int) -> None:
+    """
+    Latin Hypercube: every trait has exactly one sample in each of the
+    num_samples strata of [0, 1), with the strata randomly permuted per
+    trait and the samples uniformly distributed within their stratum
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = out.shape[0]
+    for trait in range(out.shape[1]):
+        strata = rng.permutation(num_samples)
+        for start, stop in _chunks(num_samples, chunk_size):
+            out[start:stop, trait] = \
+                (strata[start:stop] + rng.random(stop - start)) / num_samples
+
+
+def _fill_frs(out: np.ndarray, seed: int, chunk_size: int) -> None:
+    """
+    Independent uniformly distributed samples
+    """
+    rng = np.random.default_rng(seed)
+    for start, stop in _chunks(out.shape[0], chunk_size):
+        out[start:stop] = rng.random((stop - start, out.shape[1]))
+
+
+def _qmc_fill(
+        engine: Callable[..., qmc.QMCEngine]
+) -> Callable[[np.ndarray, int, int], None]:
+    """
+    Fills the output with the points of a scrambled low-discrepancy
+    sequence. The sequence continues from chunk to chunk, so the samples
+    do not depend on the chunk size.
+    """
+    def fill(out: np.ndarray, seed: int, chunk_size: int) -> None:
+        sequence = engine(
+            d=out.shape[1], scramble=True, seed=np.random.default_rng(seed))
+        for start, stop in _chunks(out.shape[0], chunk_size):
+            with warnings.catch_warnings():
+                # Sobol points are balanced for powers of two only
+                warnings.simplefilter('ignore', UserWarning)
+                out[start:stop] = sequence.random(stop - start)
+    return fill
+
+
+register_sampler(Sampler(name='LHS', fill=_fill_lhs))
+register_sampler(Sampler(name='FRS', fill=_fill_frs))
+register_sampler(Sampler(name='SOBOL', fill=_qmc_fill(qmc.Sobol)))
+register_sampler(Sampler(name='HALTON', fill=_qmc_fill(qmc.Halton)))
@@ -0,0 +1,645 @@
+'''
+Tiled, bounded-memory inversion of large rasters. Instead of keeping the
+full `(n_solutions, rows, cols)` solution cube in memory, the image is
+processed in tiles of rows and each tile is reduced to trait statistics
+right away.
+
+Copyright (C) 2022 Lukas Valentin Graf
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+'''
+
+from __future__ import annotations
+
+import numpy as np
+import os
+
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from rtm_inv.core.inversion import (
+    _retrieve_traits, backend_indices, inv_img, inv_img_multi)
+from rtm_inv.core.lut_index import LUTIndex, LUTNeighbourGraph, LUTProjection
+from rtm_inv.core.lut_store import ShardedLUT
+from rtm_inv.core.precision import (
+    get_precision_policy, is_no_solution, no_solution)
+
+# names of the cost function summaries (in the order of the output planes)
+cost_summaries = ['lowest_error', 'highest_error', 'median_error']
+
+
+def _allocate(
+        shape: Tuple[int, ...],
+        out_dir: Path | None,
+        name: str
+) -> np.ndarray:
+    """
+    Allocates a NaN-initialized output array either in memory or as
+    memory-mapped `.npy` file in `out_dir`. The data type is the trait
+    data type of the precision policy.
+    """
+    dtype = get_precision_policy().trait_dtype
+    if out_dir is None:
+        arr = np.empty(shape, dtype=dtype)
+    else:
+        arr = np.lib.format.open_memmap(
+            Path(out_dir).joinpath(f'{name}.npy'),
+            mode='w+',
+            dtype=dtype,
+            shape=shape
+        )
+    arr[:] = np.nan
+    return arr
+
+
+def tile_rows(
+        n_cols: int,
+        n_solutions: int,
+        n_traits: int,
+        memory_budget: float,
+        n_spectra: Optional[int] = 0,
+        block_size: Optional[int] = 256,
+        n_candidates: Optional[int] = 0,
+        n_workers: Optional[int] = 1
+) -> int:
+    """
+    Number of image rows that can be inverted at once without the
+    cost function block, the per-tile solution cube, the warm start
+    candidates and the gathered trait tensor exceeding the memory budget
+
+    :param n_cols:
+        number of image columns
+    :param n_solutions:
+        number of solutions per pixel
+    :param n_traits:
+        number of traits to retrieve
+    :param memory_budget:
+        memory budget in MB
+    :param n_spectra:
+        number of LUT spectra the cost function is evaluated against at
+        once (the size of the largest shard for sharded LUTs). 0 (default)
+        if the LUT is not searched.
+    :param block_size:
+        number of pixels the cost function is evaluated for at once (see
+        `rtm_inv.core.inversion.inv_img`)
+    :param n_candidates:
+        number of warm start candidates per pixel. 0 (default) without
+        warm start.
+    :param n_workers:
+        number of threads evaluating a block of pixels each at once
+    :returns:
+        number of rows per tile (at least 1)
+    """
+    # cost function values (float64) of a block of pixels against the LUT
+    # per thread. The blocks do not grow with the tile, so they are taken
+    # off the budget
+    cost_block_bytes = n_workers * block_size * n_spectra * 8
+    # LUT indices (int32) + cost function values (float32), which exist
+    # twice while the search results are scattered into the tile, plus the
+    # gathered trait values (float64) per solution and pixel
+    bytes_per_pixel = n_solutions * (2 * (4 + 4) + 8 * n_traits)
+    # warm start candidates (int32), which exist three times while they are
+    # mapped from the previous solutions and compacted to the valid pixels
+    bytes_per_pixel += n_candidates * 3 * 4
+    tile_bytes = int(memory_budget * 2**20) - cost_block_bytes
+    return max(1, tile_bytes // (bytes_per_pixel * n_cols))
+
+
+def _allocate_outputs(
+        n_traits: int,
+        rows: int,
+        cols: int,
+        out_dir: Path | None,
+        keep_cost_summaries: bool,
+        prefix: Optional[str] = ''
+) -> List[np.ndarray | None]:
+    """
+    Allocates the trait, q05, q95 and (optional) cost summary planes
+    """
+    outputs = [
+        _allocate((n_traits, rows, cols), out_dir, f'{prefix}{name}')
+        for name in ['traits', 'q05', 'q95']
+    ]
+    cost_img = None
+    if keep_cost_summaries:
+        cost_img = _allocate(
+            (len(cost_summaries), rows, cols), out_dir,
+            f'{prefix}cost_summaries')
+    outputs.append(cost_img)
+    return outputs
+
+
+def _reduce_tile(
+        outputs: List[np.ndarray | None],
+        start: int,
+        stop: int,
+        tile_mask: np.ndarray,
+        trait_values: np.ndarray,
+        lut_idxs: np.ndarray,
+        cost_function_values: np.ndarray,
+        measure: str,
+        n_workers: Optional[int] = None
+) -> None:
+    """
+    Reduces the solutions of a tile to trait statistics and cost function
+    summaries and writes them into the rows `start:stop` of the outputs
+    """
+    trait_img, q05_img, q95_img, cost_img = outputs
+    trait_img[:, start:stop, :], q05_img[:, start:stop, :], \
+        q95_img[:, start:stop, :] = _retrieve_traits(
+            trait_values=trait_values,
+            lut_idxs=lut_idxs,
+            cost_function_values=cost_function_values,
+            measure=measure,
+            n_workers=n_workers
+        )
+    if cost_img is not None:
+        # solutions are sorted by ascending cost function values
+        tile_costs = np.stack([
+            cost_function_values[0, :, :],
+            cost_function_values[-1, :, :],
+            np.median(cost_function_values, axis=0)
+        ]).astype(cost_img.dtype)
+        tile_costs[:, tile_mask] = np.nan
+        cost_img[:, start:stop, :] = tile_costs
+
+
+def _update_stats(
+        stats: Dict[str, Any] | None,
+        tile_stats: Dict[str, Any]
+) -> None:
+    """
+    Adds the pixel counts of a tile to the overall statistics
+    """
+    if stats is None:
+        return
+    for key in ['n_pixels', 'n_unique', 'n_fallback']:
+        if key in tile_stats:
+            stats[key] = stats.get(key, 0) + tile_stats[key]
+
+
+def _finalize_stats(
+        stats: Dict[str, Any] | None,
+        dedup: bool,
+        warm_start: Optional[bool] = False
+) -> None:
+    """
+    Computes the overall dedup ratio and warm start fallback rate from the
+    summed pixel counts
+    """
+    if stats is None:
+        return
+    stats.setdefault('n_pixels', 0)
+    if dedup:
+        stats.setdefault('n_unique', 0)
+        stats['dedup_ratio'] = stats['n_pixels'] / max(stats['n_unique'], 1)
+    if warm_start:
+        stats.setdefault('n_fallback', 0)
+        n_searched = stats['n_unique'] if dedup else stats['n_pixels']
+        stats['fallback_rate'] = stats['n_fallback'] / max(n_searched, 1)
+
+
+def inv_img_streaming(
+        lut: np.ndarray | ShardedLUT,
+        trait_values: np.ndarray,
+        img: np.ndarray,
+        mask: np.ndarray,
+        cost_function: str,
+        n_solutions: int,
+        measure: Optional[str] = 'Median',
+        memory_budget: Optional[float] = 1024,
+        out_dir: Optional[Path] = None,
+        keep_cost_summaries: Optional[bool] = True,
+        backend: Optional[str] = 'brute',
+        lut_index: Optional[LUTIndex | LUTProjection] = None,
+        dedup: Optional[bool] = False,
+        stats: Optional[Dict[str, Any]] = None,
+        warm_start: Optional[np.ndarray] = None,
+        warm_start_threshold: Optional[float] = None,
+        warm_start_graph: Optional[LUTNeighbourGraph] = None,
+        solutions_out: Optional[np.ndarray] = None,
+        costs_out: Optional[np.ndarray] = None,
+        block_size: Optional[int] = 256,
+        n_workers: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray | None]:
+    """
+    Lookup-table based inversion and trait retrieval on images processed
+    in tiles of rows. Each tile is inverted using `inv_img` and reduced to
+    trait statistics using the `measure` right away so that the full
+    solution cube never exists in memory.
+
+    :param lut:
+        LUT spectra of shape (num_spectra, num_bands) or ``ShardedLUT``
+        (all shards are searched for every tile)
+    :param trait_values:
+        trait values of the LUT entries of shape (num_spectra, n_traits)
+        (see `ShardedLUT.trait_values` for sharded LUTs)
+    :param img:
+        image with sensor spectra of shape (num_bands, num_rows,
+        num_columns)
+    :param mask:
+        mask of `img.shape[1], img.shape[2]` to skip pixels
+    :param cost_function:
+        cost function implementing similarity metric between sensor
+        synthetic spectra (see `rtm_inv.core.inversion.inv_img`)
+    :param n_solutions:
+        number of best solutions to use per pixel
+    :param measure:
+        statistical measure to retrieve the solution per trait out
+        of the *n* best solutions (see `rtm_inv.core.inversion.retrieve_traits`)
+    :param memory_budget:
+        maximum memory in MB used for the cost function values of a block
+        of pixels and the solutions of a single tile (see `tile_rows`).
+        1024 MB by default.
+    :param out_dir:
+        optional directory where to write the outputs to as memory-mapped
+        `.npy` files (traits.npy, q05.npy, q95.npy and cost_summaries.npy).
+        If not provided, outputs are kept in memory.
+    :param keep_cost_summaries:
+        if True (default) keeps the lowest, median and highest cost function
+        value per pixel (see `cost_summaries` for the order of the planes).
+    :param backend:
+        LUT search backend passed to `inv_img`
+    :param lut_index:
+        optional pre-built ``LUTIndex`` or ``LUTProjection`` for the
+        'kdtree' or 'pca' backend, respectively
+    :param dedup:
+        if True, the LUT is searched only once per unique spectrum within a
+        tile (see `rtm_inv.core.inversion.inv_img`)
+    :param stats:
+        optional dictionary to which inversion statistics summed over all
+        tiles are written ('n_pixels', 'n_fallback' for the 'pca' backend
+        or a `warm_start`, 'fallback_rate' for a `warm_start` and, if
+        `dedup` is True, 'n_unique' and 'dedup_ratio')
+    :param warm_start:
+        optional candidate LUT indices of shape (num_candidates, num_rows,
+        num_columns) searched before the whole LUT (see
+        `rtm_inv.core.inversion.inv_img`). With a `warm_start_graph`, the
+        best solutions of the previous scene in the source LUT of the graph
+        of shape (n_seeds, num_rows, num_columns) instead.
+    :param warm_start_threshold:
+        cost function value the best candidate of a pixel must reach for
+        the warm start to be accepted (see `rtm_inv.core.inversion.inv_img`)
+    :param warm_start_graph:
+        optional ``LUTNeighbourGraph`` mapping the `warm_start` solutions to
+        candidates in `lut`. The candidates are derived tile by tile, so
+        only those of a single tile are kept in memory.
+    :param solutions_out:
+        optional array of shape (n, num_rows, num_columns) with
+        n <= `n_solutions` to which the LUT indices of the n best solutions
+        per pixel are written (`rtm_inv.core.precision.no_solution` of its
+        data type for masked pixels), e.g., to warm start
+        the inversion of the next scene of a time series.
+    :param costs_out:
+        optional array of the shape of `solutions_out` to which the
+        corresponding cost function values are written (0 for masked
+        pixels), e.g., to cache the solutions (see
+        `rtm_inv.core.result_cache`).
+    :param block_size:
+        number of pixels evaluated against the whole LUT at once (see
+        `rtm_inv.core.inversion.inv_img`)
+    :param n_workers:
+        number of threads used to search the LUT (see
+        `rtm_inv.core.inversion.inv_img`) and to retrieve the traits of a
+        tile. Uses all cores by default. Set to 1 when running in a process
+        pool.
+    :returns:
+        tuple with the trait values, their 5 and 95% percentiles (each of
+        shape (n_traits, num_rows, num_columns)) and the cost function
+        summaries of shape (3, num_rows, num_columns) or None if
+        `keep_cost_summaries` is False. Masked pixels are NaN.
+    """
+    if memory_budget <= 0:
+        raise ValueError('Memory budget must be > 0')
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if trait_values.ndim != 2 or trait_values.shape[0] != lut.shape[0]:
+        raise ValueError(
+            'Trait values must be of shape (num_spectra, n_traits)')
+    n_traits = trait_values.shape[1]
+    _, rows, cols = img.shape
+    if not isinstance(lut, ShardedLUT):
+        # convert the LUT once instead of once per tile
+        lut = np.ascontiguousarray(lut, dtype='float64')
+    if lut_index is None and backend in backend_indices:
+        # build the index once for all tiles
+        lut_index = backend_indices[backend](lut=lut)
+
+    outputs = _allocate_outputs(
+        n_traits=n_traits,
+        rows=rows,
+        cols=cols,
+        out_dir=out_dir,
+        keep_cost_summaries=keep_cost_summaries
+    )
+    n_candidates = 0
+    if warm_start is not None:
+        n_candidates = warm_start.shape[0]
+        if warm_start_graph is not None:
+            n_candidates *= warm_start_graph.n_neighbours
+    n_rows = tile_rows(
+        n_cols=cols,
+        n_solutions=n_solutions,
+        n_traits=n_traits,
+        memory_budget=memory_budget,
+        n_spectra=max(lut.shard_sizes) if isinstance(lut, ShardedLUT)
+        else lut.shape[0],
+        block_size=block_size,
+        n_candidates=n_candidates,
+        # only the 'brute' backend evaluates cost function blocks in
+        # parallel (sharded LUTs are searched shard by shard)
+        n_workers=n_workers if backend == 'brute' and
+        not isinstance(lut, ShardedLUT) else 1
+    )
+    if solutions_out is not None and (
+            solutions_out.ndim != 3 or
+            solutions_out.shape[0] > n_solutions or
+            solutions_out.shape[1:] != (rows, cols)):
+        raise ValueError(
+            'Solutions output must be of shape (n, num_rows, num_columns) ' +
+            'with n <= n_solutions')
+    if costs_out is not None and (
+            solutions_out is None or costs_out.shape != solutions_out.shape):
+        raise ValueError(
+            'Costs output requires a solutions output of the same shape')
+    for start in range(0, rows, n_rows):
+        stop = min(start + n_rows, rows)
+        tile_mask = mask[start:stop, :]
+        if tile_mask.all():
+            if solutions_out is not None:
+                solutions_out[:, start:stop, :] = \
+                    no_solution(solutions_out.dtype)
+            if costs_out is not None:
+                costs_out[:, start:stop, :] = 0
+            continue
+        tile_stats = {}
+        tile_warm_start = None
+        if warm_start is not None:
+            tile_warm_start = warm_start[:, start:stop, :]
+            if warm_start_graph is not None:
+                tile_warm_start = warm_start_graph.candidates(tile_warm_start)
+        lut_idxs, cost_function_values = inv_img(
+            lut=lut,
+            img=img[:, start:stop, :],
+            mask=tile_mask,
+            cost_function=cost_function,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            backend=backend,
+            lut_index=lut_index,
+            dedup=dedup,
+            stats=tile_stats,
+            warm_start=tile_warm_start,
+            warm_start_threshold=warm_start_threshold,
+            n_workers=n_workers
+        )
+        _update_stats(stats, tile_stats)
+        if solutions_out is not None:
+            solutions_out[:, start:stop, :] = \
+                lut_idxs[:solutions_out.shape[0]]
+        if costs_out is not None:
+            costs_out[:, start:stop, :] = \
+                cost_function_values[:costs_out.shape[0]]
+        _reduce_tile(
+            outputs=outputs,
+            start=start,
+            stop=stop,
+            tile_mask=tile_mask,
+            trait_values=trait_values,
+            lut_idxs=lut_idxs,
+            cost_function_values=cost_function_values,
+            measure=measure,
+            n_workers=n_workers
+        )
+    _finalize_stats(stats, dedup, warm_start is not None)
+
+    return tuple(outputs)
+
+
+def retrieve_traits_streaming(
+        trait_values: np.ndarray,
+        lut_idxs: np.ndarray,
+        cost_function_values: np.ndarray,
+        measure: Optional[str] = 'Median',
+        memory_budget: Optional[float] = 1024,
+        out_dir: Optional[Path] = None,
+        keep_cost_summaries: Optional[bool] = True,
+        n_workers: Optional[int] = None
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray | None]:
+    """
+    Trait retrieval from stored solutions (e.g., memory-mapped from a
+    `rtm_inv.core.result_cache.SolutionCache`) processed in tiles of rows
+    so that only the solutions of a single tile are read at a time.
+
+    :param trait_values:
+        trait values of the LUT entries of shape (num_spectra, n_traits)
+    :param lut_idxs:
+        LUT indices of the best solutions of shape (n_solutions, num_rows,
+        num_columns) as returned by `rtm_inv.core.inversion.inv_img`
+    :param cost_function_values:
+        corresponding cost function values
+    :param measure:
+        statistical measure to retrieve the solution per trait out
+        of the *n* best solutions (see
+        `rtm_inv.core.inversion.retrieve_traits`)
+    :param memory_budget:
+        maximum memory in MB used for the solutions of a single tile.
+        1024 MB by default.
+    :param out_dir:
+        optional directory where to write the outputs to as memory-mapped
+        `.npy` files (see `inv_img_streaming`)
+    :param keep_cost_summaries:
+        if True (default) keeps the lowest, median and highest cost function
+        value per pixel
+    :param n_workers:
+        number of threads used to retrieve the traits of a tile (see
+        `inv_img_streaming`)
+    :returns:
+        outputs as returned by `inv_img_streaming`
+    """
+    if memory_budget <= 0:
+        raise ValueError('Memory budget must be > 0')
+    if lut_idxs.ndim != 3 or cost_function_values.shape != lut_idxs.shape:
+        raise ValueError(
+            'LUT indices and cost function values must be of shape ' +
+            '(n_solutions, num_rows, num_columns)')
+    n_traits = trait_values.shape[1]
+    n_solutions, rows, cols = lut_idxs.shape
+
+    outputs = _allocate_outputs(
+        n_traits=n_traits,
+        rows=rows,
+        cols=cols,
+        out_dir=out_dir,
+        keep_cost_summaries=keep_cost_summaries
+    )
+    n_rows = tile_rows(
+        n_cols=cols,
+        n_solutions=n_solutions,
+        n_traits=n_traits,
+        memory_budget=memory_budget
+    )
+    for start in range(0, rows, n_rows):
+        stop = min(start + n_rows, rows)
+        tile_idxs = np.asarray(lut_idxs[:, start:stop, :])
+        tile_mask = is_no_solution(tile_idxs[0])
+        if tile_mask.all():
+            continue
+        _reduce_tile(
+            outputs=outputs,
+            start=start,
+            stop=stop,
+            tile_mask=tile_mask,
+            trait_values=trait_values,
+            lut_idxs=tile_idxs,
+            cost_function_values=np.asarray(
+                cost_function_values[:, start:stop, :]),
+            measure=measure,
+            n_workers=n_workers
+        )
+
+    return tuple(outputs)
+
+
+def inv_img_multi_streaming(
+        luts: Dict[str, np.ndarray],
+        trait_values: Dict[str, np.ndarray],
+        img: np.ndarray,
+        mask: np.ndarray,
+        cost_functions: Dict[str, str],
+        n_solutions: Dict[str, int],
+        measures: Dict[str, str],
+        memory_budget: Optional[float] = 1024,
+        out_dir: Optional[Path] = None,
+        keep_cost_summaries: Optional[bool] = True,
+        dedup: Optional[bool] = False,
+        stats: Optional[Dict[str, Any]] = None,
+        block_size: Optional[int] = 256,
+        n_workers: Optional[int] = None
+) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray | None]]:
+    """
+    Tiled inversion and trait retrieval against several LUTs (e.g., one
+    per phenological stage) in a single pass over the image using
+    `rtm_inv.core.inversion.inv_img_multi`.
+
+    :param luts:
+        LUT spectra of shape (num_spectra, num_bands) per stage
+    :param trait_values:
+        trait values of the LUT entries of shape (num_spectra, n_traits) per
+        stage. All stages must provide the same number of traits.
+    :param img:
+        image with sensor spectra of shape (num_bands, num_rows,
+        num_columns)
+    :param mask:
+        mask of `img.shape[1], img.shape[2]` to skip pixels
+    :param cost_functions:
+        cost function per stage
+    :param n_solutions:
+        number of best solutions to use per stage
+    :param measures:
+        statistical measure to aggregate the solutions per stage
+    :param memory_budget:
+        maximum memory in MB used for the cost function values of a block
+        of pixels and the solutions of all stages of a single tile. 1024 MB
+        by default.
+    :param out_dir:
+        optional directory where to write the outputs to as memory-mapped
+        `.npy` files prefixed by the stage name
+    :param keep_cost_summaries:
+        if True (default) keeps the lowest, highest and median cost
+        function value per pixel and stage
+    :param dedup:
+        if True, the LUTs are searched only once per unique spectrum within
+        a tile
+    :param stats:
+        optional dictionary to which inversion statistics summed over all
+        tiles are written (see `inv_img_streaming`)
+    :param block_size:
+        number of pixels evaluated against the concatenated LUTs at once
+    :param n_workers:
+        number of threads used to search the LUTs and to retrieve the
+        traits of a tile (see `inv_img_streaming`)
+    :returns:
+        dictionary with the outputs of `inv_img_streaming` per stage
+    """
+    if memory_budget <= 0:
+        raise ValueError('Memory budget must be > 0')
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    n_traits = set()
+    for stage, lut in luts.items():
+        if trait_values[stage].ndim != 2 or \
+                trait_values[stage].shape[0] != lut.shape[0]:
+            raise ValueError(
+                f'{stage}: Trait values must be of shape ' +
+                '(num_spectra, n_traits)')
+        n_traits.add(trait_values[stage].shape[1])
+    if len(n_traits) != 1:
+        raise ValueError('All stages must provide the same number of traits')
+    n_traits = n_traits.pop()
+    _, rows, cols = img.shape
+
+    outputs = {
+        stage: _allocate_outputs(
+            n_traits=n_traits,
+            rows=rows,
+            cols=cols,
+            out_dir=out_dir,
+            keep_cost_summaries=keep_cost_summaries,
+            prefix=f'{stage}_'
+        ) for stage in luts
+    }
+    n_rows = tile_rows(
+        n_cols=cols,
+        n_solutions=sum(n_solutions[x] for x in luts),
+        n_traits=n_traits,
+        memory_budget=memory_budget,
+        # stages sharing a cost function are searched at once
+        n_spectra=sum(lut.shape[0] for lut in luts.values()),
+        block_size=block_size,
+        n_workers=n_workers
+    )
+    for start in range(0, rows, n_rows):
+        stop = min(start + n_rows, rows)
+        tile_mask = mask[start:stop, :]
+        if tile_mask.all():
+            continue
+        tile_stats = {}
+        res = inv_img_multi(
+            luts=luts,
+            img=img[:, start:stop, :],
+            mask=tile_mask,
+            cost_functions=cost_functions,
+            n_solutions=n_solutions,
+            block_size=block_size,
+            dedup=dedup,
+            stats=tile_stats,
+            n_workers=n_workers
+        )
+        _update_stats(stats, tile_stats)
+        for stage, (lut_idxs, cost_function_values) in res.items():
+            _reduce_tile(
+                outputs=outputs[stage],
+                start=start,
+                stop=stop,
+                tile_mask=tile_mask,
+                trait_values=trait_values[stage],
+                lut_idxs=lut_idxs,
+                cost_function_values=cost_function_values,
+                measure=measures[stage],
+                n_workers=n_workers
+            )
+    _finalize_stats(stats, dedup)
+
+    return {stage: tuple(outputs[stage]) for stage in luts}
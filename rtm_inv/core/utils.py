@@ -4,12 +4,41 @@
 import pandas as pd
 import numpy as np
 
-from scipy.stats import poisson
-from typing import Optional
+from typing import Callable, Optional
 
 green_peak_threshold = 547 # nm
 green_region = (500, 600) # nm
 
+def resampling_matrix(
+        sat_srf: pd.DataFrame,
+        wvls: np.ndarray,
+        wl_column: str = "WL"
+) -> np.ndarray:
+    """
+    Weight matrix to spectrally resample spectra at wavelengths `wvls` to
+    the spectral response function (SRF) of a multi-spectral sensor. The
+    resampled spectra are the SRF-weighted sums of the original spectra
+    divided by the integral of the SRF coefficients, i.e., the product
+    ``spectra @ matrix.T`` for spectra of shape (n_spectra, n_wvls).
+
+    :param sat_srf:
+        spectral response function (SRF) of the satellite. Must be in long-format with
+        a WL column.
+    :param wvls:
+        wavelengths of the original spectra (same unit as the WL column)
+    :param wl_column:
+        Name of the column containing the wavelength
+    :returns:
+        weights of shape (n_bands, n_wvls). Wavelengths not covered by the SRF
+        get zero weight.
+    """
+    sat_bands = sat_srf.drop(wl_column, axis=1).columns
+    srf = pd.DataFrame({wl_column: wvls}).merge(
+        sat_srf, on=wl_column, how='left')
+    response = np.nan_to_num(srf[sat_bands].values.T.astype('float64'))
+    return response / response.sum(axis=1, keepdims=True)
+
+
 def resample_spectra(spectral_df: pd.DataFrame, sat_srf: pd.DataFrame, wl_column: str = "WL"
                      ) -> pd.DataFrame:
     """
@@ -36,43 +65,60 @@ def resample_spectra(spectral_df: pd.DataFrame, sat_srf: pd.DataFrame, wl_column
 
     # force the satellite SRF onto the same spectra as the spectral DF
     innerdf = spectral_df.merge(sat_srf, on=wl_column)
-    sat_srf = innerdf.loc[:, [wl_column, *sat_bands]]
-
-    # iterate over every spectra
-    out_list = []
-    for spectrum in indiv_spectra:
-
-        spec_df = spectral_df.loc[:, spectrum]
-        # iterate over every target (multi-spectral) band
-        spectrum_bandlist = []
-        for satband in sat_bands:
-
-            # get response of selected band
-            sat_response = sat_srf.loc[:, satband]
-            # start the resampling process. First, multiply the 1nm RTM
-            # output with the spectral response function of the target
-            # band
-            sim_vec = spec_df * sat_response
-            # set zeroes to NA for calculations
-            sim_vec[sim_vec == 0] = np.nan
-
-            # second, sum up the rescaled reflectance values and divide
-            # them by the integral of the SRF coefficients
-            sat_sim_refl = np.nansum(sim_vec)
-            sat_sim_refl = sat_sim_refl / np.nansum(sat_response)
-            spectrum_bandlist.append(sat_sim_refl)
-
-        # append to DF / dict
-        resampled_dict = dict(zip(sat_bands, spectrum_bandlist))
-        # append to out_DF
-        out_list.append(resampled_dict)
-
-    out_df = pd.DataFrame.from_dict(out_list, orient="columns")
-    out_df = out_df.transpose()
-    out_df = out_df.reset_index()
-    out_df = out_df.rename(columns={"index": "sat_bands"})
+
+    # resample all spectra at once. Missing values do not contribute
+    # to the weighted sums
+    matrix = resampling_matrix(
+        sat_srf=innerdf.loc[:, [wl_column, *sat_bands]],
+        wvls=innerdf[wl_column].values,
+        wl_column=wl_column
+    )
+    spectra = innerdf.loc[:, indiv_spectra].values.astype('float64')
+    spectra[np.isnan(spectra)] = 0.
+    out_df = pd.DataFrame(matrix @ spectra)
+    out_df.insert(0, 'sat_bands', list(sat_bands))
     return out_df
 
+def _rejection_sample(
+        draw: Callable[[np.ndarray], np.ndarray],
+        params: np.ndarray,
+        lower: np.ndarray,
+        upper: np.ndarray,
+        max_rounds: Optional[int] = 10000
+) -> np.ndarray:
+    """
+    Draws one sample per parameter value from a distribution truncated to
+    the open interval (lower, upper) by rejection sampling. In every round,
+    new candidates are drawn at once for all samples not accepted so far.
+
+    :param draw:
+        function drawing one random value per parameter value (e.g.,
+        `np.random.gamma`)
+    :param params:
+        parameter values of the distribution
+    :param lower:
+        lower boundaries (exclusive) per parameter value
+    :param upper:
+        upper boundaries (exclusive) per parameter value
+    :param max_rounds:
+        maximum number of rounds before giving up
+    :returns:
+        accepted samples
+    """
+    samples = np.empty(params.shape, dtype='float64')
+    pending = np.arange(params.size)
+    for _ in range(max_rounds):
+        if pending.size == 0:
+            return samples
+        candidates = draw(params[pending])
+        accepted = (lower[pending] < candidates) & \
+            (candidates < upper[pending])
+        samples[pending[accepted]] = candidates[accepted]
+        pending = pending[~accepted]
+    raise ValueError(
+        f'{pending.size} samples not within their boundaries after ' +
+        f'{max_rounds} rounds')
+
 
 def chlorophyll_carotiniod_constraint(lut_df: pd.DataFrame) -> pd.DataFrame:
     """
@@ -113,19 +159,13 @@ def chlorophyll_carotiniod_constraint(lut_df: pd.DataFrame) -> pd.DataFrame:
         Sample leaf carotenoid values based on leaf chlorophyll
         values
         """
-        if isinstance(cab, float):
-            cab = [cab]
-        car_samples = []
-        for cab_val in cab:
-            lower = lower_boundary(cab_val)
-            upper = upper_boundary(cab_val)
-            regression_val = cab_car_regression(cab_val)
-            while True:
-                car_sample = poisson.rvs(mu=regression_val)
-                if lower < car_sample < upper:
-                    car_samples.append(car_sample)
-                    break
-        return np.array(car_samples)
+        cab = np.atleast_1d(np.asarray(cab, dtype='float64'))
+        return _rejection_sample(
+            draw=np.random.poisson,
+            params=cab_car_regression(cab),
+            lower=lower_boundary(cab),
+            upper=upper_boundary(cab)
+        )
 
     # sample car based on cab as suggested by Wocher et al. (2020)
     cab = lut_df['cab']
@@ -190,19 +230,13 @@ def glai_ccc_constraint(lut_df: pd.DataFrame) -> pd.DataFrame:
         Sample CCC values based on GLAI values using a truncated
         Gamma distribution between lower and upper bounds
         """
-        if isinstance(glai, float):
-            glai = [glai]
-        ccc_samples = []
-        for glai_val in glai:
-            lower = lower_boundary(glai_val)
-            upper = upper_boundary(glai_val)
-            regression_val = glai_ccc_regression(glai_val)
-            while True:
-                ccc_sample = np.random.gamma(regression_val)
-                if lower < ccc_sample < upper:
-                    ccc_samples.append(ccc_sample)
-                    break
-        return np.array(ccc_samples)
+        glai = np.atleast_1d(np.asarray(glai, dtype='float64'))
+        return _rejection_sample(
+            draw=np.random.gamma,
+            params=glai_ccc_regression(glai),
+            lower=lower_boundary(glai),
+            upper=upper_boundary(glai)
+        )
 
     # redistribute CCC based on glai-ccc relationship
     glai = lut_df['lai']
@@ -216,7 +250,7 @@ def glai_ccc_constraint(lut_df: pd.DataFrame) -> pd.DataFrame:
     return out_df
 
 
-def green_is_valid(wvls: np.ndarray, spectrum: np.ndarray) -> bool:
+def green_is_valid(wvls: np.ndarray, spectrum: np.ndarray) -> bool | np.ndarray:
     """
     Checks if a simulated spectrum is valid in terms of the position
     of its green-peak. Green peaks occuring at wavelengths >547nm are
@@ -226,16 +260,20 @@ def green_is_valid(wvls: np.ndarray, spectrum: np.ndarray) -> bool:
     :param wvls:
         array with wavelengths in nm
     :param spectrum:
-        corresponding spectral data
+        corresponding spectral data. Can be also a 2-d array of spectra
+        with shape (n_spectra, n_wvls)
     :returns:
-        `True` if the green-peak is valid, else `False`.
+        `True` if the green-peak is valid, else `False`. For 2-d input, a
+        boolean array with one entry per spectrum.
     """
     # get array indices of wavelengths in "green" part of the spectrum
     green_wvls_idx = np.where(wvls == green_region[0])[0][0], np.where(wvls == green_region[1])[0][0]
-    green_spectrum = spectrum[green_wvls_idx[0]:green_wvls_idx[1]]
+    green_spectrum = spectrum[..., green_wvls_idx[0]:green_wvls_idx[1]]
     green_wvls = wvls[green_wvls_idx[0]:green_wvls_idx[1]]
-    green_peak = green_wvls[np.argmax(green_spectrum)]
+    green_peak = green_wvls[np.argmax(green_spectrum, axis=-1)]
     # green peaks smaller than the threshold are considered invalid
+    if np.ndim(green_peak) > 0:
+        return green_peak >= green_peak_threshold
     if green_peak < green_peak_threshold:
         return False
     else:
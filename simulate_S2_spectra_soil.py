@@ -10,7 +10,8 @@ from pathlib import Path
 from typing import Any, Dict, List, Optional
 from datetime import datetime
 from rtm_inv.core.lookup_table import LookupTable, generate_lut, simulate_from_lut
-import pickle
+from rtm_inv.core.lut_cache import LUTCache
+from rtm_inv.core.lut_io import lut_suffix, write_lut
 import numpy as np
 import pandas as pd
 
@@ -52,7 +53,8 @@ def generate_spectra(
     lut_params_dir: Path,
     lut_config: Dict[str, Any],
     rtm_config: Dict[str, Any],
-    traits: List[str]
+    traits: List[str],
+    lut_cache: Optional[LUTCache] = None
   ) -> None:
 
   logger = get_logger()
@@ -68,10 +70,20 @@ def generate_spectra(
   # generate lookup-table
   trait_str = '-'.join(traits)
   fpath_lut = output_dir.joinpath(
-    f'{pheno_phases}_{trait_str}_lut_no-constraints.pkl') 
+    f'{pheno_phases}_{trait_str}_lut_no-constraints{lut_suffix}')
+
+  # if LUT exists (also as legacy pickle), continue, else generate it
+  if not (fpath_lut.exists() or fpath_lut.with_suffix('.pkl').exists()):
+    # look up the LUT in the cache shared across runs
+    if lut_cache is not None:
+      lut_key = lut_cache.key(
+        lut_params=lut_params_pheno, traits=traits,
+        **{**lut_config, **rtm_config})
+      if lut_cache.get(lut_key) is not None:
+        lut_cache.link(lut_key, fpath_lut)
+        logger.info('Finished PROSAIL runs (LUT from cache)')
+        return
 
-  # if LUT exists, continue, else generate it
-  if not fpath_lut.exists():
     lut_inp = lut_config.copy()
     lut_inp['lut_params'] = lut_params_pheno
     lut = generate_lut(**lut_inp)
@@ -88,9 +100,13 @@ def generate_spectra(
 
     lut.dropna(inplace=True)
 
-    # save LUT to file
-    with open(fpath_lut, 'wb') as f:
-      pickle.dump(lut, f, protocol=3)
+    # save LUT to file (columnar format with metadata)
+    lut_metadata = {'params_file': lut_params_pheno.name}
+    if lut_cache is not None:
+      lut_cache.put(lut_key, lut, metadata=lut_metadata)
+      lut_cache.link(lut_key, fpath_lut)
+    else:
+      write_lut(lut, fpath_lut, metadata=lut_metadata)
 
   else:
     pass
@@ -120,10 +136,10 @@ def generate_spectra_soil(
   # generate lookup-table
   trait_str = '-'.join(traits)
   fpath_lut = output_dir.joinpath(
-    f'{pheno_phases}_{trait_str}_lut_no-constraints.pkl') #
+    f'{pheno_phases}_{trait_str}_lut_no-constraints{lut_suffix}')
 
-  # if LUT exists, continue, else generate it
-  if not fpath_lut.exists():
+  # if LUT exists (also as legacy pickle), continue, else generate it
+  if not (fpath_lut.exists() or fpath_lut.with_suffix('.pkl').exists()):
     # Generate LUT
     lut_inp = lut_config.copy()
     lut_inp['lut_params'] = lut_params_pheno
@@ -162,9 +178,8 @@ def generate_spectra_soil(
     lut.dropna(inplace=True)
 
  
-    # save LUT to file
-    with open(fpath_lut, 'wb+') as f:
-      pickle.dump(lut, f)
+    # save LUT to file (columnar format with metadata)
+    write_lut(lut, fpath_lut, metadata={'params_file': lut_params_pheno.name})
 
   else:
     pass
@@ -232,6 +247,9 @@ if __name__ == '__main__':
 
   # directory with LUT parameters for different phenological macro-stages
   lut_params_dir = Path('lut_params')
+  # LUTs shared across runs (bounded to 20 GB)
+  lut_cache = LUTCache(
+    cache_dir=out_dir.joinpath('lut_cache'), max_size=20 * 1024**3)
   # Path to soil spectra to use
   soil_path = Path('../results/GEE_baresoil_v2/sampled_spectra_all_CH.pkl')
 
@@ -248,7 +266,8 @@ if __name__ == '__main__':
             lut_params_dir=lut_params_dir,
             lut_config=lut_config,
             rtm_config=rtm_config,
-            traits=traits
+            traits=traits,
+            lut_cache=lut_cache
         )
 
     except Exception as e:
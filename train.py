@@ -17,6 +17,7 @@ import pickle
 import torch
 
 from models import MODELS
+from rtm_inv.core.lut_io import read_lut
 
 def load_config(config_path: str) -> Dict:
   ''' 
@@ -40,7 +41,7 @@ def prepare_data_old(config: dict) -> Union[Tuple[np.array, np.array, np.array,
   data_path = config['Data']['data_path']
 
   if isinstance(data_path, str):
-    df = pd.read_pickle(data_path)
+    df = read_lut(data_path)
     X = df[config['Data']['train_cols']]
     y = df[config['Data']['target_col']]
     X_train, X_test, y_train, y_test = train_test_split(X, y.values, test_size=config['Data']['test_size'], random_state=config['Seed'])
@@ -85,8 +86,8 @@ def prepare_data_old(config: dict) -> Union[Tuple[np.array, np.array, np.array,
       return X_train.values, X_test.values, y_train, y_test
 
   elif isinstance(data_path, list):
-    # Assuming all files in the list are pickled DataFrames
-    dfs = [pd.read_pickle(path) for path in data_path]
+    # Assuming all files in the list are LUTs (columnar or pickled DataFrames)
+    dfs = [read_lut(path) for path in data_path]
     concatenated_df = pd.concat(dfs, axis=0, ignore_index=True)
     # Sample data
     #concatenated_df = concatenated_df.sample(100, random_state=config['Seed'])
@@ -151,13 +152,13 @@ def prepare_data(config: dict) -> Union[Tuple[np.array, np.array, np.array, np.a
   ##### Load test data
 
   if isinstance(test_data_path, str):
-    df = pd.read_pickle(test_data_path)
+    df = read_lut(test_data_path)
     X_test = df[config['Data']['train_cols']]
     y_test = df[config['Data']['target_col']]
 
   elif isinstance(test_data_path, list):
-    # Assuming all files in the list are pickled DataFrames
-    dfs = [pd.read_pickle(path) for path in test_data_path]
+    # Assuming all files in the list are LUTs (columnar or pickled DataFrames)
+    dfs = [read_lut(path) for path in test_data_path]
     concatenated_df = pd.concat(dfs, axis=0, ignore_index=True)
     X_test = concatenated_df[config['Data']['train_cols']]
     y_test = concatenated_df[config['Data']['target_col']] 
@@ -165,7 +166,7 @@ def prepare_data(config: dict) -> Union[Tuple[np.array, np.array, np.array, np.a
   ##### Load train data, normalize train and test
 
   if isinstance(data_path, str):
-    df = pd.read_pickle(data_path)
+    df = read_lut(data_path)
     X_train = df[config['Data']['train_cols']]
     y_train = df[config['Data']['target_col']]
     
@@ -199,8 +200,8 @@ def prepare_data(config: dict) -> Union[Tuple[np.array, np.array, np.array, np.a
   
 
   elif isinstance(data_path, list):
-    # Assuming all files in the list are pickled DataFrames
-    dfs = [pd.read_pickle(path) for path in data_path]
+    # Assuming all files in the list are LUTs (columnar or pickled DataFrames)
+    dfs = [read_lut(path) for path in data_path]
     concatenated_df = pd.concat(dfs, axis=0, ignore_index=True)
     #concatenated_df = concatenated_df.sample(10, random_state=config['Seed'])
     X_train = concatenated_df[config['Data']['train_cols']]